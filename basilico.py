@@ -1,9 +1,12 @@
 #!/usr/bin/env python
+import hashlib
 import json
+import re
 import subprocess
 import stat
 import os
 import sys
+import tempfile
 import time
 from collections import deque
 from typing import Optional, Callable, Dict, Set, List
@@ -21,10 +24,44 @@ import logging
 from datetime import datetime
 
 from read_smartctl import extract_smart_data, smart_health_status, parse_single_disk
+from progress_reader import ProgressReader, ProgressParser, BadblocksProgressParser, E2fsckProgressParser, Resize2fsProgressParser, GrowpartParser
+from erase_engine import (
+    EraseEngine,
+    EraseProgress,
+    parse_size,
+    parse_fraction,
+    format_rate,
+    merge_ranges,
+    convert_ranges,
+    logical_sector_size,
+    profile_patterns,
+    VERIFY_FULL,
+    DEFAULT_PROFILE,
+    RANDOM,
+)
+from secure_erase import SecureEraser, EraseDevice, SecureEraseError, ERASE_METHODS, DISCARD
+from state_store import CheckpointStore, BadBlockStore, CodeCache
+from bus_scheduler import BusScheduler, bus_group
+from rate_limiter import RateLimiter
+from decompress import compression_of
+from fanout import FanoutRegistry
+from image_catalog import ImageCatalog
+from hotplug import UeventMonitor
+from block_devices import BlockDeviceScanner
+from code_resolver import CodeResolver
+from partition_table import partition_path, reread_partition_table
+from bmap import BlockMap, BmapError, find_bmap, load_bmap, create_bmap, save_bmap, BMAP_SUFFIX
+from imaging import ImageWriter, ImageProgress, ImageError, supports_write_zeroes, COPY_AUTO, ZEROES_WRITE, ZEROES_SKIP, ZEROES_ZEROOUT
 
 NAME = "basilico"
+OPTION_REGEX = re.compile(r"[a-z_]+=\S*")
 # Use env vars, do not change the value here
 TEST_MODE = False
+BADBLOCKS_BLOCK_SIZE = 4096
+# Seconds between two checkpoints of a badblocks run
+CHECKPOINT_INTERVAL = 30
+# With a rate limit badblocks runs on chunks of this size, waiting between them
+THROTTLED_SEGMENT_SIZE = 1024 * 1024 * 1024
 
 
 class Disk:
@@ -39,14 +76,28 @@ class Disk:
         self._composite_id = Disk.make_composite_id(self._lsblk)
         self._code = None
         self._item = None
+        self._erase_method = None
+        # Only zeroes since the last erase, nothing has been written after that
+        self._zeroed = False
+        # Bumped whenever something that clients see changes, see disks_since
+        self._created_version = next_disk_version()
+        self._version = self._created_version
 
         self._update_lock = threading.Lock()
+        # Lookups on Tarallo and codes set by uploads, one at a time
+        self._code_lock = threading.RLock()
         self._queue_lock = threading.Lock()
         self._commands_queue = deque()
+        self._bus_group = bus_group(self._path)
 
         self._tarallo = tarallo
-        self._get_code(False)
-        self._get_item()
+        self._code_pending = False
+        if self._tarallo:
+            # The disk is listed right away, its code follows in a disks_delta
+            self.resolve_code()
+        else:
+            self._get_code(False)
+            self._get_item()
 
     def update_mountpoints(self):
         with self._update_lock:
@@ -54,6 +105,8 @@ class Disk:
             lsblk2 = get_disks(self._path)
             for one_disk in lsblk2:
                 if one_disk.get("path") == self._path:
+                    if self._lsblk.get("mountpoint") != one_disk.get("mountpoint", []):
+                        self.touch()
                     self._lsblk["mountpoint"] = one_disk.get("mountpoint", [])
                     self._mountpoint_map = one_disk.get("mountpoint_map", {})
                     # This is not copied over again
@@ -61,11 +114,41 @@ class Disk:
                     #     del self._lsblk["mountpoint_map"]
                     break
 
+    def update_lsblk(self, lsblk: dict) -> bool:
+        """Take what lsblk says now about the same disk, True if anything changed"""
+        with self._update_lock:
+            lsblk = dict(lsblk)
+            mountpoint_map = lsblk.pop("mountpoint_map", {})
+            if mountpoint_map == self._mountpoint_map and all(self._lsblk.get(key) == value for key, value in lsblk.items()):
+                return False
+            self._lsblk.update(lsblk)
+            self._mountpoint_map = mountpoint_map
+            self.touch()
+            return True
+
     def get_mountpoints_map(self) -> dict:
         # Probably pointless lock
         with self._update_lock:
             return self._mountpoint_map
 
+    def get_composite_id(self) -> tuple:
+        return self._composite_id
+
+    def get_version(self) -> int:
+        return self._version
+
+    def get_created_version(self) -> int:
+        return self._created_version
+
+    def touch(self):
+        self._version = next_disk_version()
+
+    def get_size(self) -> int:
+        return int(self._lsblk.get("size") or 0)
+
+    def get_serial(self) -> Optional[str]:
+        return self._lsblk.get("serial")
+
     @staticmethod
     def make_composite_id(lsblk: dict):
         return lsblk.get("path"), lsblk.get("wwn"), lsblk.get("serial")
@@ -103,18 +186,46 @@ class Disk:
     def get_path(self):
         return self._path
 
-    def update_from_tarallo_if_needed(self) -> bool:
-        changes = False
-        if not self._code:
-            old_code = self._code
-            self._get_code(True)
-            changes = self._code == old_code
-        self._get_item()
-        return changes
+    def get_bus_group(self) -> str:
+        return self._bus_group
+
+    def update_from_tarallo_if_needed(self, cached: bool = True) -> bool:
+        with self._code_lock:
+            changes = False
+            # Also if it was set by an upload while another lookup was running
+            if not self._code:
+                old_code = self._code
+                self._get_code(True, cached)
+                changes = self._code != old_code
+                if changes:
+                    self.touch()
+            self._get_item()
+            return changes
+
+    def resolve_code(self, on_error: Optional[Callable[[str, Exception], None]] = None) -> bool:
+        """Look up the missing code on Tarallo in the background, without holding disks_lock"""
+        if not self._tarallo or self._code:
+            return False
+        self._code_pending = True
+        return CODE_RESOLVER.submit(self, self.update_from_tarallo_if_needed, lambda _changes, error: self._code_resolved(error, on_error))
+
+    def _code_resolved(self, error: Optional[Exception], on_error: Optional[Callable[[str, Exception], None]]):
+        before = current_disk_version()
+        self._code_pending = False
+        self.touch()
+        send_disks_delta(before)
+        if isinstance(error, ErrorThatCanBeManuallyFixed):
+            if on_error:
+                on_error(self._path, error)
+            else:
+                logging.info(str(error))
+        elif error is not None:
+            logging.warning(f"Tarallo lookup failed for disk {self._path}", exc_info=error)
 
     def serialize_disk(self):
         result = self._lsblk
         result["code"] = self._code
+        result["code_pending"] = self._code_pending
         critical = False
         if not TEST_MODE:
             for mountpoint in self._lsblk["mountpoint"]:
@@ -122,6 +233,9 @@ class Disk:
                     critical = True
                     break
         result["has_critical_mounts"] = critical
+        result["erase_method"] = self._erase_method
+        result["version"] = self._version
+        result["epoch"] = DISKS_EPOCH
         return result
 
     def update_status(self, status: str) -> bool:
@@ -130,7 +244,12 @@ class Disk:
             return True
         return False
 
-    def update_erase(self, erased: bool, all_blocks_ok: Optional[bool]) -> bool:
+    def update_erase(self, erased: bool, all_blocks_ok: Optional[bool], method: Optional[str] = None) -> bool:
+        if erased:
+            # badblocks, native, or a hardware method like ata-secure-erase
+            if self._erase_method != method:
+                self._erase_method = method
+                self.touch()
         if self._tarallo and self._code:
             data = {}
             # Can be True, False or None
@@ -145,6 +264,12 @@ class Disk:
             return True
         return False
 
+    def is_zeroed(self) -> bool:
+        return self._zeroed
+
+    def set_zeroed(self, zeroed: bool):
+        self._zeroed = zeroed
+
     def update_software(self, software: str) -> bool:
         if self._tarallo and self._code:
             data = {"software": software}
@@ -153,7 +278,8 @@ class Disk:
             return True
         return False
 
-    def _get_code(self, stop_on_error: bool = True):
+    def _get_code(self, stop_on_error: bool = True, cached: bool = True):
+        # Hold _code_lock, unless the disk is still being created
         if not self._tarallo:
             if TEST_MODE:
                 import binascii
@@ -176,14 +302,23 @@ class Disk:
         if sn and sn.startswith("WD-"):
             sn = sn[3:]
 
+        if sn and cached and CODE_CACHE is not None:
+            found, code = CODE_CACHE.lookup(sn)
+            if found:
+                self._code = code
+                logging.debug(f"Disk {sn} is {code if code else 'not in tarallo'} according to the cache")
+                return
+
         try:
             codes = self._tarallo.get_codes_by_feature("sn", sn)
             if len(codes) <= 0:
                 self._code = None
                 logging.debug(f"Disk {sn} not found in tarallo")
+                self._remember_code(sn)
             elif len(codes) == 1:
                 self._code = codes[0]
                 logging.debug(f"Disk {sn} found as {self._code}")
+                self._remember_code(sn)
             else:
                 self._code = None
                 if stop_on_error:
@@ -206,6 +341,11 @@ class Disk:
             if stop_on_error:
                 raise ErrorThatCanBeManuallyFixed(f"Tarallo lookup for disk with S/N {sn} failed, more info has been logged on the server")
 
+    def _remember_code(self, sn: Optional[str]):
+        # Only answers from Tarallo, not duplicates or errors, someone has to fix those
+        if sn and CODE_CACHE is not None:
+            CODE_CACHE.remember(sn, self._code)
+
     def _get_item(self):
         if self._tarallo and self._code:
             # Nothing to do, only the code is used at the moment. Add a try-except if you uncomment.
@@ -229,7 +369,11 @@ class Disk:
         return None
 
     def set_code(self, code: str):
-        self._code = code
+        # Waits for a lookup that is running, which would overwrite the code otherwise
+        with self._code_lock:
+            if self._code != code:
+                self._code = code
+                self.touch()
 
 
 class SudoSessionKeeper(threading.Thread):
@@ -251,6 +395,8 @@ class CommandRunner(threading.Thread):
         self._the_id = the_id
         self._go = True
         self._queued_command = None
+        self._bus_group = None
+        self._bus_share = None
 
         self._function, disk_for_queue = self.dispatch_command(cmd, args)
         if not self._function:
@@ -305,6 +451,7 @@ class CommandRunner(threading.Thread):
             except Exception as e:
                 logging.error(f"[{self._the_id}] BIG ERROR in command thread", exc_info=e)
         finally:
+            self._release_bus()
             # The next thread on the disk can start, if there's a queue
             if self._queued_command:
                 # Notify finish only if not already notified, as a catch all for errors
@@ -330,6 +477,7 @@ class CommandRunner(threading.Thread):
             "smartctl": self.get_smartctl,
             "queued_smartctl": self.queued_get_smartctl,
             "queued_badblocks": self.badblocks,
+            "queued_secure_erase": self.secure_erase,
             "queued_cannolo": self.cannolo,
             "queued_sleep": self.sleep,
             "queued_umount": self.umount,
@@ -344,6 +492,11 @@ class CommandRunner(threading.Thread):
             "remove_completed": self.remove_all_from_queue,
             "remove_queued": self.remove_all_from_queue,
             "list_iso": self.list_iso,
+            "get_bus_groups": self.get_bus_groups,
+            "get_code_cache": self.get_code_cache,
+            "set_rate_limit": self.set_rate_limit,
+            "get_badblocks_map": self.get_badblocks_map,
+            "create_bmap": self.create_bmap,
             "stop": self.stop_process,
         }
         logging.debug(f"[{self._the_id}] Received command {cmd}{' with args' if len(args) > 0 else ''}")
@@ -365,18 +518,28 @@ class CommandRunner(threading.Thread):
             for queued_command in queued_commands:
                 queued_command.unlock_notifications()
 
+    @staticmethod
+    def split_options(args: str) -> (str, Dict[str, str]):
+        # Options are "key=value" words at the end of the arguments, e.g. "/dev/sda engine=native"
+        parts = args.split(" ")
+        options = {}
+        while len(parts) > 1 and OPTION_REGEX.fullmatch(parts[-1]):
+            key, value = parts.pop().split("=", 1)
+            options[key] = value
+        return " ".join(parts), options
+
     @staticmethod
     def dev_from_args(args: str):
         # This may be more complicated for some future commands
         return args.split(" ", 1)[0]
 
     def list_iso(self, cmd: str, iso_dir: str):
-        files = []
         try:
-            for file in os.listdir(iso_dir):
-                if file.startswith("."):
-                    continue
-                files.append(os.path.join(iso_dir, file))
+            if IMAGES is not None:
+                # Size, mtime, compression, checksum and partitions of each image
+                files = IMAGES.list(iso_dir)
+            else:
+                files = [{"path": os.path.join(iso_dir, file)} for file in os.listdir(iso_dir) if not file.startswith(".")]
         except FileNotFoundError:
             self.send_msg(
                 "error",
@@ -443,12 +606,32 @@ class CommandRunner(threading.Thread):
                 break
         return None
 
-    def badblocks(self, _cmd: str, dev: str):
+    def badblocks(self, _cmd: str, args: str):
+        dev, options = self.split_options(args)
+        engine = options.get("engine", "badblocks")
+        if options.get("verify", VERIFY_FULL) != VERIFY_FULL:
+            # badblocks always reads back everything
+            engine = "native"
+        if engine not in ("badblocks", "native"):
+            self._queued_command.notify_finish_with_error(f"Unknown erase engine {engine}")
+            return
+        profile = options.get("profile", DEFAULT_PROFILE)
+        try:
+            patterns = profile_patterns(profile)
+        except ValueError as e:
+            self._queued_command.notify_finish_with_error(str(e))
+            return
+        if not self._set_job_rate(options):
+            return
+
         go_ahead = self._unswap()
         if not go_ahead:
             return
 
-        self._queued_command.notify_start("Running badblocks")
+        if not self._acquire_bus():
+            return
+
+        self._queued_command.notify_start("Running badblocks" if engine == "badblocks" else "Erasing")
         if TEST_MODE:
             final_message = ""
             for progress in range(0, 100, 10):
@@ -463,121 +646,348 @@ class CommandRunner(threading.Thread):
             completed = True
             all_ok = False
         else:
-            custom_env = os.environ.copy()
-            custom_env["LC_ALL"] = "C"
-
-            pipe = subprocess.Popen(
-                (
-                    "sudo",
-                    "-n",
-                    "badblocks",
-                    "-w",
-                    "-s",
-                    "-p",
-                    "0",
-                    "-t",
-                    "0x00",
-                    "-b",
-                    "4096",
-                    dev,
-                ),
-                stderr=subprocess.PIPE,
-                env=custom_env,
-            )  # , stdout=subprocess.PIPE)
-
-            percent = 0.0
-            reading_and_comparing = False
-            errors = -1
-            deleting = False
-            buffer = bytearray()
-            for char in iter(lambda: pipe.stderr.read(1), b""):
+            if engine == "native":
+                outcome = self._erase_native(dev, options, patterns)
+            else:
+                outcome = self._erase_badblocks(dev, options, patterns)
+            if outcome is None:
+                # Already notified
+                return
+            completed, all_ok, final_message = outcome
+
+        self._finish_erase(dev, completed, all_ok, engine, f"{final_message} (profile {profile}: {', '.join(patterns)})".strip(), patterns[-1] == "0x00")
+
+    def secure_erase(self, _cmd: str, args: str):
+        dev, options = self.split_options(args)
+        method = options.get("method")
+        if method is not None and method not in ERASE_METHODS:
+            self._queued_command.notify_finish_with_error(f"Unknown erase method {method}")
+            return
+
+        go_ahead = self._unswap()
+        if not go_ahead:
+            return
+
+        self._queued_command.notify_start("Checking erase capabilities")
+        if TEST_MODE:
+            method = method or DISCARD
+            for progress in range(0, 100, 10):
                 if not self._go:
-                    pipe.kill()
-                    pipe.wait()
-                    print(f"Killed badblocks process {self.get_queued_command().id()}")
                     self._queued_command.notify_finish_with_error("Process terminated by user.")
                     return
-                if char == b"":
-                    if pipe.poll() is not None:
-                        break
-                elif char == b"\b":
-                    if not deleting:
-                        result = buffer.decode("utf-8")
-                        errors_print = "?"
-
-                        reading_and_comparing = reading_and_comparing or ("Reading and comparing" in result)
-
-                        # If other messages are printed, ignore them
-                        i = result.index("% done")
-                        if i >= 0:
-                            # /2 due to the 0x00 test + read & compare
-                            percent = float(result[i - 6 : i]) / 2
-                            if reading_and_comparing:
-                                percent += 50
-                            i = result.index("(", i)
-                            if i >= 0:
-                                # errors_str = result[i+1:].split(")", 1)[0]
-                                errors_str = result[i + 1 :].split(" ", 1)[0]
-                                # The errors are read, write and corruption
-                                errors_str = errors_str.split("/")
-                                errors = 0  # badblocks prints the 3 totals every time
-                                for error in errors_str:
-                                    errors += int(error)
-                                errors_print = str(errors)
-                            self._queued_command.notify_percentage(percent, f"{errors_print} errors")
-                        buffer.clear()
-                        deleting = True
-                # elif char == b'\n':
-                #     # Skip the first lines (total number of blocks)
-                #     buffer.clear()
-                else:
-                    if deleting:
-                        deleting = False
-                    buffer += char
-
-            # TODO: was this needed? Why were we doing it twice?
-            # pipe.wait()
-            exitcode = pipe.wait()
-
-            if errors <= -1:
-                all_ok = None
-                errors_print = "an unknown amount of"
-            elif errors == 0:
-                all_ok = True
-                errors_print = "no"
-            else:
-                all_ok = False
-                errors_print = str(errors)
-            final_message = f"Finished with {errors_print} errors"
-
-            if exitcode == 0:
-                # self._queued_command.notify_finish(final_message)
-                completed = True
-            else:
-                self._queued_command.notify_error()
-                final_message += f" and badblocks exited with status {exitcode}"
-                # self._queued_command.notify_finish(final_message)
-                completed = False
+                self._queued_command.notify_percentage(progress, f"Simulating {method}")
+                threading.Event().wait(1)
+        else:
+            eraser = SecureEraser(EraseDevice(dev))
+            method = method or eraser.best_method()
+            if method is None:
+                self._queued_command.notify_finish_with_error("The disk supports no hardware erase method, use badblocks")
+                return
+            try:
+                completed = eraser.erase(method, self._queued_command.notify_percentage, lambda: self._go)
+            except SecureEraseError as e:
+                logging.warning(f"[{self._the_id}] {method} of {dev} failed: {str(e)}")
+                self._queued_command.notify_finish_with_error(str(e))
+                return
+            if not completed:
+                self._queued_command.notify_finish_with_error("Process terminated by user.")
+                return
 
-            # print(pipe.stdout.readline().decode('utf-8'))
-            # print(pipe.stderr.readline().decode('utf-8'))
+        # The drive does not report anything about bad blocks
+        self._finish_erase(dev, True, None, method, f"Erased with {method}")
 
+    def _finish_erase(self, dev: str, completed: bool, all_ok: Optional[bool], method: str, final_message: str, zeroed: bool = False):
         with disks_lock:
             update_disks_if_needed(self)
             disk_ref = disks[dev]
+        disk_ref.set_zeroed(completed and zeroed)
 
         # noinspection PyBroadException
         try:
-            disk_ref.update_erase(completed, all_ok)
+            disk_ref.update_erase(completed, all_ok, method)
         except Exception as e:
             final_message = f"Error during upload. {final_message}"
             self._queued_command.notify_error(final_message)
             logging.warning(
-                f"[{self._the_id}] Can't update badblocks results of {dev} on tarallo",
+                f"[{self._the_id}] Can't update erase results of {dev} on tarallo",
                 exc_info=e,
             )
         self._queued_command.notify_finish(final_message)
 
+    def _erase_badblocks(self, dev: str, options: Dict[str, str], patterns: List[str]) -> Optional[tuple[bool, Optional[bool], str]]:
+        custom_env = os.environ.copy()
+        custom_env["LC_ALL"] = "C"
+
+        size = self._queued_command.disk.get_size()
+        blocks = size // BADBLOCKS_BLOCK_SIZE
+        first_block = 0
+        previous_errors = 0
+        # Same key as before profiles existed, for the zero profile
+        pattern = "/".join(patterns)
+        checkpoint = self._get_erase_checkpoint(size, options, pattern)
+        if checkpoint is not None:
+            first_block = checkpoint["verified"] // BADBLOCKS_BLOCK_SIZE
+            previous_errors = checkpoint["errors"]
+
+        # badblocks cannot be slowed down while it runs, so with a rate limit it is run on a chunk at a time
+        # and the limit is applied between chunks. Checked before each chunk, since set_rate_limit can be
+        # called at any time: without a limit the rest of the disk is done in one go.
+        def next_segments():
+            first = first_block
+            step = THROTTLED_SEGMENT_SIZE // BADBLOCKS_BLOCK_SIZE
+            while first < blocks:
+                last = min(first + step, blocks) - 1 if self._is_throttled() else blocks - 1
+                yield first, last
+                first = last + 1
+
+        if blocks <= 0:
+            # Unknown size, let badblocks find out
+            segments = [(0, -1)]
+        else:
+            segments = next_segments()
+
+        # badblocks -i skips the blocks listed in the file
+        known_bad = self._get_known_bad_ranges(options, BADBLOCKS_BLOCK_SIZE)
+        known_file = None
+        if len(known_bad) > 0:
+            known_file = tempfile.NamedTemporaryFile("w", prefix="basilico-", suffix=".txt")
+            for first, count in known_bad:
+                known_file.write("".join(f"{block}\n" for block in range(first, first + count)))
+            known_file.flush()
+        known_args = ("-i", known_file.name) if known_file is not None else ()
+        # badblocks prints the bad blocks it finds on stdout
+        found_file = tempfile.TemporaryFile("w+")
+
+        try:
+            resumed = first_block * BADBLOCKS_BLOCK_SIZE * 2 * len(patterns)
+            last_checkpoint = time.monotonic()
+            errors = 0
+            exitcode = 0
+            for segment_first, segment_last in segments:
+                # Write and read back each pattern
+                segment_bytes = (segment_last - segment_first + 1) * BADBLOCKS_BLOCK_SIZE * 2 * len(patterns)
+                done = segment_first * BADBLOCKS_BLOCK_SIZE * 2 * len(patterns)
+                if not self._throttle(segment_bytes):
+                    self._queued_command.notify_finish_with_error("Process terminated by user.")
+                    return None
+                # badblocks wants the last block (inclusive) before the first one
+                block_range = (str(segment_last), str(segment_first)) if segment_first > 0 or segment_last < blocks - 1 else ()
+
+                pipe = subprocess.Popen(
+                    ("sudo", "-n", "badblocks", "-w", "-s", "-p", "0")
+                    + tuple(arg for pattern in patterns for arg in ("-t", pattern))
+                    + ("-b", str(BADBLOCKS_BLOCK_SIZE))
+                    + known_args
+                    + (dev,)
+                    + block_range,
+                    stdout=found_file,
+                    stderr=subprocess.PIPE,
+                    env=custom_env,
+                )
+
+                progress_reader = ProgressReader(pipe.stderr, BadblocksProgressParser(len(patterns)))
+                for progress in progress_reader:
+                    if not self._go:
+                        pipe.kill()
+                        pipe.wait()
+                        print(f"Killed badblocks process {self.get_queued_command().id()}")
+                        self._queued_command.notify_finish_with_error("Process terminated by user.")
+                        return None
+                    if progress is not None:
+                        bytes_done = done + int(progress.percent / 100 * segment_bytes)
+                        self._queued_command.notify_io(bytes_done, size * 2 * len(patterns), f"{previous_errors + errors + progress.errors} errors", resumed)
+                        if progress.verified > 0 and time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                            last_checkpoint = time.monotonic()
+                            verified_block = segment_first + int(progress.verified * (segment_last - segment_first + 1))
+                            self._set_erase_checkpoint(size, verified_block * BADBLOCKS_BLOCK_SIZE, previous_errors + errors + progress.errors, pattern=pattern)
+                segment_errors = progress_reader.parser.errors
+                # TODO: was this needed? Why were we doing it twice?
+                # pipe.wait()
+                exitcode = pipe.wait()
+                if segment_errors < 0:
+                    errors = -1
+                elif errors >= 0:
+                    errors += segment_errors
+                if exitcode != 0:
+                    break
+                if segment_last < blocks - 1:
+                    self._set_erase_checkpoint(size, (segment_last + 1) * BADBLOCKS_BLOCK_SIZE, previous_errors + max(0, errors), pattern=pattern)
+            found_file.seek(0)
+            found_blocks = [int(line) for line in found_file if line.strip().isdigit()]
+        finally:
+            found_file.close()
+            if known_file is not None:
+                known_file.close()
+        if errors >= 0:
+            errors += previous_errors
+
+        if errors <= -1:
+            all_ok = None
+            errors_print = "an unknown amount of"
+        elif errors == 0:
+            all_ok = True
+            errors_print = "no"
+        else:
+            all_ok = False
+            errors_print = str(errors)
+        final_message = f"Finished with {errors_print} errors"
+
+        if exitcode == 0:
+            # self._queued_command.notify_finish(final_message)
+            completed = True
+            self._clear_erase_checkpoint()
+            # Skipped blocks are still bad
+            self._record_bad_blocks(merge_ranges([[block, 1] for block in found_blocks] + known_bad), BADBLOCKS_BLOCK_SIZE, first_block, None, "badblocks")
+        else:
+            self._queued_command.notify_error()
+            final_message += f" and badblocks exited with status {exitcode}"
+            # self._queued_command.notify_finish(final_message)
+            completed = False
+
+        # print(pipe.stdout.readline().decode('utf-8'))
+        # print(pipe.stderr.readline().decode('utf-8'))
+        return completed, all_ok, final_message
+
+    def _erase_native(self, dev: str, options: Dict[str, str], patterns: List[str]) -> Optional[tuple[bool, Optional[bool], str]]:
+        verify = options.get("verify", VERIFY_FULL)
+        # In sample mode the checkpoint is where writing got to, not what has been verified
+        pattern = "/".join(patterns) if verify == VERIFY_FULL else f"{'/'.join(patterns)}/{verify}"
+        size = self._queued_command.disk.get_size()
+        start_offset = 0
+        previous_ranges = []
+        checkpoint = self._get_erase_checkpoint(size, options, pattern)
+        if checkpoint is not None and RANDOM in patterns and checkpoint.get("seed") is None:
+            # Random data from before seeds were stored cannot be generated again to read it back
+            checkpoint = None
+        if checkpoint is not None:
+            start_offset = checkpoint["verified"]
+            previous_ranges = checkpoint["error_ranges"]
+        previous_errors = sum(count for _, count in previous_ranges)
+
+        try:
+            engine = EraseEngine(
+                dev,
+                block_size=parse_size(options.get("block_size", "4M")),
+                queue_depth=int(options.get("queue_depth", 1)),
+                verify=verify,
+                sample_fraction=parse_fraction(options.get("sample", "1%")),
+                sample_edges=parse_size(options.get("sample_edges", "64M")),
+                patterns=patterns,
+                skip_ranges=self._get_known_bad_ranges(options, logical_sector_size(dev)),
+                pattern_seed=checkpoint.get("seed") if checkpoint is not None else None,
+            )
+        except ValueError as e:
+            self._queued_command.notify_finish_with_error(f"Invalid erase options: {str(e)}")
+            return None
+
+        def on_progress(progress: EraseProgress):
+            errors = previous_errors + progress.errors
+            self._queued_command.notify_io(progress.bytes_done, progress.bytes_total, f"{errors} errors", progress.bytes_resumed)
+
+        def on_checkpoint(verified: int, error_ranges: List[List[int]]):
+            error_ranges = previous_ranges + error_ranges
+            self._set_erase_checkpoint(size, verified, sum(count for _, count in error_ranges), error_ranges, pattern, engine.pattern_seed)
+
+        try:
+            result = engine.run(lambda: self._go, on_progress, start_offset, on_checkpoint, self._throttle)
+        except OSError as e:
+            logging.warning(f"[{self._the_id}] Native erase of {dev} failed", exc_info=e)
+            self._queued_command.notify_error()
+            return False, None, f"Erase failed: {e.strerror or str(e)}"
+
+        if not result.completed:
+            print(f"Stopped native erase {self.get_queued_command().id()}")
+            self._queued_command.notify_finish_with_error("Process terminated by user.")
+            return None
+
+        self._clear_erase_checkpoint()
+        error_ranges = merge_ranges(previous_ranges + result.error_ranges)
+        # With a sample only part of the disk was read back: add to what is known, without clearing anything
+        self._record_bad_blocks(error_ranges, engine.sector_size, 0, None if result.sample_blocks is None else 0, "native")
+        errors = sum(count for _, count in error_ranges)
+        if errors > 0:
+            logging.warning(f"[{self._the_id}] Bad sectors on {dev} (first LBA, count): {error_ranges}")
+            errors_print = str(errors)
+        else:
+            errors_print = "no"
+        if result.sample_blocks is not None:
+            errors_print += f" bad sectors in {result.sample_blocks} sampled blocks"
+        else:
+            errors_print += " bad sectors"
+        return True, errors == 0, f"Finished with {errors_print}, {format_rate(result.throughput)}"
+
+    def _get_known_bad_ranges(self, options: Dict[str, str], unit: int) -> List[List[int]]:
+        """Known bad ranges of the disk in units of unit bytes, if the skip_bad option is set"""
+        serial = self._queued_command.disk.get_serial()
+        if BAD_BLOCKS is None or not serial or options.get("skip_bad", "0") != "1":
+            return []
+        bad_map = BAD_BLOCKS.get_map(serial)
+        if bad_map is None or bad_map["size"] != self._queued_command.disk.get_size():
+            return []
+        logging.info(f"[{self._the_id}] Skipping {bad_map['bad_sectors']} known bad sectors of {self._queued_command.disk.get_path()}")
+        return convert_ranges(bad_map["ranges"], bad_map["sector_size"], unit)
+
+    def _record_bad_blocks(self, ranges: List[List[int]], unit: int, start: int, end: Optional[int], method: str):
+        """Store the bad ranges (in units of unit bytes) found between start and end, None for the end of the disk"""
+        disk = self._queued_command.disk
+        serial = disk.get_serial()
+        if BAD_BLOCKS is None or not serial or disk.get_size() <= 0:
+            return
+        sector_size = logical_sector_size(disk.get_path())
+        BAD_BLOCKS.update_map(
+            serial,
+            disk.get_size(),
+            sector_size,
+            convert_ranges(ranges, unit, sector_size),
+            start * unit // sector_size,
+            end * unit // sector_size if end is not None else None,
+            method,
+        )
+
+    def get_badblocks_map(self, cmd: str, dev: str):
+        with disks_lock:
+            disk = disks.get(dev)
+        if disk is None:
+            self.send_msg("error", {"message": f"{dev} is not a disk"})
+            return
+        serial = disk.get_serial()
+        bad_map = BAD_BLOCKS.get_map(serial) if BAD_BLOCKS is not None and serial else None
+        # ranges are [first LBA, count] in units of sector_size, None if the disk has never been erased
+        self.send_msg(cmd, {"disk": dev, "serial": serial, **(bad_map or {"ranges": None})})
+
+    def create_bmap(self, cmd: str, iso: str):
+        if not os.path.isfile(iso):
+            self.send_msg("error", {"message": f"{iso} does not exist on server"})
+            return
+        try:
+            bmap = create_bmap(iso, should_continue=lambda: self._go)
+            if bmap is None:
+                return
+            save_bmap(bmap, iso + BMAP_SUFFIX)
+        except (OSError, BmapError) as e:
+            self.send_msg("error", {"message": f"Cannot map {iso}: {str(e)}"})
+            return
+        logging.info(f"[{self._the_id}] Mapped {iso}, {bmap.mapped_bytes} of {bmap.image_size} bytes contain data")
+        self.send_msg(cmd, {"iso": iso, "size": bmap.image_size, "mapped": bmap.mapped_bytes})
+
+    def _get_erase_checkpoint(self, size: int, options: Dict[str, str], pattern: str = "0x00") -> Optional[dict]:
+        if CHECKPOINTS is None or size <= 0 or options.get("resume", "1") == "0":
+            return None
+        checkpoint = CHECKPOINTS.get_checkpoint(self._queued_command.disk.get_composite_id(), size, pattern)
+        if checkpoint is not None:
+            logging.info(f"[{self._the_id}] Resuming erase of {self._queued_command.disk.get_path()} from byte {checkpoint['verified']}")
+        return checkpoint
+
+    def _set_erase_checkpoint(
+        self, size: int, verified: int, errors: int, error_ranges: Optional[list] = None, pattern: str = "0x00", seed: Optional[int] = None
+    ):
+        if CHECKPOINTS is not None:
+            CHECKPOINTS.set_checkpoint(self._queued_command.disk.get_composite_id(), size, pattern, verified, errors, error_ranges, seed)
+
+    def _clear_erase_checkpoint(self):
+        if CHECKPOINTS is not None:
+            CHECKPOINTS.clear_checkpoint(self._queued_command.disk.get_composite_id())
+
     def ping(self, _cmd: str, _nothing: str):
         self.send_msg("pong", None)
 
@@ -593,6 +1003,77 @@ class CommandRunner(threading.Thread):
         # noinspection PyUnresolvedReferences
         reactor.callFromThread(reactor.callLater, CLOSE_AT_END_TIMER, try_stop_at_end)
 
+    def _grow_filesystem(self, dev: str, part_path: str, part_number: str) -> bool:
+        """growpart, e2fsck and resize2fs with their progress, raises an exception if any of them fails or the job is stopped"""
+        if not stat.S_ISBLK(os.stat(dev).st_mode):
+            raise Exception(f"{dev} is not a block device")
+        self._queued_command.notify_start("Growing partition")
+        durations = {}
+
+        growpart = GrowpartParser()
+        exitcode = self._run_step(durations, "growpart", ("sudo", "-n", "growpart", dev, str(part_number)), growpart, 0.0, 5.0)
+        if exitcode is None:
+            raise Exception("Process terminated by user.")
+        if growpart.nochange:
+            # The image already fills the disk, so does the filesystem
+            logging.info(f"[{self._the_id}] {part_path} already fills {dev}, skipping e2fsck and resize2fs")
+            self._log_step_durations(durations)
+            return True
+        if exitcode != 0:
+            raise Exception("growpart failed")
+
+        # -C 1 prints the progress on stdout
+        exitcode = self._run_step(durations, "e2fsck", ("sudo", "-n", "e2fsck", "-fy", "-C", "1", part_path), E2fsckProgressParser(), 5.0, 80.0)
+        if exitcode is None:
+            raise Exception("Process terminated by user.")
+        # 1 means errors corrected
+        if exitcode not in (0, 1):
+            raise Exception("e2fsck failed")
+
+        exitcode = self._run_step(durations, "resize2fs", ("sudo", "-n", "resize2fs", "-p", part_path), Resize2fsProgressParser(), 80.0, 100.0)
+        if exitcode is None:
+            raise Exception("Process terminated by user.")
+        if exitcode != 0:
+            raise Exception("resize2fs failed")
+        self._log_step_durations(durations)
+        return True
+
+    def _run_step(self, durations: Dict[str, float], name: str, command: tuple, parser: ProgressParser, start: float, end: float) -> Optional[int]:
+        """Run a step of a job with its progress between start and end percent, None if stopped"""
+        custom_env = os.environ.copy()
+        custom_env["LC_ALL"] = "C"
+        logging.debug(f"[{self._the_id}] Running command {' '.join(command)}")
+        began = time.monotonic()
+        pipe = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=custom_env)
+        self._queued_command.notify_percentage(start, f"Running {name}")
+        for progress in ProgressReader(pipe.stdout, parser):
+            if not self._go:
+                # Not kill: sudo passes SIGTERM on, and e2fsck and resize2fs stop cleanly on it
+                pipe.terminate()
+                pipe.wait()
+                return None
+            if progress is not None:
+                self._queued_command.notify_percentage(start + (end - start) * progress.percent / 100, progress.text)
+        exitcode = pipe.wait()
+        durations[name] = time.monotonic() - began
+        if exitcode != 0:
+            logging.warning(f"[{self._the_id}] {name} exited with code {exitcode}")
+        return exitcode
+
+    def _log_step_durations(self, durations: Dict[str, float]):
+        logging.info(f"[{self._the_id}] Grown in {', '.join(f'{name} {duration:.1f} s' for name, duration in durations.items())}")
+
+    def _get_partition_to_grow(self, dev: str, iso: str) -> tuple[str, str] | tuple[None, None]:
+        entry = IMAGES.entry(iso) if IMAGES is not None else None
+        number = entry.get("grow_partition") if entry is not None else None
+        if number is not None and (reread_partition_table(dev) or run_command_on_partition(dev, f"sudo blockdev --rereadpt {dev}")):
+            # Known from the catalog, and the kernel has created the partitions already: no need to wait for udev
+            part_path = partition_path(dev, number)
+            if os.path.exists(part_path):
+                return part_path, str(number)
+        subprocess.run("udevadm settle", shell=True)
+        return self._get_last_linux_partition_path_and_number(dev)
+
     @staticmethod
     def _get_last_linux_partition_path_and_number(dev: str) -> tuple[str, str] | tuple[None, None]:
         # Use PTTYPE to get MBR/GPT (dos/gpt are the possible values)
@@ -617,7 +1098,8 @@ class CommandRunner(threading.Thread):
                     last_linux_entry = entry["path"], (entry["partn"] if "partn" in entry else i)
         return last_linux_entry
 
-    def cannolo(self, _cmd: str, dev_and_iso: str):
+    def cannolo(self, _cmd: str, args: str):
+        dev_and_iso, options = self.split_options(args)
         parts: list[Optional[str]] = dev_and_iso.split(" ", 1)
         while len(parts) < 2:
             parts.append(None)
@@ -634,10 +1116,24 @@ class CommandRunner(threading.Thread):
             self._queued_command.notify_finish_with_error(f"{iso} is not a file (is it a directory?)")
             return
 
+        if not self._set_job_rate(options):
+            return
+
         go_ahead = self._unswap()
         if not go_ahead:
             return
 
+        # Block maps describe the uncompressed image, compressed ones are streamed from start to end anyway
+        bmap = self._find_bmap(iso) if options.get("bmap", "1") == "1" and compression_of(iso) is None else None
+        try:
+            fanout = int(options.get("fanout", "0"))
+        except ValueError:
+            self._queued_command.notify_finish_with_error(f"Invalid fanout {options['fanout']}")
+            return
+        # The targets of a fanout move the data of a single job, they count as one on their bus
+        if not self._acquire_bus(f"fanout {fanout} {iso}" if fanout > 1 and bmap is None else None):
+            return
+
         self._queued_command.notify_start("Cannoling")
 
         if TEST_MODE:
@@ -646,24 +1142,29 @@ class CommandRunner(threading.Thread):
                 threading.Event().wait(1)
             success = True
         else:
+            success = False
             try:
-                success = self.dd(iso, dev)
+                zeroes = options.get("zeroes", "auto")
+                if zeroes == "auto":
+                    zeroes = self._zeroes_mode(dev)
+                self._queued_command.disk.set_zeroed(False)
+                success = self.dd(
+                    iso,
+                    dev,
+                    parse_size(options.get("block_size", "8M")),
+                    options.get("copy", COPY_AUTO),
+                    zeroes,
+                    bmap,
+                    options.get("verify", "0") == "1",
+                    fanout,
+                )
                 if not success:
                     raise Exception("DD operation failed")
-                subprocess.run("udevadm settle", shell=True)
-                part_path, part_number = self._get_last_linux_partition_path_and_number(dev)
+                part_path, part_number = self._get_partition_to_grow(dev, iso)
                 if part_number is None:
                     success = False
                     raise Exception("Partition to be resized not found")
-                success = run_command_on_partition(dev, f"sudo growpart {dev} {part_number}")
-                if not success:
-                    raise Exception("growpart failed")
-                success = run_command_on_partition(dev, f"sudo e2fsck -fy {part_path}")
-                if not success:
-                    raise Exception("e2fsck failed")
-                success = run_command_on_partition(dev, f"sudo resize2fs {part_path}")
-                if not success:
-                    raise Exception("resize2fs failed")
+                success = self._grow_filesystem(dev, part_path, part_number)
             except Exception as e:
                 self._queued_command.notify_error(str(e))
 
@@ -759,6 +1260,74 @@ class CommandRunner(threading.Thread):
             self._queued_command.disk.update_mountpoints()
         return True
 
+    def _acquire_bus(self, share: Optional[str] = None) -> bool:
+        """Wait until there are not too many heavy I/O jobs on the same bus. Released when the command ends."""
+        group = self._queued_command.disk.get_bus_group()
+        if BUS_SCHEDULER.is_full(group):
+            self._queued_command.notify_start("Waiting for other jobs on the same bus")
+        if not BUS_SCHEDULER.acquire(group, lambda: self._go, share=share):
+            self._queued_command.notify_finish_with_error("Process terminated by user.")
+            return False
+        self._bus_group = group
+        self._bus_share = share
+        return True
+
+    def _release_bus(self):
+        if self._bus_group is not None:
+            BUS_SCHEDULER.release(self._bus_group, self._bus_share)
+            self._bus_group = None
+
+    def get_bus_groups(self, cmd: str, _nothing: str):
+        groups = {}
+        with disks_lock:
+            for path in disks:
+                group = disks[path].get_bus_group()
+                if group not in groups:
+                    groups[group] = {"disks": [], "running": BUS_SCHEDULER.running(group), "max_jobs": BUS_SCHEDULER.max_jobs}
+                groups[group]["disks"].append(path)
+        self.send_msg(cmd, groups)
+
+    def get_code_cache(self, cmd: str, _nothing: str):
+        self.send_msg(cmd, CODE_CACHE.stats() if CODE_CACHE is not None else None)
+
+    def _set_job_rate(self, options: Dict[str, str]) -> bool:
+        if "rate" not in options:
+            return True
+        rate = parse_rate(options["rate"])
+        if rate is None:
+            self._queued_command.notify_finish_with_error(f"Invalid rate limit {options['rate']}, it should be in MB/s")
+            return False
+        self._queued_command.set_rate_limit(rate)
+        return True
+
+    def _is_throttled(self) -> bool:
+        return self._queued_command.rate_limiter.rate > 0 or RATE_LIMITER.rate > 0
+
+    def _throttle(self, amount: int) -> bool:
+        """Wait until amount bytes can be moved without going over the job and server rate limits"""
+        should_continue = lambda: self._go
+        return self._queued_command.rate_limiter.consume(amount, should_continue) and RATE_LIMITER.consume(amount, should_continue)
+
+    def set_rate_limit(self, cmd: str, args: str):
+        # "50" for the whole server, "50 <queue id>" for a single job, 0 removes the limit
+        parts = args.split(" ", 1)
+        rate = parse_rate(parts[0])
+        if rate is None:
+            self.send_msg("error", {"message": f"Invalid rate limit {parts[0]}, it should be in MB/s"})
+            return
+        if len(parts) < 2:
+            RATE_LIMITER.set_rate(rate)
+            logging.info(f"[{self._the_id}] Server rate limit set to {format_rate(rate) if rate > 0 else 'unlimited'}")
+            self.send_msg(cmd, {"id": None, "rate_limit": rate / 1000 / 1000})
+            return
+        with queued_commands_lock:
+            queued_command = next((the_cmd for the_cmd in queued_commands if the_cmd.id_is(parts[1])), None)
+        if queued_command is None:
+            self.send_msg("error", {"message": f"No job with ID {parts[1]}"})
+            return
+        queued_command.set_rate_limit(rate)
+        self.send_msg(cmd, {"id": parts[1], "rate_limit": rate / 1000 / 1000})
+
     def sleep(self, _cmd: str, dev: str):
         self._queued_command.notify_start("Calling hdparm")
         exitcode = self._call_hdparm_for_sleep(dev)
@@ -947,20 +1516,30 @@ class CommandRunner(threading.Thread):
                 self._queued_command.notify_finish_with_error("Upload failed due to authorization error: " + str(e))
             return
 
-        with disks_lock:
-            if code:
-                disk_ref.set_code(code)
+        serial = disk_ref.get_serial()
+        if serial and CODE_CACHE is not None:
+            # It was probably cached as not found
+            CODE_CACHE.invalidate(serial)
+        before = current_disk_version()
+        if code:
+            disk_ref.set_code(code)
+            if serial and CODE_CACHE is not None:
+                # A lookup that was running when the disk was uploaded may have cached it as not found again
+                CODE_CACHE.remember(serial, code)
 
-            try:
-                disk_ref.update_from_tarallo_if_needed()
-            except ErrorThatCanBeManuallyFixed as e:
-                if queued:
-                    self.send_msg(
-                        "error_that_can_be_manually_fixed",
-                        {"message": str(e), "disk": dev},
-                    )
-                    self._queued_command.notify_finish_with_error("Upload succeeded, but an error was reported")
-                return
+        try:
+            # Without disks_lock, Tarallo may take a while to answer. Not from the cache, for the same reason.
+            disk_ref.update_from_tarallo_if_needed(cached=False)
+        except ErrorThatCanBeManuallyFixed as e:
+            if queued:
+                self.send_msg(
+                    "error_that_can_be_manually_fixed",
+                    {"message": str(e), "disk": dev},
+                )
+                self._queued_command.notify_finish_with_error("Upload succeeded, but an error was reported")
+            return
+        finally:
+            send_disks_delta(before)
 
         logging.info(f"[{self._the_id}] created {disk_ref.get_path()} on tarallo as {code if code else 'unknown code'}")
         if queued:
@@ -993,11 +1572,28 @@ class CommandRunner(threading.Thread):
             except Exception:
                 logging.warning(f"[{the_id}] Something blew up while trying to send {cmd} (connection already closed?)")
 
-    def get_disks(self, cmd: str, _nothing: str):
+    def send_code_error(self, path: str, error: Exception):
+        self.send_msg("error_that_can_be_manually_fixed", {"message": str(error), "disk": path})
+
+    def get_disks(self, cmd: str, args: str):
+        # "since=<version> epoch=<epoch>" to get only what changed after that, as a disks_delta
+        options = dict(word.split("=", 1) for word in args.split(" ") if OPTION_REGEX.fullmatch(word))
+        since = None
+        if "since" in options:
+            try:
+                since = int(options["since"])
+            except ValueError:
+                self.send_msg("error", {"message": f"Invalid version {options['since']}", "command": cmd})
+                return
         result = []
         with disks_lock:
-            # Sent regardless
-            update_disks_if_needed(self, False)
+            # Sent regardless. With uevents the list is already up to date.
+            if not disk_monitor_running():
+                update_disks_if_needed(self, False)
+            # A version from before a restart of the server means nothing, send everything again
+            if since is not None and options.get("epoch") == DISKS_EPOCH:
+                self.send_msg("disks_delta", disks_since(since))
+                return
             for disk in disks:
                 result.append(disks[disk].serialize_disk())
         self.send_msg(cmd, result)
@@ -1009,40 +1605,85 @@ class CommandRunner(threading.Thread):
         filename = filename.replace("-", " ").replace("_", " ")
         return filename
 
-    def dd(self, inputf: str, outputf: str, bs: int = 4096, output_delay: float = 1.0):
-        if os.path.exists(inputf):
-            try:
-                with open(inputf, "rb") as fin:
-                    print("Input file opened successfully!")
-                    with open(outputf, "wb") as fout:
-                        print("Output file opened successfully!")
-                        s = os.stat(inputf).st_mode
-                        is_special = stat.S_ISBLK(s) or stat.S_ISCHR(s)
-                        total_size = get_block_size(outputf) if is_special else os.path.getsize(inputf)
-                        completed_size = 0
-                        elapsed_time = 0
-                        actual_time = time.time()
-                        while True:
-                            # capture asap stop request from client
-                            if not self._go:
-                                return False
-                            if fout.write(fin.read(bs)) == 0:
-                                fout.flush()
-                                return True
-                            completed_size += bs
-                            if elapsed_time > output_delay:
-                                percentage = (completed_size / total_size) * 100
-                                self._queued_command.notify_percentage(percentage)
-                                elapsed_time = 0
-                            else:
-                                elapsed_time += time.time() - actual_time
-                                actual_time = time.time()
-            except KeyboardInterrupt:
-                print("\nInterrupted!")
-                os.system("sync")
-                return False
+    def _zeroes_mode(self, dev: str) -> str:
+        """How to handle holes and zeroes in the image for this disk"""
+        if self._queued_command.disk.is_zeroed():
+            return ZEROES_SKIP
+        if supports_write_zeroes(dev):
+            return ZEROES_ZEROOUT
+        return ZEROES_WRITE
+
+    def _find_bmap(self, iso: str) -> Optional[BlockMap]:
+        path = find_bmap(iso)
+        if path is None:
+            return None
+        try:
+            bmap = load_bmap(path)
+        except (OSError, BmapError) as e:
+            logging.warning(f"[{self._the_id}] Ignoring block map {path}: {str(e)}")
+            return None
+        if not bmap.matches(iso):
+            logging.warning(f"[{self._the_id}] Ignoring block map {path}, the image has changed")
+            return None
+        return bmap
+
+    def dd(
+        self,
+        inputf: str,
+        outputf: str,
+        block_size: int = 8 * 1024 * 1024,
+        method: str = COPY_AUTO,
+        zeroes: str = ZEROES_WRITE,
+        bmap: Optional[BlockMap] = None,
+        verify: bool = False,
+        fanout: int = 0,
+    ) -> bool:
+        if not os.path.exists(inputf):
+            return False
+        stream = None
+        if fanout > 1 and bmap is None:
+            # Read once for all the targets that join within FANOUT.gather_timeout
+            stream = FANOUT.join(inputf, block_size, fanout)
+
+        def on_progress(progress: ImageProgress):
+            self._queued_command.notify_io(progress.bytes_done, progress.bytes_total)
+
+        try:
+            # Hashed while writing, so verifying reads the disk and not the image again
+            checksum = VERIFY_CHECKSUM if verify and bmap is None else None
+            writer = ImageWriter(inputf, outputf, block_size, method=method, zeroes=zeroes, bmap=bmap, stream=stream, checksum=checksum)
+            result = writer.run(lambda: self._go, on_progress, self._throttle)
+        except OSError as e:
+            logging.warning(f"[{self._the_id}] Copying {inputf} to {outputf} failed", exc_info=e)
+            return False
+        finally:
+            if stream is not None:
+                # Or the other targets would wait for this one forever
+                stream.close()
+        if result.completed:
+            logging.info(
+                f"[{self._the_id}] Copied {inputf} to {outputf} with {result.method} at {format_rate(result.throughput)}, "
+                f"{result.bytes_written} of {result.size} bytes written"
+            )
+        if not result.completed or not verify:
+            return result.completed
+
+        self._queued_command.notify_start("Verifying")
+        if bmap is not None:
+            ranges, new_hash = bmap.byte_ranges(), bmap.new_hash
         else:
+            ranges, new_hash = [(0, result.size, result.digest)], lambda: hashlib.new(VERIFY_CHECKSUM)
+        try:
+            mismatches = writer.verify(ranges, new_hash, lambda: self._go, on_progress)
+        except OSError as e:
+            raise ImageError(f"Cannot read {outputf} back: {str(e)}")
+        if mismatches is None:
             return False
+        if len(mismatches) > 0:
+            logging.warning(f"[{self._the_id}] Ranges of {outputf} that differ from {inputf} (offset, length): {mismatches}")
+            raise ImageError(f"Verification failed, {len(mismatches)} ranges differ from the image")
+        logging.info(f"[{self._the_id}] Verified {outputf} against {inputf}")
+        return True
 
     def stop_process(self, cmd: str, args: str):
         logging.debug(f"Received stop request for {args}")
@@ -1070,6 +1711,78 @@ class CommandRunner(threading.Thread):
         return exitcode
 
 
+class IoMetrics:
+    """Bytes moved by a job and how fast, for clients and monitoring."""
+
+    # Seconds of history for the current throughput
+    WINDOW = 5.0
+
+    def __init__(self):
+        self.bytes_done = None
+        self.bytes_total = None
+        self._bytes_resumed = 0
+        self._start = time.monotonic()
+        self._end = None
+        self._samples = deque()
+
+    def restart(self):
+        self.bytes_done = None
+        self.bytes_total = None
+        self._bytes_resumed = 0
+        self._start = time.monotonic()
+        self._end = None
+        self._samples.clear()
+
+    def stop(self):
+        if self._end is None:
+            self._end = time.monotonic()
+
+    def update(self, bytes_done: int, bytes_total: int, bytes_resumed: int = 0, now: Optional[float] = None):
+        now = now if now is not None else time.monotonic()
+        if self.bytes_done is None:
+            # Anything done in a previous run does not count for the throughput
+            self._bytes_resumed = bytes_resumed
+            self._samples.append((self._start, bytes_resumed))
+        self.bytes_done = bytes_done
+        self.bytes_total = bytes_total
+        self._samples.append((now, bytes_done))
+        while len(self._samples) > 2 and now - self._samples[1][0] >= self.WINDOW:
+            self._samples.popleft()
+
+    def elapsed(self, now: Optional[float] = None) -> float:
+        if self._end is not None:
+            return self._end - self._start
+        return (now if now is not None else time.monotonic()) - self._start
+
+    def throughput(self) -> Optional[float]:
+        """Bytes per second over the last few seconds"""
+        if self._end is not None or len(self._samples) < 2:
+            return None
+        (t0, b0), (t1, b1) = self._samples[0], self._samples[-1]
+        if t1 <= t0:
+            return None
+        return (b1 - b0) / (t1 - t0)
+
+    def average_throughput(self, now: Optional[float] = None) -> Optional[float]:
+        if self.bytes_done is None:
+            return None
+        elapsed = self.elapsed(now)
+        if elapsed <= 0:
+            return None
+        return (self.bytes_done - self._bytes_resumed) / elapsed
+
+    def serialize(self) -> dict:
+        if self.bytes_done is None:
+            return {"bytes_done": None, "bytes_total": None, "throughput": None, "avg_throughput": None, "elapsed": None}
+        return {
+            "bytes_done": self.bytes_done,
+            "bytes_total": self.bytes_total,
+            "throughput": self.throughput(),
+            "avg_throughput": self.average_throughput(),
+            "elapsed": self.elapsed(),
+        }
+
+
 class QueuedCommand:
     def __init__(self, disk: Disk, command_runner: CommandRunner):
         self.disk = disk
@@ -1085,6 +1798,8 @@ class QueuedCommand:
         self._text = "Queued"
         self._to_delete = False
         self._deleted = False
+        self._io = IoMetrics()
+        self.rate_limiter = RateLimiter()
         date = datetime.today().strftime("%Y%m%d%H%M")
         with queued_commands_lock:
             self._id = f"{date}-{str(len(queued_commands))}"
@@ -1110,6 +1825,7 @@ class QueuedCommand:
                 self._text = text
             self._started = True
             self._percentage = 0.0
+            self._io.restart()
             self.send_to_all_clients()
 
     def notify_finish_safe(self, text: Optional[str] = None):
@@ -1125,6 +1841,7 @@ class QueuedCommand:
                 self._text = text
             self._finished = True
             self._percentage = 100.0
+            self._io.stop()
             self.send_to_all_clients()
 
             if self._to_delete:
@@ -1137,6 +1854,7 @@ class QueuedCommand:
             self._finished = True
             self._error = True
             self._percentage = 100.0
+            self._io.stop()
             self.send_to_all_clients()
 
             if self._to_delete:
@@ -1163,6 +1881,23 @@ class QueuedCommand:
             self._percentage = percent
             self.send_to_all_clients(doLog=False)
 
+    def notify_io(self, bytes_done: int, bytes_total: int, text: Optional[str] = None, bytes_resumed: int = 0):
+        with self._notifications_lock:
+            if text is not None:
+                self._text = text
+            self._io.update(bytes_done, bytes_total, bytes_resumed)
+            if bytes_total > 0:
+                self._percentage = bytes_done / bytes_total * 100
+            self.send_to_all_clients(doLog=False)
+
+    def get_io_metrics(self) -> IoMetrics:
+        return self._io
+
+    def set_rate_limit(self, rate: float):
+        with self._notifications_lock:
+            self.rate_limiter.set_rate(rate)
+            self.send_to_all_clients()
+
     def delete_when_done(self):
         self._to_delete = True
         # Locking is pointless, notify_delete must be called after releasing the lock anyway
@@ -1217,6 +1952,10 @@ class QueuedCommand:
             "error": self._error,
             "stale": self._stale,
             "stopped": self._stopped,
+            # bytes_done, bytes_total, throughput, avg_throughput and elapsed, None if the job does no I/O
+            **self._io.serialize(),
+            # MB/s, None if unlimited
+            "rate_limit": self.rate_limiter.rate / 1000 / 1000 if self.rate_limiter.rate > 0 else None,
         }
 
 
@@ -1285,7 +2024,17 @@ class TurboProtocol(LineOnlyReceiver):
 
 
 def update_disks_if_needed(this_thread: Optional[CommandRunner], send: bool = True):  # , disk: Optional[str] = None):
+    if disk_monitor_running():
+        # Added, changed and removed disks come from uevents, only Tarallo codes may be missing
+        update_disks_from_tarallo(this_thread)
+        return
+    rescan_disks(this_thread, send)
+
+
+def rescan_disks(this_thread: Optional[CommandRunner] = None, send: bool = True):
+    """Compare every disk with what is in the system, and tell clients what changed"""
     with disks_lock:
+        before = current_disk_version()
         disks_lsblk = get_disks()
         found_disks = set()
 
@@ -1302,19 +2051,11 @@ def update_disks_if_needed(this_thread: Optional[CommandRunner], send: bool = Tr
             add = False
             if path in disks:
                 if disks[path].compare_composite_id(lsblk):
-                    try:
-                        more_changes = disks[path].update_from_tarallo_if_needed()
-                        changes = changes or more_changes
-                    except ErrorThatCanBeManuallyFixed as e:
-                        if this_thread:
-                            this_thread.send_msg(
-                                "error_that_can_be_manually_fixed",
-                                {"message": str(e), "disk": path},
-                            )
-
+                    # Clients get the code with a disks_delta, when Tarallo answers
+                    disks[path].resolve_code(this_thread.send_code_error if this_thread else None)
                 else:
                     logging.info(f"Disk {path} has changed")
-                    del disks[path]
+                    forget_disk(path)
                     add = True
             else:
                 logging.info(f"Disk {path} is new")
@@ -1338,15 +2079,103 @@ def update_disks_if_needed(this_thread: Optional[CommandRunner], send: bool = Tr
                 to_delete.append(path)
 
         for path in to_delete:
-            del disks[path]
+            forget_disk(path)
             changes = True
 
-        if send and changes and this_thread:
-            result = []
-            with disks_lock:
-                for disk in disks:
-                    result.append(disks[disk].serialize_disk())
-            this_thread.send_msg("get_disks", result)
+        if send and changes:
+            send_disks_delta(before)
+
+
+def update_disks_from_tarallo(this_thread: Optional[CommandRunner]):
+    with disks_lock:
+        for disk in disks.values():
+            disk.resolve_code(this_thread.send_code_error if this_thread else None)
+
+
+def handle_disk_event(action: str, path: str):
+    """Update a single disk from a uevent and tell clients, instead of scanning all of them again"""
+    found = []
+    if action != "remove":
+        found = [lsblk for lsblk in get_disks(path) if str(lsblk.get("path")) == path]
+    before = current_disk_version()
+    with disks_lock:
+        if path in disks and (len(found) == 0 or not disks[path].compare_composite_id(found[0])):
+            logging.info(f"Disk {path} is gone")
+            forget_disk(path)
+        if len(found) > 0 and path not in disks:
+            logging.info(f"Disk {path} is new")
+            # noinspection PyBroadException
+            try:
+                disks[path] = Disk(found[0], TARALLO)
+            except Exception as e:
+                logging.warning(f"Exception while adding disk {path}, skipping", exc_info=e)
+        elif len(found) > 0:
+            # Same disk, but partitions, mounts or size may be different
+            disks[path].update_lsblk(found[0])
+    send_disks_delta(before)
+
+
+def next_disk_version() -> int:
+    global disks_version
+    with disks_version_lock:
+        disks_version += 1
+        return disks_version
+
+
+def current_disk_version() -> int:
+    with disks_version_lock:
+        return disks_version
+
+
+def forget_disk(path: str):
+    """Remove a disk, remembering when for clients that ask what changed since then. Hold disks_lock."""
+    del disks[path]
+    removed_disks[path] = next_disk_version()
+
+
+def disks_since(since: int) -> dict:
+    """Disks added, changed and removed (by path) after a version, and the version they bring a client to.
+
+    A path can be both removed and added, when another disk took its place: removals go first.
+    """
+    with disks_lock:
+        version = current_disk_version()
+        added = []
+        changed = []
+        for disk in disks.values():
+            if disk.get_created_version() > since:
+                added.append(disk.serialize_disk())
+            elif disk.get_version() > since:
+                changed.append(disk.serialize_disk())
+        removed = [path for path, removed_version in removed_disks.items() if removed_version > since]
+    return {"epoch": DISKS_EPOCH, "since": since, "version": version, "added": added, "changed": changed, "removed": removed}
+
+
+def send_disks_delta(since: int):
+    # To every client: one that sees a since newer than its version asks for what it missed
+    delta = disks_since(since)
+    if len(delta["added"]) == 0 and len(delta["changed"]) == 0 and len(delta["removed"]) == 0:
+        return
+    response = f"disks_delta {CommandRunner._encode_param(delta)}"
+    with clients_lock:
+        for client in clients.values():
+            # noinspection PyUnresolvedReferences
+            reactor.callFromThread(TurboProtocol.send_msg, client, response)
+
+
+def start_disk_monitor():
+    global DISK_MONITOR
+    try:
+        # Uevents that were lost may have been disks coming and going
+        DISK_MONITOR = UeventMonitor(handle_disk_event, on_resync=rescan_disks)
+    except OSError as e:
+        logging.warning("Cannot listen to uevents, disks will be scanned again after every job", exc_info=e)
+        return
+    DISK_MONITOR.start()
+
+
+def disk_monitor_running() -> bool:
+    return DISK_MONITOR is not None and DISK_MONITOR.is_alive()
 
 
 def scan_for_disks():
@@ -1385,6 +2214,7 @@ def find_thread_from_pid(pinolo_pid: str) -> CommandRunner:
 
 def main():
     scan_for_disks()
+    start_disk_monitor()
     ip = os.getenv("IP")
     port = os.getenv("PORT")
     global TEST_MODE
@@ -1442,6 +2272,21 @@ def load_settings():
         global TARALLO
         TARALLO = Tarallo.Tarallo(url, token)
 
+    BUS_SCHEDULER.max_jobs = int(os.getenv("MAX_JOBS_PER_BUS", BUS_SCHEDULER.max_jobs))
+    RATE_LIMITER.set_rate(parse_rate(os.getenv("MAX_RATE", "0")) or 0)
+    CODE_RESOLVER.workers = int(os.getenv("TARALLO_WORKERS", CODE_RESOLVER.workers))
+
+    global STATE_DIR, CHECKPOINTS, BAD_BLOCKS, IMAGES, CODE_CACHE
+    STATE_DIR = os.path.expanduser(os.getenv("STATE_DIR", f"~/.local/state/{NAME}"))
+    CHECKPOINTS = CheckpointStore(os.path.join(STATE_DIR, "checkpoints.json"))
+    BAD_BLOCKS = BadBlockStore(os.path.join(STATE_DIR, "badblocks.json"))
+    IMAGES = ImageCatalog(os.path.join(STATE_DIR, "images.json"))
+    CODE_CACHE = CodeCache(
+        os.path.join(STATE_DIR, "codes.json"),
+        float(os.getenv("TARALLO_CACHE_TTL", 7 * 24 * 3600)),
+        float(os.getenv("TARALLO_NOT_FOUND_TTL", 3600)),
+    )
+
 
 def get_smartctl_status(smartctl_output: str) -> Optional[str]:
     # noinspection PyBroadException
@@ -1455,45 +2300,9 @@ def get_smartctl_status(smartctl_output: str) -> Optional[str]:
         return None
 
 
-def find_mounts(el: dict):
-    mounts = {}
-    if el["mountpoint"] is not None:
-        mounts[el["path"]] = el["mountpoint"]
-    if "children" in el:
-        children = el["children"]
-        for child in children:
-            children_mounts = find_mounts(child)
-            mounts = {**mounts, **children_mounts}
-    return mounts
-
-
 def get_disks_linux(path: Optional[str] = None) -> list:
-    # Name is required, otherwise the tree is flattened
-    # To filter out loop devices, ODDs, tape drives and network devices: --exclude 7,9,11,43
-    # See: https://www.kernel.org/doc/Documentation/admin-guide/devices.txt
-    # Also: https://unix.stackexchange.com/a/610634
-    output = subprocess.getoutput(f"lsblk --exclude 7,9,11,43 -b -o NAME,PATH,VENDOR,MODEL,SERIAL,HOTPLUG,ROTA,MOUNTPOINT,SIZE -J {path if path else ''}")
-    jsonized = json.loads(output)
-    if "blockdevices" in jsonized:
-        result = jsonized["blockdevices"]
-    else:
-        result = []
-    for el in result:
-        # Skip empty disks (empty SD card reader)
-        if el["size"] == 0:
-            continue
-
-        mounts = find_mounts(el)
-        if "children" in el:
-            del el["children"]
-        if "name" in el:
-            del el["name"]
-        # List of partition names (/dev/sda1) to filesystem directories
-        el["mountpoint_map"] = mounts
-        # List of filesystem directories
-        el["mountpoint"] = list(mounts.values())
-
-    return result
+    # Straight from sysfs and /proc, a few file reads instead of running lsblk
+    return BLOCK_DEVICES.scan(path)
 
 
 def try_stop_at_end():
@@ -1517,10 +2326,15 @@ def try_stop_at_end():
         reactor.callLater(CLOSE_AT_END_TIMER, try_stop_at_end)
 
 
-def get_block_size(path):
-    """Return device size in bytes."""
-    with open(path, "rb") as f:
-        return f.seek(0, 2) or f.tell()
+def parse_rate(rate: str) -> Optional[float]:
+    """MB/s from a client or the config to bytes per second, None if invalid"""
+    try:
+        mbps = float(rate)
+    except ValueError:
+        return None
+    if mbps < 0 or mbps != mbps:
+        return None
+    return mbps * 1000 * 1000
 
 
 def run_command_on_partition(dev: str, cmd: str) -> bool:
@@ -1556,6 +2370,25 @@ def user_groups_checks():
 
 
 TARALLO = None
+STATE_DIR = None
+CHECKPOINTS: Optional[CheckpointStore] = None
+BAD_BLOCKS: Optional[BadBlockStore] = None
+IMAGES: Optional[ImageCatalog] = None
+# Tarallo code of each serial number, including the ones that are not there
+CODE_CACHE: Optional[CodeCache] = None
+BLOCK_DEVICES = BlockDeviceScanner()
+# Keeps disks current from udev events, if it could be started
+DISK_MONITOR: Optional[UeventMonitor] = None
+# Concurrent erase and cannolo jobs behind the same USB hub, port multiplier or SAS expander
+BUS_SCHEDULER = BusScheduler(2)
+# Bytes per second for all the erase and cannolo jobs together, 0 is unlimited
+RATE_LIMITER = RateLimiter()
+# Tarallo lookups of disk codes, off the threads that scan disks and run commands
+CODE_RESOLVER = CodeResolver()
+# Hash computed while writing images and compared when reading them back, with verify=1
+VERIFY_CHECKSUM = "blake2b"
+# cannolo jobs with fanout=N share a single read of the image
+FANOUT = FanoutRegistry()
 CLOSE_AT_END = False
 CLOSE_AT_END_LOCK = threading.Lock()
 CLOSE_AT_END_TIMER = 5
@@ -1567,6 +2400,12 @@ clients_lock = threading.Lock()
 
 disks: Dict[str, Disk] = {}
 disks_lock = threading.RLock()
+# Latest version of any disk, and the version each path was removed at. Versions start over at each
+# run of the server, which has a different epoch.
+DISKS_EPOCH = os.urandom(8).hex()
+disks_version = 0
+disks_version_lock = threading.Lock()
+removed_disks: Dict[str, int] = {}
 
 running_commands: Set[CommandRunner] = set()
 running_commands_lock = threading.Lock()
@@ -0,0 +1,195 @@
+import os
+import re
+from typing import Dict, List, Optional
+
+# Same as lsblk --exclude 7,9,11,43: loop devices, md, optical drives and nbd
+EXCLUDED_MAJORS = {7, 9, 11, 43}
+_ESCAPE = re.compile(r"\\([0-7]{3})")
+_UDEV_ESCAPE = re.compile(r"\\x([0-9a-fA-F]{2})")
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path, "r", errors="replace") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _read_int(path: str) -> Optional[int]:
+    value = _read(path)
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _unescape(field: str) -> str:
+    # Spaces and such are octal escapes, e.g. \040
+    return _ESCAPE.sub(lambda match: chr(int(match.group(1), 8)), field)
+
+
+def read_mounts(proc_root: str = "/proc") -> Dict[str, str]:
+    """Where each device is mounted, by "major:minor" and by device name. Swap is "[SWAP]" like lsblk says.
+
+    btrfs and others have an anonymous major:minor (0:NN), so like libmount the source device after
+    the filesystem type is used too.
+    """
+    mounts = {}
+    try:
+        with open(os.path.join(proc_root, "self", "mountinfo"), "r") as f:
+            for line in f:
+                fields = line.split(" ")
+                if len(fields) <= 4:
+                    continue
+                mountpoint = _unescape(fields[4])
+                if fields[2] not in mounts:
+                    mounts[fields[2]] = mountpoint
+                # Optional fields, then " - fstype source options"
+                _, separator, rest = line.rstrip("\n").partition(" - ")
+                after = rest.split(" ")
+                if separator and len(after) > 1 and after[1].startswith("/"):
+                    name = os.path.basename(os.path.realpath(_unescape(after[1])))
+                    if name not in mounts:
+                        mounts[name] = mountpoint
+    except OSError:
+        pass
+    try:
+        with open(os.path.join(proc_root, "swaps"), "r") as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                if len(fields) > 0:
+                    mounts[os.path.basename(os.path.realpath(fields[0]))] = "[SWAP]"
+    except OSError:
+        pass
+    return mounts
+
+
+def read_udev_properties(udev_root: str, dev: str) -> Dict[str, str]:
+    """What udev knows about a device (ID_SERIAL_SHORT, ID_MODEL...) from its database"""
+    properties = {}
+    try:
+        with open(os.path.join(udev_root, f"b{dev}"), "r", errors="replace") as f:
+            for line in f:
+                if line.startswith("E:"):
+                    key, _, value = line[2:].rstrip("\n").partition("=")
+                    properties[key] = value
+    except OSError:
+        pass
+    return properties
+
+
+def _udev_decode(value: str) -> str:
+    # ID_MODEL_ENC has spaces as \x20
+    return _UDEV_ESCAPE.sub(lambda match: chr(int(match.group(1), 16)), value).strip()
+
+
+class BlockDeviceScanner:
+    """List disks like lsblk does, reading sysfs, /proc and the udev database instead of running it.
+
+    Each disk is the same dict get_disks_linux used to make out of lsblk -J: path, vendor, model,
+    serial, wwn, hotplug, rota, size in bytes, mountpoint (a list) and mountpoint_map (partitions and
+    devices stacked on them, like LVM and dm-crypt, to where they are mounted).
+    """
+
+    def __init__(self, sysfs_root: str = "/sys", proc_root: str = "/proc", udev_root: str = "/run/udev/data", dev_root: str = "/dev"):
+        self.sysfs_root = sysfs_root
+        self.proc_root = proc_root
+        self.udev_root = udev_root
+        self.dev_root = dev_root
+
+    def scan(self, path: Optional[str] = None) -> List[dict]:
+        """Every disk, or just the one at path"""
+        block = os.path.join(self.sysfs_root, "block")
+        if path is not None:
+            names = [os.path.basename(os.path.realpath(path))]
+        else:
+            try:
+                names = sorted(os.listdir(block))
+            except OSError:
+                return []
+        mounts = read_mounts(self.proc_root)
+        disks = []
+        for name in names:
+            disk = self._disk(os.path.join(block, name), name, mounts)
+            if disk is not None:
+                disks.append(disk)
+        return disks
+
+    def _disk(self, directory: str, name: str, mounts: Dict[str, str]) -> Optional[dict]:
+        dev = _read(os.path.join(directory, "dev"))
+        if dev is None or int(dev.split(":")[0]) in EXCLUDED_MAJORS:
+            return None
+        try:
+            if len(os.listdir(os.path.join(directory, "slaves"))) > 0:
+                # Device mapper and such, lsblk lists them under the disks they are made of
+                return None
+        except OSError:
+            pass
+        size = (_read_int(os.path.join(directory, "size")) or 0) * 512
+        if size == 0:
+            # Empty SD card readers and the like
+            return None
+
+        udev = read_udev_properties(self.udev_root, dev)
+        device = os.path.join(directory, "device")
+        model = udev.get("ID_MODEL_ENC") or udev.get("ID_MODEL")
+        wwn = udev.get("ID_WWN_WITH_EXTENSION") or udev.get("ID_WWN") or _read(os.path.join(device, "wwid"))
+        path = os.path.join(self.dev_root, name)
+        mountpoint_map = {}
+        self._find_mounts(directory, path, dev, mounts, mountpoint_map)
+        return {
+            "path": path,
+            "vendor": _read(os.path.join(device, "vendor")) or None,
+            "model": _udev_decode(model) if model else (_read(os.path.join(device, "model")) or None),
+            "serial": udev.get("ID_SERIAL_SHORT") or _read(os.path.join(device, "serial")) or self._vpd_serial(device),
+            "wwn": wwn or None,
+            "hotplug": self._is_hotplug(directory),
+            "rota": _read_int(os.path.join(directory, "queue", "rotational")) == 1,
+            "size": size,
+            "mountpoint": list(mountpoint_map.values()),
+            "mountpoint_map": mountpoint_map,
+        }
+
+    def _find_mounts(self, directory: str, path: str, dev: str, mounts: Dict[str, str], mountpoint_map: Dict[str, str]):
+        name = os.path.basename(directory)
+        mountpoint = mounts.get(dev) or mounts.get(name)
+        if mountpoint is not None:
+            mountpoint_map[path] = mountpoint
+        children = []
+        try:
+            for child in sorted(os.listdir(directory)):
+                # Partitions are subdirectories with a partition file
+                if os.path.isfile(os.path.join(directory, child, "partition")):
+                    children.append((os.path.join(directory, child), os.path.join(self.dev_root, child)))
+        except OSError:
+            pass
+        try:
+            for holder in sorted(os.listdir(os.path.join(directory, "holders"))):
+                holder_directory = os.path.join(self.sysfs_root, "block", holder)
+                dm_name = _read(os.path.join(holder_directory, "dm", "name"))
+                children.append((holder_directory, os.path.join(self.dev_root, "mapper", dm_name) if dm_name else os.path.join(self.dev_root, holder)))
+        except OSError:
+            pass
+        for child_directory, child_path in children:
+            child_dev = _read(os.path.join(child_directory, "dev"))
+            if child_dev is not None:
+                self._find_mounts(child_directory, child_path, child_dev, mounts, mountpoint_map)
+
+    @staticmethod
+    def _vpd_serial(device: str) -> Optional[str]:
+        # SCSI VPD page 0x80: 4 bytes of header, then the serial number
+        try:
+            with open(os.path.join(device, "vpd_pg80"), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        serial = data[4:].decode("ascii", "replace").strip(" \x00")
+        return serial or None
+
+    def _is_hotplug(self, directory: str) -> bool:
+        if _read_int(os.path.join(directory, "removable")) == 1:
+            return True
+        # Like lsblk, anything on a bus where disks come and go
+        real = os.path.realpath(directory)
+        return any(f"/{bus}" in real for bus in ("usb", "ieee1394", "pcmcia", "mmc_host"))
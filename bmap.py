@@ -0,0 +1,165 @@
+import errno
+import hashlib
+import json
+import os
+import xml.etree.ElementTree as ElementTree
+from typing import Callable, Iterator, List, Optional
+
+# Sidecar written by basilico, next to the image
+BMAP_SUFFIX = ".bmap.json"
+BMAP_BLOCK_SIZE = 4096
+
+
+class BmapError(Exception):
+    pass
+
+
+class BlockMap:
+    """Which blocks of an image contain data, with a checksum for each range of them.
+
+    Same information as the XML files written by bmaptool, which can be read too. Ranges are
+    [first block, last block (inclusive), checksum].
+    """
+
+    def __init__(self, image_size: int, block_size: int, ranges: List[list], checksum_type: str = "sha256", image_mtime: Optional[int] = None):
+        self.image_size = image_size
+        self.block_size = block_size
+        self.ranges = ranges
+        self.checksum_type = checksum_type
+        # Only in our own sidecars, to notice when the image has changed
+        self.image_mtime = image_mtime
+
+    @property
+    def mapped_bytes(self) -> int:
+        return sum(length for _, length, _ in self.byte_ranges())
+
+    def byte_ranges(self) -> Iterator[tuple[int, int, str]]:
+        """(offset, length, checksum) of each range, the last one may end before its last block"""
+        for first, last, checksum in self.ranges:
+            offset = first * self.block_size
+            yield offset, min((last + 1) * self.block_size, self.image_size) - offset, checksum
+
+    def matches(self, image: str) -> bool:
+        stat = os.stat(image)
+        if stat.st_size != self.image_size:
+            return False
+        return self.image_mtime is None or self.image_mtime == int(stat.st_mtime)
+
+    def new_hash(self):
+        return hashlib.new(self.checksum_type)
+
+    def serialize(self) -> dict:
+        return {
+            "version": 1,
+            "image_size": self.image_size,
+            "image_mtime": self.image_mtime,
+            "block_size": self.block_size,
+            "mapped_blocks": sum(last - first + 1 for first, last, _ in self.ranges),
+            "checksum_type": self.checksum_type,
+            "ranges": self.ranges,
+        }
+
+    @staticmethod
+    def deserialize(data: dict):
+        try:
+            ranges = [[int(first), int(last), str(checksum)] for first, last, checksum in data["ranges"]]
+            return BlockMap(int(data["image_size"]), int(data["block_size"]), ranges, data.get("checksum_type", "sha256"), data.get("image_mtime"))
+        except (KeyError, TypeError, ValueError) as e:
+            raise BmapError(f"Invalid block map: {str(e)}")
+
+
+def parse_bmaptool_xml(text: str) -> BlockMap:
+    try:
+        root = ElementTree.fromstring(text)
+        version = root.get("version", "2.0")
+        image_size = int(root.findtext("ImageSize").strip())
+        block_size = int(root.findtext("BlockSize").strip())
+        # Version 1 has no ChecksumType and uses sha1
+        checksum_type = (root.findtext("ChecksumType") or "sha1").strip()
+        ranges = []
+        for element in root.find("BlockMap").findall("Range"):
+            first, _, last = element.text.strip().partition("-")
+            checksum = element.get("chksum") or element.get("sha1") or ""
+            ranges.append([int(first), int(last or first), checksum])
+    except (ElementTree.ParseError, AttributeError, ValueError) as e:
+        raise BmapError(f"Invalid bmaptool file: {str(e)}")
+    if not version.startswith(("1.", "2.")):
+        raise BmapError(f"Unsupported bmap version {version}")
+    return BlockMap(image_size, block_size, ranges, checksum_type)
+
+
+def load_bmap(path: str) -> BlockMap:
+    with open(path, "r") as f:
+        text = f.read()
+    if text.lstrip().startswith("<"):
+        return parse_bmaptool_xml(text)
+    try:
+        return BlockMap.deserialize(json.loads(text))
+    except ValueError as e:
+        raise BmapError(f"Invalid block map: {str(e)}")
+
+
+def save_bmap(bmap: BlockMap, path: str):
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as f:
+        json.dump(bmap.serialize(), f, separators=(",", ":"))
+    os.replace(temporary, path)
+
+
+def find_bmap(image: str) -> Optional[str]:
+    """Our sidecar, or one from bmaptool (image.bmap or image.img.bmap for image.img)"""
+    stem = os.path.splitext(image)[0]
+    for path in (image + BMAP_SUFFIX, image + ".bmap", stem + ".bmap"):
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def create_bmap(
+    image: str, block_size: int = BMAP_BLOCK_SIZE, should_continue: Callable[[], bool] = lambda: True, chunk_size: int = 4 * 1024 * 1024
+) -> Optional[BlockMap]:
+    """Map the data of an image from its holes, like bmaptool create. None if stopped."""
+    fd = os.open(image, os.O_RDONLY)
+    try:
+        stat = os.fstat(fd)
+        size = stat.st_size
+        ranges = []
+        for offset, length in _data_extents(fd, size):
+            first = offset // block_size
+            last = (offset + length - 1) // block_size
+            if len(ranges) > 0 and ranges[-1][1] >= first - 1:
+                # Touches the previous one after rounding to blocks
+                first = ranges.pop()[0]
+            ranges.append([first, last, None])
+        bmap = BlockMap(size, block_size, ranges, image_mtime=int(stat.st_mtime))
+        for i, (offset, length, _) in enumerate(list(bmap.byte_ranges())):
+            digest = bmap.new_hash()
+            done = 0
+            while done < length:
+                if not should_continue():
+                    return None
+                data = os.pread(fd, min(chunk_size, length - done), offset + done)
+                if len(data) == 0:
+                    raise BmapError(f"{image} got shorter while mapping it")
+                digest.update(data)
+                done += len(data)
+            bmap.ranges[i][2] = digest.hexdigest()
+        return bmap
+    finally:
+        os.close(fd)
+
+
+def _data_extents(fd: int, size: int) -> Iterator[tuple[int, int]]:
+    offset = 0
+    while offset < size:
+        try:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return
+            # No SEEK_DATA, everything is data
+            yield offset, size - offset
+            return
+        hole = min(os.lseek(fd, data, os.SEEK_HOLE), size)
+        yield data, hole - data
+        offset = hole
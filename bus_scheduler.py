@@ -0,0 +1,109 @@
+import os
+import re
+import threading
+from typing import Callable, Dict, Optional
+
+_USB_DEVICE = re.compile(r"\d+-\d+(\.\d+)*")
+_USB_ROOT = re.compile(r"usb\d+")
+_PCI_FUNCTION = re.compile(r"[0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\.[0-7]")
+_ATA_PORT = re.compile(r"ata\d+")
+
+
+def bus_group_from_sysfs_path(device_path: str) -> str:
+    """Find what a disk shares its bandwidth with, from the real path of its sysfs device.
+
+    Disks behind the same USB hub share the hub, disks on the same ATA port share a port multiplier
+    and disks behind the same SAS expander share the expander. Anything else (NVMe, plain SATA and
+    SAS ports...) gets a group of its own.
+    """
+    parts = device_path.strip("/").split("/")
+    if len(parts) > 0 and parts[0] == "sys":
+        parts = parts[1:]
+    if len(parts) > 0 and parts[0] == "devices":
+        parts = parts[1:]
+
+    usb = [i for i, part in enumerate(parts) if _USB_DEVICE.fullmatch(part) or _USB_ROOT.fullmatch(part)]
+    if len(usb) >= 2:
+        # The last one is the disk (or its bridge), the one before is the hub it is connected to
+        return "/".join(parts[: usb[-2] + 1])
+
+    for i, part in enumerate(parts):
+        if _ATA_PORT.fullmatch(part) or part.startswith("expander-"):
+            return "/".join(parts[: i + 1])
+
+    for i, part in enumerate(parts):
+        if part.startswith("port-"):
+            return "/".join(parts[: i + 1])
+
+    # Up to the last PCI function, which is the disk itself for NVMe
+    pci = [i for i, part in enumerate(parts) if _PCI_FUNCTION.fullmatch(part)]
+    if len(pci) > 0:
+        return "/".join(parts[: pci[-1] + 1])
+    return "/".join(parts)
+
+
+def bus_group(path: str, sysfs_root: str = "/sys") -> str:
+    name = os.path.basename(os.path.realpath(path))
+    try:
+        device = os.path.realpath(os.path.join(sysfs_root, "class", "block", name, "device"), strict=True)
+    except OSError:
+        # Not a real disk, it is alone on its bus
+        return name
+    return bus_group_from_sysfs_path(os.path.relpath(device, sysfs_root))
+
+
+class BusScheduler:
+    """Limit how many heavy I/O jobs run at the same time on the same bus.
+
+    Eight disks erasing at the same time behind one USB hub are slower than two at a time, four times.
+    max_jobs is the limit for each group, 0 means no limit. Jobs that acquire with the same share key,
+    like the targets of a fanout that all get the same data from one read, take a single slot together.
+    """
+
+    def __init__(self, max_jobs: int = 0):
+        self.max_jobs = max_jobs
+        self._condition = threading.Condition()
+        self._running: Dict[str, int] = {}
+        # Jobs holding each shared slot, by (group, share key)
+        self._shared: Dict[tuple[str, str], int] = {}
+
+    def running(self, group: str) -> int:
+        with self._condition:
+            return self._running.get(group, 0)
+
+    def is_full(self, group: str) -> bool:
+        with self._condition:
+            return 0 < self.max_jobs <= self._running.get(group, 0)
+
+    def acquire(
+        self, group: str, should_continue: Callable[[], bool] = lambda: True, poll_interval: Optional[float] = 1.0, share: Optional[str] = None
+    ) -> bool:
+        """Wait for a free slot, return False if should_continue became false while waiting"""
+        with self._condition:
+            while True:
+                if share is not None and (group, share) in self._shared:
+                    self._shared[(group, share)] += 1
+                    return True
+                if not 0 < self.max_jobs <= self._running.get(group, 0):
+                    break
+                if not should_continue():
+                    return False
+                self._condition.wait(poll_interval)
+            self._running[group] = self._running.get(group, 0) + 1
+            if share is not None:
+                self._shared[(group, share)] = 1
+                # Others with the same key may be waiting
+                self._condition.notify_all()
+            return True
+
+    def release(self, group: str, share: Optional[str] = None):
+        with self._condition:
+            if share is not None and (group, share) in self._shared:
+                self._shared[(group, share)] -= 1
+                if self._shared[(group, share)] > 0:
+                    return
+                del self._shared[(group, share)]
+            self._running[group] = self._running.get(group, 1) - 1
+            if self._running[group] <= 0:
+                del self._running[group]
+            self._condition.notify_all()
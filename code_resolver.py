@@ -0,0 +1,55 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Hashable, Optional, Set
+
+
+class CodeResolver:
+    """Run Tarallo lookups on a pool of threads of their own, so a slow answer holds up nothing else.
+
+    Lookups are identified by a key (the disk): asking again for one that is still running does nothing.
+    on_done(result, exception) is called on the pool thread once the lookup is over.
+    """
+
+    def __init__(self, workers: int = 4):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._running: Set[Hashable] = set()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def submit(self, key: Hashable, lookup: Callable[[], object], on_done: Callable[[object, Optional[Exception]], None]) -> bool:
+        """Start a lookup, False if the same one is already running"""
+        with self._lock:
+            if key in self._running:
+                return False
+            self._running.add(key)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max(1, self.workers), thread_name_prefix="tarallo")
+            self._executor.submit(self._run, key, lookup, on_done)
+        return True
+
+    def is_running(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._running
+
+    def _run(self, key: Hashable, lookup: Callable[[], object], on_done: Callable[[object, Optional[Exception]], None]):
+        # noinspection PyBroadException
+        try:
+            result, error = lookup(), None
+        except Exception as e:
+            result, error = None, e
+        # noinspection PyBroadException
+        try:
+            on_done(result, error)
+        except Exception as e:
+            logging.warning(f"Exception after looking up {key} on Tarallo", exc_info=e)
+        finally:
+            with self._lock:
+                self._running.discard(key)
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait)
@@ -48,16 +48,18 @@ DRIVES_TABLE_NAME = 0
 DRIVES_TABLE_TARALLO_ID = 1
 DRIVES_TABLE_DRIVE_SIZE = 2
 
-QUEUE_TABLE = ["ID", "Process", "Disk", "Status", "Eta", "Progress"]
+QUEUE_TABLE = ["ID", "Process", "Disk", "Status", "Eta", "Speed", "Progress"]
 
 QUEUE_TABLE_DRIVE = 0
 QUEUE_TABLE_PROCESS = 1
 QUEUE_TABLE_STATUS = 2
 QUEUE_TABLE_ETA = 3
-QUEUE_TABLE_PROGRESS = 4
+QUEUE_TABLE_SPEED = 4
+QUEUE_TABLE_PROGRESS = 5
 
 QUEUE_LABELS = {
     "queued_badblocks": "Erase",
+    "queued_secure_erase": "Secure Erase",
     "queued_smartctl": "Smart Check",
     "smartctl": "Smart Check",
     "queued_cannolo": "Load System",
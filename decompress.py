@@ -0,0 +1,146 @@
+import gzip
+import lzma
+import os
+import queue
+import subprocess
+import threading
+from typing import Callable, Optional
+
+from erase_engine import aligned_buffer
+
+try:
+    import zstandard
+except ImportError:
+    # Not a requirement, the zstd command does the same
+    zstandard = None
+
+COMPRESSION_SUFFIXES = {".gz": "gzip", ".xz": "xz", ".zst": "zstd"}
+
+
+def compression_of(path: str) -> Optional[str]:
+    """gzip, xz or zstd from the extension of the image, None if it is not compressed"""
+    return COMPRESSION_SUFFIXES.get(os.path.splitext(path)[1].lower())
+
+
+class DecompressingReader:
+    """Decompress an image in a thread of its own, while the caller writes what was decompressed before.
+
+    The thread fills block_size buffers taken from a pool of depth + 1 of them and queues them, so it can
+    get at most depth blocks ahead of the writer and nothing is allocated while copying. Every buffer
+    returned by get() has to be given back with release() before asking for the next one. zstd images
+    are decompressed by the zstandard module if installed, by a zstd process otherwise.
+    """
+
+    def __init__(self, path: str, block_size: int, depth: int = 4):
+        self.path = path
+        self.compression = compression_of(path)
+        if self.compression is None:
+            raise ValueError(f"{path} is not a compressed image")
+        self.block_size = block_size
+        self.compressed_size = os.path.getsize(path)
+
+        self._free = queue.Queue()
+        for _ in range(depth + 1):
+            self._free.put(memoryview(aligned_buffer(block_size)))
+        self._filled = queue.Queue()
+        self._stop = threading.Event()
+        self._raw = None
+        self._stream = None
+        self._process: Optional[subprocess.Popen] = None
+        self._thread = threading.Thread(target=self._decompress, daemon=True)
+
+    def start(self):
+        self._raw = open(self.path, "rb")
+        if self.compression == "gzip":
+            self._stream = gzip.GzipFile(fileobj=self._raw)
+        elif self.compression == "xz":
+            self._stream = lzma.LZMAFile(self._raw)
+        elif zstandard is not None:
+            self._stream = zstandard.ZstdDecompressor().stream_reader(self._raw)
+        else:
+            self._process = subprocess.Popen(("zstd", "-dc"), stdin=self._raw, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            self._stream = self._process.stdout
+        self._thread.start()
+
+    @property
+    def compressed_done(self) -> int:
+        if self._raw is None:
+            return 0
+        try:
+            # The zstd process shares the file position, no need to ask it
+            return os.lseek(self._raw.fileno(), 0, os.SEEK_CUR)
+        except (OSError, ValueError):
+            # Closed, it has all been read
+            return self.compressed_size
+
+    def estimated_size(self, bytes_done: int) -> int:
+        """Size of the decompressed image: as much as what is left of the compressed file, at the same ratio"""
+        compressed_done = self.compressed_done
+        if compressed_done <= 0:
+            return bytes_done
+        return max(bytes_done, bytes_done * self.compressed_size // compressed_done)
+
+    def get(self, should_continue: Callable[[], bool] = lambda: True) -> Optional[memoryview]:
+        """The next decompressed block, None at the end of the image or if stopped. The last one may be shorter."""
+        while True:
+            try:
+                buffer, length, error = self._filled.get(timeout=0.5)
+                break
+            except queue.Empty:
+                if not should_continue():
+                    return None
+        if error is not None:
+            raise error
+        if buffer is None:
+            return None
+        return buffer[:length]
+
+    def release(self, block: memoryview):
+        self._free.put(memoryview(block.obj))
+
+    def close(self):
+        self._stop.set()
+        if self._process is not None:
+            # Or the thread could be waiting for it forever
+            self._process.kill()
+            self._process.wait()
+        if self._thread.is_alive():
+            self._thread.join()
+        if self._stream is not None:
+            self._stream.close()
+        if self._raw is not None:
+            self._raw.close()
+
+    def _decompress(self):
+        try:
+            while not self._stop.is_set():
+                try:
+                    buffer = self._free.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                length = self._fill(buffer)
+                if length == 0:
+                    self._free.put(buffer)
+                    self._check_process()
+                    self._filled.put((None, 0, None))
+                    return
+                self._filled.put((buffer, length, None))
+        except (OSError, EOFError, lzma.LZMAError, ValueError) as e:
+            self._filled.put((None, 0, OSError(f"Cannot decompress {self.path}: {str(e)}")))
+        except Exception as e:
+            self._filled.put((None, 0, e))
+
+    def _fill(self, buffer: memoryview) -> int:
+        filled = 0
+        while filled < len(buffer) and not self._stop.is_set():
+            read = self._stream.readinto(buffer[filled:])
+            if not read:
+                break
+            filled += read
+        return filled
+
+    def _check_process(self):
+        if self._process is not None:
+            exitcode = self._process.wait()
+            if exitcode != 0:
+                raise OSError(f"zstd exited with code {exitcode}")
@@ -1,7 +1,8 @@
 import os.path
+from datetime import datetime
 
 from PyQt5.QtCore import QObject
-from PyQt5.QtWidgets import QDialog
+from PyQt5.QtWidgets import QDialog, QListWidgetItem
 
 from ui.SelectSystemDialog import Ui_SelectSystemDialog
 
@@ -22,13 +23,34 @@ class SelectSystemDialog(QDialog, Ui_SelectSystemDialog):
         self.cancelButton.clicked.connect(self.close)
 
     def load_images(self, images: list):
-        for path in images:
-            if not os.path.isfile(path):
-                continue
+        for image in images:
+            # Older servers send bare paths, newer ones the catalog entry of each image
+            if isinstance(image, str):
+                image = {"path": image}
+                if not os.path.isfile(image["path"]):
+                    continue
 
+            path = image["path"]
+            if image.get("compression") is not None:
+                path = os.path.splitext(path)[0]
             file_extension = os.path.splitext(path)[1]
             if file_extension == ".iso" or file_extension == ".img":
-                self.isoList.addItem(os.path.basename(path))
+                item = QListWidgetItem(os.path.basename(image["path"]))
+                item.setToolTip(self._describe(image))
+                self.isoList.addItem(item)
+
+    @staticmethod
+    def _describe(image: dict) -> str:
+        lines = []
+        if image.get("size") is not None:
+            lines.append(f"Size: {image['size'] / 1024 ** 3:.2f} GiB" + (f" ({image['compression']})" if image.get("compression") else ""))
+        if image.get("mtime") is not None:
+            lines.append(f"Modified: {datetime.fromtimestamp(image['mtime']).strftime('%Y-%m-%d %H:%M')}")
+        if image.get("partition_table") is not None:
+            lines.append(f"Partitions: {len(image.get('partitions', []))} ({image['partition_table']})")
+        if image.get("checksum") is not None:
+            lines.append(f"{image.get('checksum_type', 'checksum')}: {image['checksum']}")
+        return "\n".join(lines)
 
     def select(self):
         """
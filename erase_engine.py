@@ -0,0 +1,488 @@
+import bisect
+import mmap
+import os
+import random
+import re
+import stat
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Sequence
+
+KiB = 1024
+MiB = 1024 * KiB
+GiB = 1024 * MiB
+
+
+def parse_size(size: str) -> int:
+    """Parse sizes like "4096", "512K", "4M" or "1G" (powers of 2) into bytes."""
+    match = re.fullmatch(r"(\d+)\s*([KMGT]?)i?B?", size.strip(), re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid size: {size}")
+    number, unit = match.groups()
+    return int(number) * {"": 1, "K": KiB, "M": MiB, "G": GiB, "T": 1024 * GiB}[unit.upper()]
+
+
+def parse_fraction(fraction: str) -> float:
+    """Parse "0.05" or "5%" into 0.05"""
+    try:
+        if fraction.endswith("%"):
+            return float(fraction[:-1]) / 100
+        return float(fraction)
+    except ValueError:
+        raise ValueError(f"Invalid fraction: {fraction}")
+
+
+def format_rate(bytes_per_second: float) -> str:
+    return f"{bytes_per_second / 1000 / 1000:.1f} MB/s"
+
+
+def aligned_buffer(size: int) -> mmap.mmap:
+    """Anonymous mmaps are page aligned, which is what O_DIRECT wants."""
+    return mmap.mmap(-1, size)
+
+
+def same_data(a: memoryview, b: memoryview) -> bool:
+    # Comparing as 64 bit words is way faster than byte by byte
+    if len(a) % 8 == 0 and len(b) % 8 == 0:
+        return a.cast("Q") == b.cast("Q")
+    return a == b
+
+
+def open_direct(path: str, flags: int) -> (int, bool):
+    """Open with O_DIRECT if the file supports it, return the fd and whether O_DIRECT is in use."""
+    if hasattr(os, "O_DIRECT"):
+        try:
+            return os.open(path, flags | os.O_DIRECT), True
+        except OSError:
+            # e.g. tmpfs, fall through
+            pass
+    return os.open(path, flags), False
+
+
+def logical_sector_size(path: str) -> int:
+    try:
+        if stat.S_ISBLK(os.stat(path).st_mode):
+            name = os.path.basename(os.path.realpath(path))
+            with open(f"/sys/class/block/{name}/queue/logical_block_size") as f:
+                return int(f.read().strip())
+    except (OSError, ValueError):
+        pass
+    return 512
+
+
+def merge_ranges(ranges: List[List[int]]) -> List[List[int]]:
+    """Merge [first, count] ranges that overlap or touch."""
+    merged = []
+    for first, count in sorted(ranges):
+        if len(merged) > 0 and first <= merged[-1][0] + merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], first + count - merged[-1][0])
+        else:
+            merged.append([first, count])
+    return merged
+
+
+def convert_ranges(ranges: List[List[int]], from_unit: int, to_unit: int) -> List[List[int]]:
+    """Convert [first, count] ranges between units (e.g. 4096 byte blocks to 512 byte LBAs), rounding outwards."""
+    converted = []
+    for first, count in ranges:
+        start = first * from_unit // to_unit
+        end = -(-(first + count) * from_unit // to_unit)
+        converted.append([start, end - start])
+    return merge_ranges(converted)
+
+
+def replace_ranges(old: List[List[int]], new: List[List[int]], start: int, end: int) -> List[List[int]]:
+    """Replace everything in old between start and end (exclusive) with new, all in the same unit."""
+    kept = []
+    for first, count in old:
+        if first < start:
+            kept.append([first, min(count, start - first)])
+        if first + count > end:
+            kept.append([max(first, end), first + count - max(first, end)])
+    return merge_ranges(kept + [[first, count] for first, count in new])
+
+
+RANDOM = "random"
+# Patterns written (and read back) in order by each profile. A pattern is a byte in hex, like badblocks -t, or random.
+ERASE_PROFILES = {
+    "zero": ("0x00",),
+    "random": (RANDOM,),
+    "random-zero": (RANDOM, "0x00"),
+    "dod": ("0x00", "0xff", RANDOM),
+    # Same as badblocks without -t
+    "badblocks": ("0xaa", "0x55", "0xff", "0x00"),
+}
+DEFAULT_PROFILE = "zero"
+
+
+def profile_patterns(profile: str) -> Sequence[str]:
+    if profile not in ERASE_PROFILES:
+        raise ValueError(f"Unknown erase profile {profile}, use one of {', '.join(ERASE_PROFILES)}")
+    return ERASE_PROFILES[profile]
+
+
+def parse_pattern(pattern: str) -> Optional[int]:
+    """Byte value of a pattern like "0xff", None for random"""
+    if pattern == RANDOM:
+        return None
+    match = re.fullmatch(r"0x([0-9a-f]{1,2})", pattern, re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid pattern {pattern}")
+    return int(match.group(1), 16)
+
+
+class FixedPattern:
+    def __init__(self, value: int, block_size: int):
+        self._buffer = aligned_buffer(block_size)
+        if value != 0:
+            self._buffer.write(bytes([value]) * block_size)
+
+    def data(self, offset: int, length: int, scratch) -> memoryview:
+        return memoryview(self._buffer)[:length]
+
+
+class RandomPattern:
+    """Pseudorandom data that can be generated again for any offset, to read it back.
+
+    A pool is filled once from a seeded PRNG, and each CHUNK of the disk is a slice of the pool starting
+    at a shift that depends on its absolute offset. The data does not depend on block sizes or where a run
+    started, only on the seed, so it can be read back in different blocks or after resuming. Copying a
+    slice is way faster than generating new data, so the PRNG never slows down the disk.
+    """
+
+    EXTRA = 1 * MiB
+    CHUNK = 64 * KiB
+
+    def __init__(self, seed: int):
+        self._pool = memoryview(random.Random(seed).randbytes(self.CHUNK + self.EXTRA))
+
+    def data(self, offset: int, length: int, scratch) -> memoryview:
+        view = memoryview(scratch)[:length]
+        position = offset
+        end = offset + length
+        while position < end:
+            chunk, within = divmod(position, self.CHUNK)
+            count = min(self.CHUNK - within, end - position)
+            shift = zlib.crc32(chunk.to_bytes(8, "little")) % self.EXTRA + within
+            view[position - offset : position - offset + count] = self._pool[shift : shift + count]
+            position += count
+        return view
+
+
+def make_pattern(pattern: str, block_size: int, seed: int = 0):
+    """seed is only used for random data, the same seed makes the same data"""
+    value = parse_pattern(pattern)
+    if value is None:
+        return RandomPattern(seed)
+    return FixedPattern(value, block_size)
+
+
+class EraseProgress:
+    def __init__(self, bytes_done: int, bytes_total: int, elapsed: float, errors: int, bytes_resumed: int = 0):
+        self.bytes_done = bytes_done
+        self.bytes_total = bytes_total
+        self.elapsed = elapsed
+        self.errors = errors
+        # Already done in a previous run, counted in bytes_done
+        self.bytes_resumed = bytes_resumed
+
+    @property
+    def percent(self) -> float:
+        if self.bytes_total <= 0:
+            return 100.0
+        return self.bytes_done / self.bytes_total * 100
+
+    @property
+    def throughput(self) -> float:
+        """Average bytes per second"""
+        if self.elapsed <= 0:
+            return 0.0
+        return (self.bytes_done - self.bytes_resumed) / self.elapsed
+
+
+class EraseResult:
+    def __init__(
+        self,
+        completed: bool,
+        size: int,
+        elapsed: float,
+        error_ranges: List[List[int]],
+        sector_size: int,
+        start: int = 0,
+        bytes_processed: int = 0,
+        sample_blocks: Optional[int] = None,
+    ):
+        self.completed = completed
+        self.size = size
+        # Where this run started, if resumed
+        self.start = start
+        self.elapsed = elapsed
+        # [first LBA, number of LBAs], in units of sector_size
+        self.error_ranges = error_ranges
+        self.sector_size = sector_size
+        # Written plus read back in this run
+        self.bytes_processed = bytes_processed
+        # How many blocks were read back, when only a sample is verified
+        self.sample_blocks = sample_blocks
+
+    @property
+    def errors(self) -> int:
+        return sum(count for _, count in self.error_ranges)
+
+    @property
+    def throughput(self) -> float:
+        """Average bytes per second, counting both the write and the verify pass"""
+        if self.elapsed <= 0:
+            return 0.0
+        return self.bytes_processed / self.elapsed
+
+
+VERIFY_FULL = "full"
+VERIFY_SAMPLE = "sample"
+
+
+class EraseEngine:
+    """Overwrite a disk and read it back, without shelling out to badblocks.
+
+    The disk is processed in regions: each region is written in blocks of block_size bytes, then read
+    back and compared. Regions should be larger than the disk cache, so the read pass hits the platters.
+    Up to queue_depth blocks are in flight at the same time, each from its own thread (pread and pwrite
+    release the GIL). Blocks that fail are retried in probe_size units to find the exact bad LBAs.
+    Everything before a region boundary has been written (and verified), so that is where an interrupted
+    erase can be resumed: on_checkpoint is called with the boundary (and the errors found so far) after
+    each region, and start_offset can be used to resume from there.
+
+    With verify="sample" the whole disk is written first, then only the first and last sample_edges bytes
+    and a random sample_fraction of the other blocks are read back. That is almost twice as fast and
+    still catches disks that silently drop writes.
+
+    With more than one pattern each region is written and read back with every pattern in turn. In sample
+    mode only the last pattern, which is what remains on the disk, is read back.
+
+    skip_ranges are [first LBA, count] ranges already known to be bad: they are not touched and are
+    reported as errors again, to avoid spending hours retrying a damaged area.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        block_size: int = 4 * MiB,
+        queue_depth: int = 1,
+        region_size: int = 1 * GiB,
+        probe_size: int = 4 * KiB,
+        progress_interval: float = 1.0,
+        verify: str = VERIFY_FULL,
+        sample_fraction: float = 0.01,
+        sample_edges: int = 64 * MiB,
+        seed: Optional[int] = None,
+        patterns: Sequence[str] = ("0x00",),
+        skip_ranges: Optional[List[List[int]]] = None,
+        pattern_seed: Optional[int] = None,
+    ):
+        if verify not in (VERIFY_FULL, VERIFY_SAMPLE):
+            raise ValueError(f"Unknown verify mode {verify}")
+        if not 0 <= sample_fraction <= 1:
+            raise ValueError(f"Sample fraction {sample_fraction} is not between 0 and 1")
+        if len(patterns) == 0:
+            raise ValueError("No patterns to write")
+        for pattern in patterns:
+            parse_pattern(pattern)
+        self.path = path
+        self.sector_size = logical_sector_size(path)
+        self.block_size = self._align(block_size)
+        self.queue_depth = max(1, queue_depth)
+        self.region_size = max(self.block_size, self._align(region_size))
+        self.probe_size = min(self.block_size, self._align(probe_size))
+        self.progress_interval = progress_interval
+        self.verify = verify
+        self.sample_fraction = sample_fraction
+        self.sample_edges = sample_edges
+        self.seed = seed
+        # Random patterns are made from this, resuming needs the same one as the interrupted run
+        self.pattern_seed = pattern_seed if pattern_seed is not None else random.getrandbits(64)
+        self.patterns = tuple(patterns)
+        self.skip_ranges = merge_ranges(skip_ranges or [])
+        self.direct = False
+
+        self._errors: List[List[int]] = []
+        self._bytes_done = 0
+        self._bytes_total = 0
+        self._bytes_resumed = 0
+        self._start_offset = 0
+        self._size = 0
+        self._start = 0.0
+        self._last_progress = 0.0
+        self._throttle = None
+        self._skip_starts = []
+
+    def _align(self, size: int) -> int:
+        return max(self.sector_size, size - size % self.sector_size)
+
+    def run(
+        self,
+        should_continue: Callable[[], bool] = lambda: True,
+        on_progress: Optional[Callable[[EraseProgress], None]] = None,
+        start_offset: int = 0,
+        on_checkpoint: Optional[Callable[[int, List[List[int]]], None]] = None,
+        throttle: Optional[Callable[[int], bool]] = None,
+    ) -> EraseResult:
+        """throttle is called with the bytes about to be moved and may sleep, returning False stops the erase"""
+        fd, self.direct = open_direct(self.path, os.O_RDWR)
+        self._throttle = throttle
+        self._skip_starts = [first * self.sector_size for first, _ in self.skip_ranges]
+        self._errors = []
+        self._start_offset = start_offset - start_offset % self.sector_size
+        self._start = time.monotonic()
+        self._last_progress = self._start
+        sample = None
+        completed = False
+        try:
+            self._size = os.lseek(fd, 0, os.SEEK_END)
+            patterns = [make_pattern(pattern, self.block_size, self.pattern_seed) for pattern in self.patterns]
+            if self.verify == VERIFY_SAMPLE:
+                sample = self.sample_blocks(self._size)
+                passes = [(pattern, True) for pattern in patterns]
+                self._bytes_resumed = self._start_offset * len(patterns)
+                self._bytes_total = self._size * len(patterns) + sum(length for _, length in sample)
+            else:
+                passes = [(pattern, write) for pattern in patterns for write in (True, False)]
+                self._bytes_resumed = self._start_offset * 2 * len(patterns)
+                self._bytes_total = self._size * 2 * len(patterns)
+            self._bytes_done = self._bytes_resumed
+
+            # A buffer for the pattern and one to read back, for each block in flight
+            buffers = [(aligned_buffer(self.block_size), aligned_buffer(self.block_size)) for _ in range(self.queue_depth)]
+            with ThreadPoolExecutor(self.queue_depth) as executor:
+                for region_start in range(self._start_offset, self._size, self.region_size):
+                    region_end = min(region_start + self.region_size, self._size)
+                    blocks = [(offset, min(self.block_size, region_end - offset)) for offset in range(region_start, region_end, self.block_size)]
+                    for pattern, write in passes:
+                        if not self._pass(executor, fd, blocks, write, pattern, buffers, should_continue, on_progress):
+                            return self._result(False, sample)
+                    if on_checkpoint:
+                        on_checkpoint(region_end, merge_ranges(self._errors))
+                # Flush the disk cache before reading back
+                os.fsync(fd)
+                if sample is not None:
+                    if not self._pass(executor, fd, sample, False, patterns[-1], buffers, should_continue, on_progress):
+                        return self._result(False, sample)
+            completed = True
+        finally:
+            os.close(fd)
+        if on_progress:
+            on_progress(self._progress())
+        return self._result(completed, sample)
+
+    def sample_blocks(self, size: int) -> List[tuple[int, int]]:
+        """Blocks to read back in sample mode, as (offset, length), sorted to keep the seeks short."""
+        blocks = [(offset, min(self.block_size, size - offset)) for offset in range(0, size, self.block_size)]
+        edge_blocks = -(-min(self.sample_edges, size) // self.block_size)
+        if 2 * edge_blocks >= len(blocks):
+            return blocks
+        middle = blocks[edge_blocks : len(blocks) - edge_blocks]
+        count = min(len(middle), round(len(blocks) * self.sample_fraction))
+        sampled = random.Random(self.seed).sample(middle, count)
+        return blocks[:edge_blocks] + sorted(sampled) + blocks[len(blocks) - edge_blocks :]
+
+    def _result(self, completed: bool, sample: Optional[list]) -> EraseResult:
+        return EraseResult(
+            completed,
+            self._size,
+            time.monotonic() - self._start,
+            merge_ranges(self._errors),
+            self.sector_size,
+            self._start_offset,
+            self._bytes_done - self._bytes_resumed,
+            len(sample) if sample is not None else None,
+        )
+
+    def _progress(self) -> EraseProgress:
+        # The same bad sectors are found again by every pattern
+        errors = sum(count for _, count in merge_ranges(self._errors))
+        return EraseProgress(self._bytes_done, self._bytes_total, time.monotonic() - self._start, errors, self._bytes_resumed)
+
+    def _pass(self, executor, fd: int, blocks: List[tuple[int, int]], write: bool, pattern, buffers, should_continue, on_progress) -> bool:
+        for i in range(0, len(blocks), self.queue_depth):
+            if not should_continue():
+                return False
+            batch = blocks[i : i + self.queue_depth]
+            if self._throttle is not None and not self._throttle(sum(length for _, length in batch)):
+                return False
+            if len(batch) == 1:
+                self._block(fd, batch[0][0], batch[0][1], write, pattern, *buffers[0])
+            else:
+                futures = [executor.submit(self._block, fd, offset, length, write, pattern, *buffers[slot]) for slot, (offset, length) in enumerate(batch)]
+                for future in futures:
+                    future.result()
+            self._bytes_done += sum(length for _, length in batch)
+
+            now = time.monotonic()
+            if on_progress and now - self._last_progress >= self.progress_interval:
+                self._last_progress = now
+                on_progress(self._progress())
+        return True
+
+    def _is_skipped(self, offset: int, length: int) -> bool:
+        # The last known bad range starting before the end of this one
+        i = bisect.bisect_left(self._skip_starts, offset + length) - 1
+        if i < 0:
+            return False
+        first, count = self.skip_ranges[i]
+        return (first + count) * self.sector_size > offset
+
+    def _block(self, fd: int, offset: int, length: int, write: bool, pattern, scratch, buffer):
+        expected = pattern.data(offset, length, scratch)
+        if self._is_skipped(offset, length):
+            self._probe(fd, offset, length, write, expected, buffer)
+            return
+        try:
+            if write:
+                self._write(fd, expected, offset)
+                return
+            view = memoryview(buffer)[:length]
+            self._read(fd, view, offset)
+            if same_data(view, expected):
+                return
+        except OSError:
+            pass
+        self._probe(fd, offset, length, write, expected, buffer)
+
+    def _probe(self, fd: int, offset: int, length: int, write: bool, expected: memoryview, buffer):
+        for sub in range(0, length, self.probe_size):
+            sub_length = min(self.probe_size, length - sub)
+            if self._is_skipped(offset + sub, sub_length):
+                # Do not touch it, it is still bad. Every pass writes, not every pass reads back.
+                if write:
+                    self._errors.append([(offset + sub) // self.sector_size, sub_length // self.sector_size])
+                continue
+            try:
+                if write:
+                    self._write(fd, expected[sub : sub + sub_length], offset + sub)
+                    continue
+                view = memoryview(buffer)[:sub_length]
+                self._read(fd, view, offset + sub)
+                if same_data(view, expected[sub : sub + sub_length]):
+                    continue
+            except OSError:
+                pass
+            # list.append is atomic, no need to lock
+            self._errors.append([(offset + sub) // self.sector_size, sub_length // self.sector_size])
+
+    @staticmethod
+    def _write(fd: int, data: memoryview, offset: int):
+        while len(data) > 0:
+            written = os.pwrite(fd, data, offset)
+            if written <= 0:
+                raise OSError(f"Short write at offset {offset}")
+            data = data[written:]
+            offset += written
+
+    @staticmethod
+    def _read(fd: int, view: memoryview, offset: int):
+        while len(view) > 0:
+            read = os.preadv(fd, [view], offset)
+            if read <= 0:
+                raise OSError(f"Short read at offset {offset}")
+            view = view[read:]
+            offset += read
@@ -0,0 +1,204 @@
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from decompress import DecompressingReader, compression_of
+from erase_engine import MiB, aligned_buffer
+
+# Chunks are written with O_DIRECT to every target, so they must be aligned to the largest sector size
+FANOUT_ALIGNMENT = 4096
+
+
+class FanoutStream:
+    """What one target reads from a FanoutHub, the same interface as a DecompressingReader"""
+
+    def __init__(self, hub: "FanoutHub"):
+        self._hub = hub
+        self.position = 0
+        self.released = 0
+        self.active = True
+
+    def estimated_size(self, bytes_done: int) -> int:
+        return self._hub.estimated_size(bytes_done)
+
+    def get(self, should_continue: Callable[[], bool] = lambda: True) -> Optional[memoryview]:
+        return self._hub.get(self, should_continue)
+
+    def release(self, _block: memoryview):
+        self._hub.release(self)
+
+    def close(self):
+        self._hub.leave(self)
+
+
+class FanoutHub:
+    """Read an image once and write it to many disks.
+
+    A reader thread fills a ring of slots block_size bytes each, every target has a FanoutStream that
+    goes through the ring at its own pace. A slot is filled again only when every target has released
+    it, so the slowest target slows down the reader and the others, and nothing is read twice. Targets
+    that stop or fail leave the hub and do not hold back the others.
+
+    The reader waits for expected targets to join, or gather_timeout seconds after the first one, then
+    starts from the beginning of the image: join() returns None after that.
+    """
+
+    def __init__(self, source: str, block_size: int = 8 * MiB, slots: int = 8, expected: int = 0, gather_timeout: float = 60.0):
+        self.source = source
+        self.block_size = max(FANOUT_ALIGNMENT, block_size - block_size % FANOUT_ALIGNMENT)
+        self.expected = expected
+        self.gather_timeout = gather_timeout
+        self._slots: List[memoryview] = [memoryview(aligned_buffer(self.block_size)) for _ in range(slots)]
+        self._lengths = [0] * slots
+        self._condition = threading.Condition()
+        self._streams: List[FanoutStream] = []
+        self._produced = 0
+        self._done = False
+        self._error: Optional[Exception] = None
+        self._started = False
+        self._size = 0
+        self._decompressor: Optional[DecompressingReader] = None
+        self._thread = threading.Thread(target=self._read, daemon=True)
+
+    @property
+    def started(self) -> bool:
+        return self._started
+
+    def join(self) -> Optional[FanoutStream]:
+        with self._condition:
+            if self._started:
+                return None
+            stream = FanoutStream(self)
+            self._streams.append(stream)
+            if not self._thread.is_alive():
+                self._thread.start()
+            self._condition.notify_all()
+            return stream
+
+    def estimated_size(self, bytes_done: int) -> int:
+        if self._decompressor is not None:
+            return self._decompressor.estimated_size(bytes_done)
+        return max(bytes_done, self._size)
+
+    def get(self, stream: FanoutStream, should_continue: Callable[[], bool]) -> Optional[memoryview]:
+        with self._condition:
+            while stream.position >= self._produced and not self._done and self._error is None:
+                if not should_continue():
+                    return None
+                self._condition.wait(0.5)
+            if stream.position >= self._produced:
+                if self._error is not None:
+                    raise self._error
+                return None
+            slot = stream.position % len(self._slots)
+            stream.position += 1
+            return self._slots[slot][: self._lengths[slot]]
+
+    def release(self, stream: FanoutStream):
+        with self._condition:
+            stream.released += 1
+            self._condition.notify_all()
+
+    def leave(self, stream: FanoutStream):
+        with self._condition:
+            stream.active = False
+            self._condition.notify_all()
+
+    def _gather(self) -> bool:
+        deadline = time.monotonic() + self.gather_timeout
+        with self._condition:
+            while len(self._streams) < self.expected and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+            self._started = True
+            return any(stream.active for stream in self._streams)
+
+    def _wait_for_slot(self) -> bool:
+        """Wait until every target is done with the slot to fill next, False if there is nobody left"""
+        with self._condition:
+            while True:
+                active = [stream for stream in self._streams if stream.active]
+                if len(active) == 0:
+                    return False
+                if self._produced - min(stream.released for stream in active) < len(self._slots):
+                    return True
+                self._condition.wait(0.5)
+
+    def _read(self):
+        if not self._gather():
+            return
+        fd = None
+        try:
+            if compression_of(self.source) is not None:
+                self._decompressor = DecompressingReader(self.source, self.block_size, 2)
+                self._decompressor.start()
+            else:
+                fd = os.open(self.source, os.O_RDONLY)
+                self._size = os.fstat(fd).st_size
+            offset = 0
+            while self._wait_for_slot():
+                slot = self._produced % len(self._slots)
+                length = self._fill(fd, self._slots[slot], offset)
+                if length == 0:
+                    break
+                offset += length
+                with self._condition:
+                    self._lengths[slot] = length
+                    self._produced += 1
+                    self._condition.notify_all()
+            with self._condition:
+                self._done = True
+                self._condition.notify_all()
+        except Exception as e:
+            with self._condition:
+                self._error = e
+                self._condition.notify_all()
+        finally:
+            if fd is not None:
+                os.close(fd)
+            if self._decompressor is not None:
+                self._decompressor.close()
+
+    def _fill(self, fd: Optional[int], view: memoryview, offset: int) -> int:
+        if self._decompressor is not None:
+            block = self._decompressor.get()
+            if block is None:
+                return 0
+            view[: len(block)] = block
+            self._decompressor.release(block)
+            return len(block)
+        filled = 0
+        while filled < len(view):
+            read = os.preadv(fd, [view[filled:]], offset + filled)
+            if read == 0:
+                break
+            filled += read
+        # Read once and never again, do not keep it in the page cache
+        os.posix_fadvise(fd, offset, filled, os.POSIX_FADV_DONTNEED)
+        return filled
+
+
+class FanoutRegistry:
+    """Hubs still waiting for targets, by image and block size"""
+
+    def __init__(self, slots: int = 8, gather_timeout: float = 60.0):
+        self.slots = slots
+        self.gather_timeout = gather_timeout
+        self._lock = threading.Lock()
+        self._hubs: Dict[tuple, FanoutHub] = {}
+
+    def join(self, source: str, block_size: int, expected: int) -> FanoutStream:
+        key = (os.path.realpath(source), block_size)
+        with self._lock:
+            hub = self._hubs.get(key)
+            stream = hub.join() if hub is not None else None
+            if stream is None:
+                # Already started, a new one for those that come later
+                hub = FanoutHub(source, block_size, self.slots, expected, self.gather_timeout)
+                self._hubs[key] = hub
+                stream = hub.join()
+            for other_key, other in list(self._hubs.items()):
+                if other.started:
+                    # Nobody else can join, the targets keep it alive until they are done
+                    del self._hubs[other_key]
+            return stream
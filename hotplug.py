@@ -0,0 +1,151 @@
+import errno
+import logging
+import socket
+import struct
+import threading
+from typing import Callable, Dict, Optional
+
+NETLINK_KOBJECT_UEVENT = 15
+# Multicast groups: events straight from the kernel, or from udevd once it has processed them
+KERNEL_GROUP = 1
+UDEV_GROUP = 2
+_UDEV_PREFIX = b"libudev\x00"
+_UDEV_MAGIC = 0xFEEDCAFE
+# Same as lsblk --exclude 7,9,11,43: loop devices, md, optical drives and nbd
+IGNORED_MAJORS = {"7", "9", "11", "43"}
+
+
+def parse_uevent(data: bytes) -> Optional[Dict[str, str]]:
+    """Properties of a uevent (ACTION, DEVNAME, SUBSYSTEM, DEVTYPE...), None if it is not one.
+
+    Kernel events are "action@devpath" followed by KEY=VALUE strings, all NUL terminated. udevd sends
+    the same properties after a binary header that starts with "libudev".
+    """
+    if data.startswith(_UDEV_PREFIX):
+        if len(data) < 24:
+            return None
+        magic, _header_size, properties_offset, properties_length = struct.unpack_from("!I", data, 8) + struct.unpack_from("=III", data, 12)
+        if magic != _UDEV_MAGIC:
+            return None
+        payload = data[properties_offset : properties_offset + properties_length]
+    else:
+        header, _, payload = data.partition(b"\x00")
+        if b"@" not in header:
+            return None
+    properties = {}
+    for field in payload.split(b"\x00"):
+        key, separator, value = field.partition(b"=")
+        if separator:
+            properties[key.decode("utf-8", "replace")] = value.decode("utf-8", "replace")
+    if "ACTION" not in properties:
+        return None
+    return properties
+
+
+class NetlinkUeventSource:
+    """Uevents from a netlink socket, needs no privileges to listen"""
+
+    def __init__(self, group: int = UDEV_GROUP, buffer_size: int = 1024 * 1024):
+        self._socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        try:
+            # Bursts of events when a hub with many disks is connected
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+        except OSError:
+            pass
+        self._socket.bind((0, group))
+
+    def receive(self, timeout: float) -> Optional[bytes]:
+        self._socket.settimeout(timeout)
+        try:
+            return self._socket.recv(64 * 1024)
+        except socket.timeout:
+            return None
+
+    def close(self):
+        self._socket.close()
+
+
+class UeventMonitor(threading.Thread):
+    """Call on_event(action, device path) for every disk that is added, changed or removed.
+
+    Partitions are reported as their disk, since that is what changes for clients. source is anything
+    with receive(timeout) returning the raw bytes of an event or None, a NetlinkUeventSource by default.
+    When events have been lost, on_resync() is called to compare all disks again.
+    """
+
+    def __init__(
+        self,
+        on_event: Callable[[str, str], None],
+        source=None,
+        poll_interval: float = 1.0,
+        on_resync: Optional[Callable[[], None]] = None,
+        max_backoff: float = 30.0,
+    ):
+        super().__init__(daemon=True)
+        self.on_event = on_event
+        self.on_resync = on_resync
+        self.source = source if source is not None else NetlinkUeventSource()
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self._go = True
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._go = False
+        self._stopped.set()
+
+    def run(self):
+        failures = 0
+        while self._go:
+            try:
+                data = self.source.receive(self.poll_interval)
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    # Too many events at once, e.g. a hub full of disks, some have been dropped
+                    logging.warning("Uevents have been lost, scanning all disks again")
+                    self._resync()
+                    continue
+                failures += 1
+                logging.warning("Cannot receive uevents", exc_info=e)
+                # Do not spin on a socket that keeps failing
+                self._stopped.wait(min(self.max_backoff, self.poll_interval * 2 ** min(failures, 10)))
+                continue
+            failures = 0
+            if data is None:
+                continue
+            event = self.disk_event(parse_uevent(data))
+            if event is None:
+                continue
+            # noinspection PyBroadException
+            try:
+                self.on_event(*event)
+            except Exception as e:
+                logging.warning(f"Exception while handling uevent {event}", exc_info=e)
+
+    def _resync(self):
+        if self.on_resync is None:
+            return
+        # noinspection PyBroadException
+        try:
+            self.on_resync()
+        except Exception as e:
+            logging.warning("Exception while scanning disks again after losing uevents", exc_info=e)
+
+    @staticmethod
+    def disk_event(properties: Optional[Dict[str, str]]) -> Optional[tuple[str, str]]:
+        if properties is None or properties.get("SUBSYSTEM") != "block" or properties.get("MAJOR") in IGNORED_MAJORS:
+            return None
+        name = properties.get("DEVNAME")
+        if not name:
+            return None
+        path = name if name.startswith("/") else f"/dev/{name}"
+        action = properties["ACTION"]
+        if properties.get("DEVTYPE") == "partition":
+            # A partition was added or removed: its disk has changed
+            parent = properties.get("DEVPATH", "").rstrip("/").split("/")
+            if len(parent) < 2:
+                return None
+            return "change", f"/dev/{parent[-2]}"
+        if action not in ("add", "change", "remove"):
+            return None
+        return action, path
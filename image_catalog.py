@@ -0,0 +1,160 @@
+import hashlib
+import logging
+import os
+import queue
+import threading
+from typing import Callable, List, Optional, Set, Tuple
+
+from bmap import BMAP_SUFFIX, find_bmap
+from decompress import DecompressingReader, compression_of
+from erase_engine import MiB
+from partition_table import parse_partition_table
+from state_store import JsonStore
+
+# Enough for the MBR and the GPT header and entries, even with 4096 byte sectors
+PARTITION_TABLE_HEAD = 1 * MiB
+
+
+class ImageCatalog(JsonStore):
+    """Metadata of the images in the ISO directories, cached by path.
+
+    Size, modification time, compression and partition table are read when an image is first listed
+    and again only if its size or mtime change. The checksum (of the file as it is, compressed or not)
+    takes a full read, so a thread of its own computes it in the background: until then it is None.
+    """
+
+    def __init__(self, path: str, checksum: str = "blake2b", chunk_size: int = 8 * MiB):
+        super().__init__(path)
+        self.checksum = checksum
+        self.chunk_size = chunk_size
+        self._pending = queue.Queue()
+        # Queued or being hashed, by path and mtime, so listing again does not queue them twice
+        self._hashing: Set[Tuple[str, int]] = set()
+        self._hasher: Optional[threading.Thread] = None
+
+    def list(self, directory: str) -> List[dict]:
+        """Every image in a directory with its metadata, raises OSError like os.listdir"""
+        images = []
+        paths = set()
+        for file in sorted(os.listdir(directory)):
+            path = os.path.join(directory, file)
+            if file.startswith(".") or file.endswith((BMAP_SUFFIX, ".bmap", ".tmp")) or not os.path.isfile(path):
+                continue
+            entry = self.entry(path)
+            if entry is not None:
+                images.append(entry)
+                paths.add(entry["path"])
+        with self._lock:
+            # Forget images that have been deleted from this directory
+            directory = os.path.abspath(directory)
+            gone = [path for path in self._data if os.path.dirname(path) == directory and path not in paths]
+            for path in gone:
+                del self._data[path]
+            if len(gone) > 0:
+                self._save()
+        return images
+
+    def entry(self, path: str) -> Optional[dict]:
+        """Metadata of an image, indexing it if needed, None if it cannot be read"""
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._data.get(path)
+        if entry is None or entry.get("size") != stat.st_size or entry.get("mtime_ns") != stat.st_mtime_ns:
+            try:
+                entry = self._index(path, stat)
+            except OSError as e:
+                logging.warning(f"Cannot index image {path}", exc_info=e)
+                return None
+            self.set(path, entry)
+        if entry.get("checksum") is None:
+            self._hash_later(path, entry["mtime_ns"])
+        # Sidecars change on their own, without touching the image
+        return {**entry, "bmap": find_bmap(path) is not None}
+
+    def _index(self, path: str, stat: os.stat_result) -> dict:
+        compression = compression_of(path)
+        table = parse_partition_table(self._read_head(path, compression))
+        last_linux = table.last_linux_partition()
+        return {
+            "path": path,
+            "name": os.path.basename(path),
+            "size": stat.st_size,
+            "mtime": int(stat.st_mtime),
+            "mtime_ns": stat.st_mtime_ns,
+            "compression": compression,
+            "checksum": None,
+            "checksum_type": self.checksum,
+            "partition_table": table.table_type,
+            "partitions": [partition.serialize() for partition in table.partitions],
+            "grow_partition": last_linux.number if last_linux is not None else None,
+        }
+
+    @staticmethod
+    def _read_head(path: str, compression: Optional[str]) -> bytes:
+        if compression is None:
+            with open(path, "rb") as f:
+                return f.read(PARTITION_TABLE_HEAD)
+        reader = DecompressingReader(path, PARTITION_TABLE_HEAD, 1)
+        reader.start()
+        try:
+            block = reader.get()
+            return bytes(block) if block is not None else b""
+        finally:
+            reader.close()
+
+    def _hash_later(self, path: str, mtime_ns: int):
+        with self._lock:
+            if (path, mtime_ns) in self._hashing:
+                return
+            self._hashing.add((path, mtime_ns))
+            self._pending.put((path, mtime_ns))
+            if self._hasher is None or not self._hasher.is_alive():
+                self._hasher = threading.Thread(target=self._hash_pending, daemon=True)
+                self._hasher.start()
+
+    def _hash_pending(self):
+        while True:
+            try:
+                path, mtime_ns = self._pending.get(timeout=1)
+            except queue.Empty:
+                with self._lock:
+                    # Or something queued right now would wait for a thread that is gone
+                    if self._pending.empty():
+                        self._hasher = None
+                        return
+                continue
+            try:
+                self._hash(path)
+            finally:
+                with self._lock:
+                    self._hashing.discard((path, mtime_ns))
+
+    def _hash(self, path: str):
+        with self._lock:
+            entry = self._data.get(path)
+        if entry is None or entry.get("checksum") is not None:
+            return
+        try:
+            digest = self.hash_file(path)
+        except OSError as e:
+            logging.warning(f"Cannot hash image {path}", exc_info=e)
+            return
+        with self._lock:
+            current = self._data.get(path)
+            # Unless it changed in the meantime
+            if current is not None and current.get("mtime_ns") == entry["mtime_ns"] and current.get("size") == entry["size"]:
+                self.set(path, {**current, "checksum": digest})
+
+    def hash_file(self, path: str, should_continue: Callable[[], bool] = lambda: True) -> Optional[str]:
+        digest = hashlib.new(self.checksum)
+        with open(path, "rb") as f:
+            while should_continue():
+                data = f.read(self.chunk_size)
+                if len(data) == 0:
+                    return digest.hexdigest()
+                digest.update(data)
+        return None
@@ -0,0 +1,525 @@
+import errno
+import fcntl
+import hashlib
+import os
+import struct
+import time
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence
+
+from bmap import BlockMap
+from decompress import DecompressingReader, compression_of
+from erase_engine import MiB, aligned_buffer, open_direct, logical_sector_size, same_data
+
+COPY_AUTO = "auto"
+COPY_BUFFERED = "buffered"
+# Zero-copy methods, from the best one: the data never leaves the kernel
+KERNEL_COPY_METHODS = ("copy_file_range", "sendfile", "splice")
+COPY_METHODS = (COPY_AUTO, COPY_BUFFERED) + KERNEL_COPY_METHODS
+# What the kernel says when a method cannot be used with these two files
+_UNSUPPORTED = (errno.EINVAL, errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF)
+_F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+
+# What to do with holes and zero blocks of the image: write them, skip them because the disk is already
+# zeroed, or ask the disk to zero them (BLKZEROOUT) instead of sending the zeroes
+ZEROES_WRITE = "write"
+ZEROES_SKIP = "skip"
+ZEROES_ZEROOUT = "zeroout"
+ZEROES_MODES = (ZEROES_WRITE, ZEROES_SKIP, ZEROES_ZEROOUT)
+# _IO(0x12, 127) from linux/fs.h
+_BLKZEROOUT = 0x127F
+
+
+class ImageError(Exception):
+    pass
+
+
+def supports_write_zeroes(path: str, sysfs_root: str = "/sys") -> bool:
+    """Whether the disk can zero a range by itself, without receiving the zeroes"""
+    name = os.path.basename(os.path.realpath(path))
+    try:
+        with open(os.path.join(sysfs_root, "class", "block", name, "queue", "write_zeroes_max_bytes")) as f:
+            return int(f.read().strip()) > 0
+    except (OSError, ValueError):
+        return False
+
+
+class ImageProgress:
+    def __init__(self, bytes_done: int, bytes_total: int, elapsed: float, bytes_written: int = 0):
+        # Bytes of the image copied so far
+        self.bytes_done = bytes_done
+        self.bytes_total = bytes_total
+        self.elapsed = elapsed
+        # Bytes actually sent to the disk, holes and zeroes that were skipped are not counted
+        self.bytes_written = bytes_written
+
+    @property
+    def throughput(self) -> float:
+        if self.elapsed <= 0:
+            return 0.0
+        return self.bytes_done / self.elapsed
+
+
+class ImageResult:
+    def __init__(self, completed: bool, size: int, elapsed: float, method: Optional[str] = None, bytes_written: int = 0, digest: Optional[str] = None):
+        self.completed = completed
+        self.size = size
+        self.elapsed = elapsed
+        # The copy method in use at the end
+        self.method = method
+        self.bytes_written = bytes_written
+        # Hex digest of the whole image, if asked for a checksum
+        self.digest = digest
+
+    @property
+    def throughput(self) -> float:
+        if self.elapsed <= 0:
+            return 0.0
+        return self.size / self.elapsed
+
+
+class ImageWriter:
+    """Copy an image to a disk.
+
+    The image is read into one preallocated buffer of block_size bytes at a time and written to the
+    disk with O_DIRECT, so neither the reads nor the writes allocate anything and the page cache is not
+    filled with data that will never be read again. O_DIRECT needs writes aligned to the logical sector
+    size, the unaligned tail of the image (if any) goes through a normal file descriptor. The disk is
+    flushed with fsync at the end, so a completed copy is really on the disk.
+
+    With method="auto" a zero-copy method (copy_file_range, sendfile, splice through a pipe) is tried
+    first, falling back to the next one if the kernel does not support it for these files and finally
+    to the buffered copy. Every method copies block_size bytes at a time, to report progress and to be
+    stopped in the middle.
+
+    Unless zeroes="write", holes in the image (found with SEEK_DATA and SEEK_HOLE) and zero_block sized
+    blocks of zeroes are skipped or zeroed by the disk. Only the buffered copy sees the data, so that is
+    the only method used by "auto" in that case.
+
+    With a block map only its ranges are copied and everything else on the disk is left as it is, like
+    bmaptool does. verify() reads ranges back from the disk and compares their checksums.
+
+    Compressed images (.gz, .xz, .zst) are decompressed by a DecompressingReader while writing, up to
+    queue_depth blocks ahead of the disk. They can only go through the buffered copy, and the total
+    size is estimated from how much of the compressed file has been read. A stream (a FanoutStream, to
+    write the image read once to many disks) is copied the same way.
+
+    With a checksum (any hashlib algorithm, blake2b is the fast one) the image is hashed while it is
+    copied, holes included, and the result has its digest: verify([(0, size, digest)]) reads the disk
+    back to compare, without reading the image twice. Only the buffered copy sees the data to hash it.
+    """
+
+    def __init__(
+        self,
+        source: str,
+        target: str,
+        block_size: int = 8 * MiB,
+        progress_interval: float = 1.0,
+        method: str = COPY_AUTO,
+        zeroes: str = ZEROES_WRITE,
+        zero_block: int = 1 * MiB,
+        bmap: Optional[BlockMap] = None,
+        queue_depth: int = 4,
+        stream=None,
+        checksum: Optional[str] = None,
+    ):
+        if method not in COPY_METHODS:
+            raise ValueError(f"Unknown copy method {method}, use one of {', '.join(COPY_METHODS)}")
+        self.compression = compression_of(source)
+        if (self.compression is not None or stream is not None) and method not in (COPY_AUTO, COPY_BUFFERED):
+            raise ValueError(f"Compressed and shared images can only be copied with {COPY_BUFFERED}")
+        if (self.compression is not None or stream is not None) and bmap is not None:
+            raise ValueError("Block maps are not supported for compressed and shared images")
+        if checksum is not None and method not in (COPY_AUTO, COPY_BUFFERED):
+            raise ValueError(f"Images can only be hashed with {COPY_BUFFERED}")
+        if zeroes not in ZEROES_MODES:
+            raise ValueError(f"Unknown zeroes mode {zeroes}, use one of {', '.join(ZEROES_MODES)}")
+        self.source = source
+        self.method = method
+        self.zeroes = zeroes
+        self.target = target
+        self.sector_size = logical_sector_size(target)
+        self.block_size = max(self.sector_size, block_size - block_size % self.sector_size)
+        self.zero_block = min(self.block_size, max(self.sector_size, zero_block - zero_block % self.sector_size))
+        self.progress_interval = progress_interval
+        self.bmap = bmap
+        self.queue_depth = queue_depth
+        self.stream = stream
+        # Block maps have checksums of their own
+        self.checksum = checksum if bmap is None else None
+        self.direct = False
+
+        self._bytes_done = 0
+        self._bytes_written = 0
+        self._size = 0
+        self._start = 0.0
+        self._last_progress = 0.0
+        self._buffer = None
+        self._zero_buffer = None
+        self._hash = None
+
+    def methods(self) -> Sequence[str]:
+        if self.method == COPY_AUTO:
+            if self.zeroes != ZEROES_WRITE or self.compression is not None or self.stream is not None or self.checksum is not None:
+                return (COPY_BUFFERED,)
+            available = [method for method in KERNEL_COPY_METHODS if hasattr(os, method)]
+            return available + [COPY_BUFFERED]
+        return (self.method,)
+
+    def run(
+        self,
+        should_continue: Callable[[], bool] = lambda: True,
+        on_progress: Optional[Callable[[ImageProgress], None]] = None,
+        throttle: Optional[Callable[[int], bool]] = None,
+    ) -> ImageResult:
+        """throttle is called with the bytes about to be written and may sleep, returning False stops the copy"""
+        self._bytes_done = 0
+        self._bytes_written = 0
+        self._start = time.monotonic()
+        self._last_progress = self._start
+        self._buffer = memoryview(aligned_buffer(self.block_size))
+        self._zero_buffer = memoryview(aligned_buffer(self.block_size))
+        self._hash = hashlib.new(self.checksum) if self.checksum is not None else None
+        completed = False
+        method = None
+        if self.compression is not None or self.stream is not None:
+            target_fd, self.direct = open_direct(self.target, os.O_WRONLY)
+            try:
+                completed = self._copy_stream(target_fd, should_continue, on_progress, throttle)
+                os.fsync(target_fd)
+            finally:
+                os.close(target_fd)
+            if completed and on_progress:
+                on_progress(self._progress())
+            return self._result(completed, COPY_BUFFERED)
+
+        source_fd = os.open(self.source, os.O_RDONLY)
+        try:
+            self._size = os.lseek(source_fd, 0, os.SEEK_END)
+            for method in self.methods():
+                if method == COPY_BUFFERED:
+                    target_fd, self.direct = open_direct(self.target, os.O_WRONLY)
+                else:
+                    # Zero-copy goes through the page cache, O_DIRECT would only make it fail
+                    target_fd = os.open(self.target, os.O_WRONLY)
+                    self.direct = False
+                try:
+                    outcome = self._copy_extents(method, source_fd, target_fd, should_continue, on_progress, throttle)
+                    os.fsync(target_fd)
+                finally:
+                    os.close(target_fd)
+                if outcome is not None:
+                    completed = outcome
+                    break
+        finally:
+            os.close(source_fd)
+        if completed and on_progress:
+            on_progress(self._progress())
+        return self._result(completed, method)
+
+    def _result(self, completed: bool, method: Optional[str]) -> ImageResult:
+        digest = self._hash.hexdigest() if completed and self._hash is not None else None
+        return ImageResult(completed, self._bytes_done, time.monotonic() - self._start, method, self._bytes_written, digest)
+
+    def _progress(self) -> ImageProgress:
+        return ImageProgress(self._bytes_done, self._size, time.monotonic() - self._start, self._bytes_written)
+
+    def _report(self, on_progress):
+        now = time.monotonic()
+        if on_progress and now - self._last_progress >= self.progress_interval:
+            self._last_progress = now
+            on_progress(self._progress())
+
+    def extents(self, fd: int, start: int = 0) -> Iterator[tuple[int, int, bool]]:
+        """(offset, length, has data) from start to the end of the image, holes have no data"""
+        if self.bmap is not None:
+            for offset, length, data in self._bmap_extents():
+                if offset + length > start:
+                    yield max(offset, start), offset + length - max(offset, start), data
+            return
+        if self.zeroes == ZEROES_WRITE:
+            # Holes read as zeroes and get written, no need to look for them
+            if start < self._size:
+                yield start, self._size - start, True
+            return
+        offset = start
+        while offset < self._size:
+            try:
+                data = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    # No SEEK_DATA here, everything is data
+                    yield offset, self._size - offset, True
+                    return
+                # Nothing but a hole until the end
+                data = self._size
+            data = min(data, self._size)
+            if data > offset:
+                yield offset, data - offset, False
+            if data >= self._size:
+                return
+            hole = min(os.lseek(fd, data, os.SEEK_HOLE), self._size)
+            yield data, hole - data, True
+            offset = hole
+
+    def _bmap_extents(self) -> Iterator[tuple[int, int, bool]]:
+        offset = 0
+        for range_offset, length, _ in self.bmap.byte_ranges():
+            if range_offset > offset:
+                yield offset, range_offset - offset, False
+            yield range_offset, length, True
+            offset = range_offset + length
+        if offset < self._size:
+            yield offset, self._size - offset, False
+
+    def _copy_extents(self, method: str, source_fd: int, target_fd: int, should_continue, on_progress, throttle) -> Optional[bool]:
+        """Copy from where the previous method stopped, None if this method is not supported"""
+        for offset, length, data in self.extents(source_fd, self._bytes_done):
+            if not data:
+                if not should_continue():
+                    return False
+                if self.bmap is None:
+                    # Not mapped by a block map means it does not matter what is there
+                    self._zero(target_fd, offset, length)
+                if self._hash is not None:
+                    self._hash_zeroes(length)
+                self._bytes_done += length
+                self._report(on_progress)
+                continue
+            if method == COPY_BUFFERED:
+                outcome = self._copy(source_fd, target_fd, offset, length, should_continue, on_progress, throttle)
+            else:
+                outcome = self._copy_kernel(method, source_fd, target_fd, offset, length, should_continue, on_progress, throttle)
+            if outcome is not True:
+                return outcome
+        return True
+
+    def _copy(self, source_fd: int, target_fd: int, offset: int, length: int, should_continue, on_progress, throttle) -> bool:
+        end = offset + length
+        while offset < end:
+            if not should_continue():
+                return False
+            read = self._fill(source_fd, self._buffer[: min(len(self._buffer), end - offset)], offset)
+            if read == 0:
+                # The image got shorter
+                return True
+            chunk = self._buffer[:read]
+            if self._hash is not None:
+                self._hash.update(chunk)
+            runs = self._runs(chunk)
+            if throttle is not None and not throttle(sum(run_length for _, run_length, data in runs if data)):
+                return False
+            self._write_runs(target_fd, chunk, offset, runs)
+            offset += read
+            self._bytes_done += read
+            self._report(on_progress)
+        return True
+
+    def _copy_stream(self, target_fd: int, should_continue, on_progress, throttle) -> bool:
+        reader = self.stream
+        if reader is None:
+            reader = DecompressingReader(self.source, self.block_size, self.queue_depth)
+            reader.start()
+        try:
+            while True:
+                if not should_continue():
+                    return False
+                chunk = reader.get(should_continue)
+                if chunk is None:
+                    if not should_continue():
+                        return False
+                    self._size = self._bytes_done
+                    return True
+                try:
+                    if self._hash is not None:
+                        self._hash.update(chunk)
+                    runs = self._runs(chunk)
+                    if throttle is not None and not throttle(sum(run_length for _, run_length, data in runs if data)):
+                        return False
+                    self._write_runs(target_fd, chunk, self._bytes_done, runs)
+                finally:
+                    reader.release(chunk)
+                self._bytes_done += len(chunk)
+                self._size = reader.estimated_size(self._bytes_done)
+                self._report(on_progress)
+        finally:
+            reader.close()
+
+    def _write_runs(self, fd: int, chunk: memoryview, offset: int, runs: List[tuple[int, int, bool]]):
+        for run_offset, run_length, data in runs:
+            if data:
+                self._write(fd, chunk[run_offset : run_offset + run_length], offset + run_offset)
+                self._bytes_written += run_length
+            else:
+                self._zero(fd, offset + run_offset, run_length)
+
+    def _hash_zeroes(self, length: int):
+        while length > 0:
+            step = min(len(self._zero_buffer), length)
+            self._hash.update(self._zero_buffer[:step])
+            length -= step
+
+    def _runs(self, chunk: memoryview) -> List[tuple[int, int, bool]]:
+        """Split a chunk in (offset, length, has data) runs of data and zero blocks"""
+        if self.zeroes == ZEROES_WRITE:
+            return [(0, len(chunk), True)]
+        runs = []
+        for offset in range(0, len(chunk), self.zero_block):
+            length = min(self.zero_block, len(chunk) - offset)
+            data = not same_data(chunk[offset : offset + length], self._zero_buffer[:length])
+            if len(runs) > 0 and runs[-1][2] == data:
+                runs[-1] = (runs[-1][0], runs[-1][1] + length, data)
+            else:
+                runs.append((offset, length, data))
+        return runs
+
+    def _zero(self, fd: int, offset: int, length: int):
+        if self.zeroes == ZEROES_SKIP:
+            return
+        if self.zeroes == ZEROES_ZEROOUT and offset % 512 == 0 and length % 512 == 0:
+            try:
+                fcntl.ioctl(fd, _BLKZEROOUT, struct.pack("QQ", offset, length))
+                return
+            except OSError:
+                # Not a block device, or the kernel does not like the range
+                pass
+        end = offset + length
+        while offset < end:
+            step = min(len(self._zero_buffer), end - offset)
+            self._write(fd, self._zero_buffer[:step], offset)
+            self._bytes_written += step
+            offset += step
+
+    def _copy_kernel(self, method: str, source_fd: int, target_fd: int, offset: int, length: int, should_continue, on_progress, throttle) -> Optional[bool]:
+        """Copy with a zero-copy method, None if the kernel does not support it here"""
+        pipe = os.pipe() if method == "splice" else None
+        end = offset + length
+        try:
+            if pipe is not None:
+                try:
+                    # The default 64 KiB pipe means a lot of syscalls
+                    fcntl.fcntl(pipe[1], _F_SETPIPE_SZ, min(self.block_size, 1 * MiB))
+                except OSError:
+                    pass
+            while self._bytes_done < end:
+                if not should_continue():
+                    return False
+                chunk = min(self.block_size, end - self._bytes_done)
+                if throttle is not None and not throttle(chunk):
+                    return False
+                copied = 0
+                while copied < chunk:
+                    try:
+                        step = self._kernel_step(method, source_fd, target_fd, self._bytes_done, chunk - copied, pipe)
+                    except OSError as e:
+                        if e.errno in _UNSUPPORTED:
+                            return None
+                        raise
+                    if step == 0:
+                        # The image got shorter
+                        return True
+                    copied += step
+                    self._bytes_done += step
+                    self._bytes_written += step
+                self._report(on_progress)
+            return True
+        finally:
+            if pipe is not None:
+                os.close(pipe[0])
+                os.close(pipe[1])
+
+    def _kernel_step(self, method: str, source_fd: int, target_fd: int, offset: int, length: int, pipe) -> int:
+        if method == "copy_file_range":
+            return os.copy_file_range(source_fd, target_fd, length, offset, offset)
+        if method == "sendfile":
+            # sendfile writes at the current position of the target
+            os.lseek(target_fd, offset, os.SEEK_SET)
+            return os.sendfile(target_fd, source_fd, offset, length)
+        pipe_read, pipe_write = pipe
+        filled = os.splice(source_fd, pipe_write, length, offset_src=offset)
+        moved = 0
+        try:
+            while moved < filled:
+                moved += os.splice(pipe_read, target_fd, filled - moved, offset_dst=offset + moved)
+        except OSError:
+            # Empty the pipe, the next method will copy this part again
+            os.read(pipe_read, filled - moved)
+            raise
+        return moved
+
+    def verify(
+        self,
+        ranges: Iterable[tuple[int, int, str]],
+        new_hash: Callable,
+        should_continue: Callable[[], bool] = lambda: True,
+        on_progress: Optional[Callable[[ImageProgress], None]] = None,
+    ) -> Optional[List[tuple[int, int]]]:
+        """Read (offset, length, expected hex digest) ranges back from the disk, return the (offset, length) of those that differ, None if stopped"""
+        ranges = list(ranges)
+        total = sum(length for _, length, _ in ranges)
+        buffer = memoryview(aligned_buffer(self.block_size))
+        start = time.monotonic()
+        self._last_progress = start
+        verified = 0
+        mismatches = []
+        fd, direct = open_direct(self.target, os.O_RDONLY)
+        try:
+            for offset, length, expected in ranges:
+                digest = new_hash()
+                done = 0
+                while done < length:
+                    if not should_continue():
+                        return None
+                    step = min(len(buffer), length - done)
+                    # O_DIRECT reads whole sectors, the image may end in the middle of one
+                    aligned = -(-step // self.sector_size) * self.sector_size if direct else step
+                    read = self._fill(fd, buffer[:aligned], offset + done)
+                    if read < step:
+                        raise OSError(f"Short read at offset {offset + done}")
+                    digest.update(buffer[:step])
+                    done += step
+                    verified += step
+                    now = time.monotonic()
+                    if on_progress and now - self._last_progress >= self.progress_interval:
+                        self._last_progress = now
+                        on_progress(ImageProgress(verified, total, now - start))
+                if digest.hexdigest() != expected:
+                    mismatches.append((offset, length))
+        finally:
+            os.close(fd)
+        if on_progress:
+            on_progress(ImageProgress(verified, total, time.monotonic() - start))
+        return mismatches
+
+    @staticmethod
+    def _fill(fd: int, view: memoryview, offset: int) -> int:
+        """Read until the buffer is full or the image ends, return how much was read"""
+        filled = 0
+        while filled < len(view):
+            read = os.preadv(fd, [view[filled:]], offset + filled)
+            if read == 0:
+                break
+            filled += read
+        return filled
+
+    def _write(self, fd: int, data: memoryview, offset: int):
+        tail = len(data) % self.sector_size if self.direct else 0
+        if tail > 0:
+            # Only the last block of the image can be unaligned
+            self._pwrite(fd, data[: len(data) - tail], offset)
+            plain_fd = os.open(self.target, os.O_WRONLY)
+            try:
+                self._pwrite(plain_fd, data[len(data) - tail :], offset + len(data) - tail)
+                os.fsync(plain_fd)
+            finally:
+                os.close(plain_fd)
+        else:
+            self._pwrite(fd, data, offset)
+
+    @staticmethod
+    def _pwrite(fd: int, data: memoryview, offset: int):
+        while len(data) > 0:
+            written = os.pwrite(fd, data, offset)
+            if written <= 0:
+                raise OSError(f"Short write at offset {offset}")
+            data = data[written:]
+            offset += written
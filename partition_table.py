@@ -0,0 +1,116 @@
+import fcntl
+import os
+import struct
+import uuid
+from typing import List, Optional
+
+# GPT and MBR type of the partitions growpart, e2fsck and resize2fs work on, same as lsblk says
+LINUX_GPT_TYPE = "0fc63daf-8483-4772-8e79-3d69d8477de4"
+LINUX_MBR_TYPE = "0x83"
+_GPT_SIGNATURE = b"EFI PART"
+_MBR_PROTECTIVE = 0xEE
+_MBR_EXTENDED = (0x05, 0x0F, 0x85)
+# _IO(0x12, 95) from linux/fs.h
+_BLKRRPART = 0x125F
+
+
+class Partition:
+    def __init__(self, number: int, start: int, size: int, part_type: str, name: str = ""):
+        self.number = number
+        # In bytes
+        self.start = start
+        self.size = size
+        self.part_type = part_type
+        self.name = name
+
+    @property
+    def linux(self) -> bool:
+        return self.part_type in (LINUX_GPT_TYPE, LINUX_MBR_TYPE)
+
+    def serialize(self) -> dict:
+        return {"number": self.number, "start": self.start, "size": self.size, "type": self.part_type, "name": self.name, "linux": self.linux}
+
+
+class PartitionTable:
+    def __init__(self, table_type: Optional[str], partitions: List[Partition], sector_size: int = 512):
+        # "gpt" or "dos" like lsblk PTTYPE, None if there is no partition table
+        self.table_type = table_type
+        self.partitions = partitions
+        self.sector_size = sector_size
+
+    def last_linux_partition(self) -> Optional[Partition]:
+        linux = [partition for partition in self.partitions if partition.linux]
+        return max(linux, key=lambda partition: partition.number) if len(linux) > 0 else None
+
+
+def parse_partition_table(head: bytes) -> PartitionTable:
+    """Partitions of an image, from its first bytes (a MiB is plenty).
+
+    GPT comes first, since it has a protective MBR in front of it. Logical partitions inside an MBR
+    extended one are not listed, they would need reading all over the image.
+    """
+    for sector_size in (512, 4096):
+        if head[sector_size : sector_size + 8] == _GPT_SIGNATURE:
+            return PartitionTable("gpt", _parse_gpt(head, sector_size), sector_size)
+    if len(head) >= 512 and head[510:512] == b"\x55\xaa":
+        partitions = _parse_mbr(head)
+        if partitions is not None:
+            return PartitionTable("dos", partitions)
+    return PartitionTable(None, [])
+
+
+def _parse_gpt(head: bytes, sector_size: int) -> List[Partition]:
+    header = head[sector_size : sector_size + 92]
+    entries_lba, entries_count, entry_size = struct.unpack_from("<QII", header, 72)
+    partitions = []
+    offset = entries_lba * sector_size
+    for i in range(entries_count):
+        entry = head[offset + i * entry_size : offset + (i + 1) * entry_size]
+        if len(entry) < 128:
+            # The rest of the entries are not in the head
+            break
+        if entry[:16] == bytes(16):
+            # Unused
+            continue
+        first, last = struct.unpack_from("<QQ", entry, 32)
+        name = entry[56:128].decode("utf-16-le", errors="replace").rstrip("\x00")
+        part_type = str(uuid.UUID(bytes_le=bytes(entry[:16])))
+        partitions.append(Partition(i + 1, first * sector_size, (last - first + 1) * sector_size, part_type, name))
+    return partitions
+
+
+def _parse_mbr(head: bytes) -> Optional[List[Partition]]:
+    partitions = []
+    for i in range(4):
+        status, part_type, start, sectors = struct.unpack_from("<B3xB3xII", head, 446 + i * 16)
+        if status not in (0x00, 0x80):
+            # Not a partition table, just a boot sector with a signature
+            return None
+        if part_type == 0 or sectors == 0 or part_type in _MBR_EXTENDED:
+            continue
+        if part_type == _MBR_PROTECTIVE:
+            # GPT with a sector size we do not know about
+            return None
+        partitions.append(Partition(i + 1, start * 512, sectors * 512, f"0x{part_type:02x}"))
+    return partitions
+
+
+def partition_path(disk: str, number: int) -> str:
+    # /dev/sda1, but /dev/nvme0n1p1 and /dev/mmcblk0p1
+    return f"{disk}p{number}" if disk[-1].isdigit() else f"{disk}{number}"
+
+
+def reread_partition_table(disk: str) -> bool:
+    """Ask the kernel to read the partition table again, like blockdev --rereadpt. Needs root."""
+    try:
+        fd = os.open(disk, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        fcntl.ioctl(fd, _BLKRRPART)
+        return True
+    except OSError:
+        # Not a block device, in use or not root
+        return False
+    finally:
+        os.close(fd)
@@ -5,6 +5,7 @@ Created on Fri Jul 30 10:54:18 2021
 
 @author: il_palmi
 """
+
 import json
 import os.path
 import sys
@@ -261,6 +262,10 @@ class PinoloMainWindow(QMainWindow, Ui_MainWindow):
         drives = self.drivesTableViewModel.get_selected_drives(rows)
 
         for drive in drives:
+            if drive.code_pending:
+                if not standard_procedure:
+                    warning_dialog(f"The drive {drive.name} is still being looked up on TARALLO, try again in a moment.", dialog_type="ok")
+                continue
             if not standard_procedure:
                 if drive.tarallo_id is not None:
                     warning_dialog(f"The drive {drive.name} already has a TARALLO id.", dialog_type="ok")
@@ -506,13 +511,15 @@ class PinoloMainWindow(QMainWindow, Ui_MainWindow):
                     self.queueTableViewModel.update_table(data)
 
             case "queued_umount":
-                self.send_msg("get_disks")
+                self.send_msg(self.drivesTableViewModel.get_disks_command())
 
             case "get_disks":
-                if self.drivesTableViewModel.rowCount() > 0:
-                    self.drivesTableViewModel.update_data(command_data)
-                else:
-                    self.drivesTableViewModel.load_data(command_data)
+                self.drivesTableViewModel.load_data(command_data)
+
+            case "disks_delta":
+                if not self.drivesTableViewModel.apply_delta(command_data):
+                    # Some changes were sent to other clients only, or the server restarted
+                    self.send_msg(self.drivesTableViewModel.get_disks_command())
 
             # Standalone smartctl (not the queued/standard procedure/button one)
             case "smartctl":
@@ -572,6 +579,7 @@ class Job:
         self.type = self._format_process_type(command_data["command"])
         self.status = self._parse_status(command_data)
         self.progress: float = command_data["percentage"]
+        self.speed = self._format_speed(command_data.get("throughput"))
 
         self.status_icon = None
 
@@ -582,22 +590,36 @@ class Job:
     def update(self, command_data: dict):
         self.status = self._parse_status(command_data)
         self.progress = command_data["percentage"]
-        self._update_eta()
+        self.speed = self._format_speed(command_data.get("throughput"))
+        self._update_eta(command_data)
 
-    def _update_eta(self):
+    def _update_eta(self, command_data: dict):
         elapsed_time = time.time() - self.start_time
-        if 0 < self.progress < 100:
+        throughput = command_data.get("throughput")
+        if throughput and command_data.get("bytes_total") and 0 < self.progress < 100:
+            # Based on the current speed, which the server knows better
+            eta = (command_data["bytes_total"] - command_data["bytes_done"]) / throughput
+            self.eta = time.strftime("%H:%M:%S", time.gmtime(eta))
+        elif 0 < self.progress < 100:
             predicted_total_time = elapsed_time / (self.progress / 100)
             eta = predicted_total_time - elapsed_time
             self.eta = time.strftime("%H:%M:%S", time.gmtime(eta))
         else:
             self.eta = None
 
+    @staticmethod
+    def _format_speed(throughput: Optional[float]):
+        if throughput is None:
+            return None
+        return f"{format_size(int(throughput), False, False)}/s"
+
     @staticmethod
     def _format_process_type(command: str):
         match command:
             case "queued_badblocks":
                 return "Erase"
+            case "queued_secure_erase":
+                return "Secure erase"
             case "queued_smartctl":
                 return "Smart check"
             case "queued_cannolo":
@@ -632,7 +654,7 @@ class QueueTableModel(QAbstractTableModel):
         self.parent = parent
         super().__init__()
         self.jobs: List[Job] = []
-        self.header_labels = ["Drive", "Process", "Status", "Eta", "Progress"]
+        self.header_labels = ["Drive", "Process", "Status", "Eta", "Speed", "Progress"]
 
     def rowCount(self, parent=...) -> int:
         return len(self.jobs)
@@ -660,6 +682,8 @@ class QueueTableModel(QAbstractTableModel):
                         return job.status
                     case "Eta":
                         return job.eta
+                    case "Speed":
+                        return job.speed
                     case "Progress":
                         return job.progress
 
@@ -803,11 +827,14 @@ class Drive:
         self.serial = drive_data["serial"]
         self.size = drive_data["size"]
         self.tarallo_id = drive_data["code"]
+        # Still looking it up on Tarallo
+        self.code_pending = drive_data.get("code_pending", False)
 
     def update(self, drive_data: dict):
         self.mounted = True if drive_data["mountpoint"] else False
         self.mountpoints = drive_data["mountpoint"] if self.mounted else None
         self.tarallo_id = drive_data["code"]
+        self.code_pending = drive_data.get("code_pending", False)
 
 
 class DrivesTableModel(QAbstractTableModel):
@@ -815,6 +842,9 @@ class DrivesTableModel(QAbstractTableModel):
         super().__init__()
         self.parent = parent
         self.drives: List[Drive] = []
+        # Latest version of the disks on the server that is in the table, and the run of the server it is from
+        self.version = 0
+        self.epoch = None
         self.header_labels = ["Drive", "Tarallo ID", "Size"]
 
         if QIcon.hasThemeIcon("data-warning"):
@@ -843,7 +873,7 @@ class DrivesTableModel(QAbstractTableModel):
                     case "Drive":
                         return drive.name
                     case "Tarallo ID":
-                        return drive.tarallo_id
+                        return "pending" if drive.code_pending else drive.tarallo_id
                     case "Size":
                         return format_size(drive.size, True, False)
             case Qt.DecorationRole:
@@ -860,19 +890,53 @@ class DrivesTableModel(QAbstractTableModel):
                 return None
 
     def load_data(self, command_data: List[dict]):
+        """Add new drives and update the ones already in the table, by path"""
+        rows = {drive.name: row for row, drive in enumerate(self.drives)}
         for drive_data in command_data:
-            self.beginInsertRows(QModelIndex(), len(self.drives), len(self.drives))
-            self.drives.append(Drive(drive_data))
-            self.endInsertRows()
+            row = rows.get(drive_data["path"])
+            if row is None:
+                rows[drive_data["path"]] = len(self.drives)
+                self.beginInsertRows(QModelIndex(), len(self.drives), len(self.drives))
+                self.drives.append(Drive(drive_data))
+                self.endInsertRows()
+            else:
+                self.drives[row].update(drive_data)
+                self.dataChanged.emit(self.index(row, 0), self.index(row, self.columnCount() - 1))
+            self.version = max(self.version, drive_data.get("version", 0))
+            self.epoch = drive_data.get("epoch", self.epoch)
         self._resize_columns()
 
-    def update_data(self, command_data: List[dict]):
-        for drive_data in command_data:
-            serial = drive_data["serial"]
-            for drive in self.drives:
-                if drive.serial == serial:
-                    drive.update(drive_data)
-                    continue
+    def get_disks_command(self) -> str:
+        if self.rowCount() > 0 and self.epoch is not None:
+            # Only what changed, the rest is already in the table
+            return f"get_disks since={self.version} epoch={self.epoch}"
+        return "get_disks"
+
+    def apply_delta(self, delta: dict) -> bool:
+        """Disks added, changed or removed (by path) on the server since delta["since"].
+
+        False if the table is missing something from before that, and get_disks_command should be sent.
+        """
+        if self.epoch is not None and delta.get("epoch") != self.epoch:
+            # The server restarted, versions start over
+            self.clear()
+            return False
+        version = self.version
+        complete = delta.get("since", 0) <= version
+        for path in delta.get("removed", []):
+            for row, drive in enumerate(self.drives):
+                if drive.name == path:
+                    self.beginRemoveRows(QModelIndex(), row, row)
+                    del self.drives[row]
+                    self.endRemoveRows()
+                    break
+        # Added may be known already and changed may not be, after a gap
+        self.load_data(delta.get("changed", []) + delta.get("added", []))
+        # Not past what this client has never seen
+        self.version = max(version, delta.get("version", 0)) if complete else version
+        self.epoch = delta.get("epoch", self.epoch)
+        self.dataChanged.emit(self.index(0, 0), self.index(self.rowCount() - 1, self.columnCount() - 1))
+        return complete
 
     def get_selected_drives(self, rows: List[QModelIndex]) -> List[Drive]:
         if rows is None:
@@ -889,6 +953,8 @@ class DrivesTableModel(QAbstractTableModel):
     def clear(self):
         self.beginResetModel()
         self.drives.clear()
+        self.version = 0
+        self.epoch = None
         self.endResetModel()
 
 
@@ -0,0 +1,183 @@
+import os
+import re
+import select
+from typing import Optional
+
+
+class ProgressParser:
+    """Turns the progress output of a tool into something that can be sent to clients.
+
+    parse() is called only on the latest complete frame of each chunk read from the pipe, scan() on the
+    whole chunk: override scan() to track phase changes that may be printed between two progress frames.
+    Tools that draw a bar one character at a time never complete a frame while drawing it: with
+    partial_frames, parse() also gets what has been printed of the current one.
+    """
+
+    partial_frames = False
+
+    def scan(self, text: str):
+        pass
+
+    def parse(self, frame: str):
+        raise NotImplementedError
+
+
+class BadblocksProgress:
+    def __init__(self, percent: float, errors: int, verified: float = 0.0):
+        self.percent = percent
+        self.errors = errors
+        # Fraction of the blocks that have been written and read back with every pattern
+        self.verified = verified
+
+
+class BadblocksProgressParser(ProgressParser):
+    # e.g. "Testing with pattern 0x00:  12.34% done, 0:05 elapsed. (0/0/0 errors)"
+    _PROGRESS = re.compile(r"(\d+(?:\.\d+)?)% done, [^(]*\((\d+)/(\d+)/(\d+) errors\)")
+
+    def __init__(self, patterns: int = 1):
+        # Each pattern is a write pass and a read & compare pass
+        self._phases = 2 * max(patterns, 1)
+        self._phase = -1
+        self.errors = -1
+
+    def scan(self, text: str):
+        self._phase += text.count("Testing with pattern") + text.count("Reading and comparing")
+
+    def parse(self, frame: str) -> Optional[BadblocksProgress]:
+        match = self._PROGRESS.search(frame)
+        if match is None:
+            # If other messages are printed, ignore them
+            return None
+        percent, read_errors, write_errors, corruption_errors = match.groups()
+        # badblocks prints the 3 totals every time
+        self.errors = int(read_errors) + int(write_errors) + int(corruption_errors)
+        phase = min(max(self._phase, 0), self._phases - 1)
+        verified = float(percent) / 100 if phase == self._phases - 1 else 0.0
+        percent = (phase * 100.0 + float(percent)) / self._phases
+        return BadblocksProgress(percent, self.errors, verified)
+
+
+class StepProgress:
+    def __init__(self, percent: float, text: Optional[str] = None):
+        self.percent = percent
+        self.text = text
+
+
+class E2fsckProgressParser(ProgressParser):
+    """e2fsck -C 1 prints "pass current max device" lines on stdout"""
+
+    _PROGRESS = re.compile(r"^([1-5]) (\d+) (\d+) \S+$")
+    # Roughly how long each pass takes, like e2fsck weighs them for its own progress bar
+    _PASS_WEIGHTS = (70.0, 20.0, 2.0, 3.0, 5.0)
+
+    def parse(self, frame: str) -> Optional[StepProgress]:
+        match = self._PROGRESS.match(frame.strip())
+        if match is None:
+            return None
+        phase, current, maximum = (int(group) for group in match.groups())
+        fraction = current / maximum if maximum > 0 else 1.0
+        percent = sum(self._PASS_WEIGHTS[: phase - 1]) + self._PASS_WEIGHTS[phase - 1] * min(fraction, 1.0)
+        return StepProgress(percent, f"e2fsck pass {phase}")
+
+
+class Resize2fsProgressParser(ProgressParser):
+    """resize2fs -p prints "Begin pass N (max = M)", then a label and a bar of 40 X, one at a time.
+
+    How many passes there will be depends on the resize, so the percentage is the one of the current pass.
+    """
+
+    partial_frames = True
+    _PASS = re.compile(r"Begin pass (\d+)")
+    _BAR = re.compile(r"^X+$")
+    _BAR_WIDTH = 40
+
+    def __init__(self):
+        self.phase = 0
+
+    def scan(self, text: str):
+        for match in self._PASS.finditer(text):
+            self.phase = int(match.group(1))
+
+    def parse(self, frame: str) -> Optional[StepProgress]:
+        frame = frame.strip()
+        if self.phase == 0 or self._BAR.match(frame) is None:
+            return None
+        return StepProgress(min(len(frame), self._BAR_WIDTH) * 100.0 / self._BAR_WIDTH, f"resize2fs pass {self.phase}")
+
+
+class GrowpartParser(ProgressParser):
+    """growpart has no progress, only whether it changed the partition or it already fills the disk"""
+
+    def __init__(self):
+        self.changed = False
+        self.nochange = False
+
+    def scan(self, text: str):
+        self.changed = self.changed or "CHANGED:" in text
+        self.nochange = self.nochange or "NOCHANGE:" in text
+
+    def parse(self, frame: str):
+        return None
+
+
+class ProgressReader:
+    """Read the progress output of a long-running process in whole chunks.
+
+    Tools like badblocks redraw their status line with backspaces, and reading that one byte at a time
+    costs a syscall per character. This reads everything that is available, splits on the redraw
+    characters and parses only the most recent progress frame.
+    Iterating yields the parsed progress (or None when nothing new was parsed) every time a chunk
+    arrives or timeout seconds pass without output, so the caller can check whether to stop. Iteration
+    ends when the stream is closed.
+    """
+
+    _SEPARATORS = (b"\b", b"\r", b"\n")
+    _SPLIT = re.compile(rb"[\b\r\n]+")
+    _MAX_FRAME = 4096
+
+    def __init__(self, stream, parser: ProgressParser, chunk_size: int = 64 * 1024, timeout: float = 1.0):
+        self.parser = parser
+        self._fd = stream if isinstance(stream, int) else stream.fileno()
+        self._chunk_size = chunk_size
+        self._timeout = timeout
+        self._pending = bytearray()
+
+    def __iter__(self):
+        while True:
+            ready, _, _ = select.select((self._fd,), (), (), self._timeout)
+            if not ready:
+                yield None
+                continue
+            chunk = os.read(self._fd, self._chunk_size)
+            if chunk == b"":
+                if len(self._pending) > 0:
+                    yield self._feed(b"\n")
+                return
+            yield self._feed(chunk)
+
+    def _feed(self, chunk: bytes):
+        self._pending += chunk
+        last = max(self._pending.rfind(separator) for separator in self._SEPARATORS)
+        if last < 0:
+            # Something that long is not a progress line, do not keep it forever
+            if len(self._pending) > self._MAX_FRAME:
+                self._pending.clear()
+            return self._parse_partial()
+        complete = bytes(self._pending[:last])
+        del self._pending[: last + 1]
+
+        self.parser.scan(complete.decode("utf-8", "replace"))
+        partial = self._parse_partial()
+        if partial is not None:
+            return partial
+        for frame in reversed(self._SPLIT.split(complete)):
+            if frame.strip():
+                progress = self.parser.parse(frame.decode("utf-8", "replace"))
+                if progress is not None:
+                    return progress
+        return None
+
+    def _parse_partial(self):
+        if not self.parser.partial_frames or len(self._pending) == 0:
+            return None
+        return self.parser.parse(self._pending.decode("utf-8", "replace"))
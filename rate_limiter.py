@@ -0,0 +1,53 @@
+import threading
+import time
+from typing import Callable
+
+
+class RateLimiter:
+    """Token bucket limiting how many bytes per second go through it.
+
+    Shared by any number of threads: each one asks for the bytes it is about to move and is put to
+    sleep until they fit in the rate. The rate can be changed at any time, 0 means unlimited.
+    """
+
+    def __init__(self, rate: float = 0, burst_seconds: float = 1.0, poll_interval: float = 0.5):
+        self._lock = threading.Lock()
+        self._rate = rate
+        self._burst_seconds = burst_seconds
+        self._poll_interval = poll_interval
+        self._tokens = 0.0
+        self._last = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    def set_rate(self, rate: float):
+        with self._lock:
+            self._rate = max(0.0, rate)
+            self._tokens = 0.0
+            self._last = time.monotonic()
+
+    def consume(self, amount: int, should_continue: Callable[[], bool] = lambda: True) -> bool:
+        """Wait until amount bytes can be moved, return False if should_continue became false while waiting"""
+        with self._lock:
+            rate = self._rate
+            if rate <= 0:
+                return True
+            now = time.monotonic()
+            self._tokens = min(rate * self._burst_seconds, self._tokens + (now - self._last) * rate)
+            self._last = now
+            # Going into debt is fine, the next ones will wait longer
+            self._tokens -= amount
+            deadline = now - self._tokens / rate if self._tokens < 0 else now
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True
+            if not should_continue():
+                return False
+            if self._rate != rate:
+                # Changed at runtime, the debt has been cleared
+                return True
+            time.sleep(min(remaining, self._poll_interval))
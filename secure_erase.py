@@ -0,0 +1,271 @@
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+from typing import Callable, List, Optional
+
+ATA_SECURITY_ERASE = "ata-secure-erase"
+ATA_ENHANCED_SECURITY_ERASE = "ata-enhanced-secure-erase"
+NVME_SANITIZE = "nvme-sanitize"
+NVME_FORMAT = "nvme-format"
+DISCARD = "discard"
+
+# Fastest (and most thorough) first
+ERASE_METHODS = [NVME_SANITIZE, NVME_FORMAT, ATA_ENHANCED_SECURITY_ERASE, ATA_SECURITY_ERASE, DISCARD]
+
+# Temporary password, the drive resets it after the erase
+ATA_PASSWORD = "pesto"
+# Polls of the sanitize log that may still say "never sanitized" before giving up: the drive ignored the command
+SANITIZE_START_POLLS = 5
+# Seconds to wait for sanitize when the drive does not estimate how long it takes
+SANITIZE_TIMEOUT = 24 * 3600
+# Estimated times in the sanitize log are all ones when not reported
+_NVME_NO_ESTIMATE = 0xFFFFFFFF
+
+
+class SecureEraseError(Exception):
+    pass
+
+
+class EraseDevice:
+    """Everything the hardware erase needs from the system, replaced by a fake in tests."""
+
+    def __init__(self, path: str, sysfs_root: str = "/sys"):
+        self.path = path
+        self.name = os.path.basename(os.path.realpath(path))
+        self._sysfs = os.path.join(sysfs_root, "class", "block", self.name)
+
+    def sysfs(self, attribute: str) -> Optional[str]:
+        try:
+            with open(os.path.join(self._sysfs, attribute)) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    @staticmethod
+    def run(command: tuple) -> (int, str):
+        custom_env = os.environ.copy()
+        custom_env["LC_ALL"] = "C"
+        try:
+            result = subprocess.run(("sudo", "-n") + command, capture_output=True, text=True, env=custom_env)
+        except FileNotFoundError:
+            return 127, ""
+        return result.returncode, result.stdout
+
+    @staticmethod
+    def start(command: tuple):
+        return subprocess.Popen(("sudo", "-n") + command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    @staticmethod
+    def wait(seconds: float):
+        threading.Event().wait(seconds)
+
+    @staticmethod
+    def now() -> float:
+        return time.monotonic()
+
+
+def parse_hdparm_security(hdparm_output: str) -> dict:
+    """Parse the Security section of hdparm -I"""
+    security = {"supported": False, "enabled": False, "locked": False, "frozen": True, "enhanced": False, "minutes": None, "enhanced_minutes": None}
+    section = hdparm_output.split("Security:", 1)
+    if len(section) < 2:
+        return security
+    # Next section starts at a non-indented line
+    lines = []
+    for line in section[1].splitlines()[1:]:
+        if line and not line[0].isspace():
+            break
+        lines.append(" ".join(line.split()))
+
+    for line in lines:
+        if line == "supported":
+            security["supported"] = True
+        elif line == "enabled":
+            security["enabled"] = True
+        elif line == "locked":
+            security["locked"] = True
+        elif line == "not frozen":
+            security["frozen"] = False
+        elif line == "supported: enhanced erase":
+            security["enhanced"] = True
+        else:
+            match = re.search(r"(\d+)min for SECURITY ERASE UNIT", line)
+            if match:
+                security["minutes"] = int(match.group(1))
+            match = re.search(r"(\d+)min for ENHANCED SECURITY ERASE UNIT", line)
+            if match:
+                security["enhanced_minutes"] = int(match.group(1))
+    return security
+
+
+def _find_key(data, key: str):
+    # nvme-cli nests the logs differently depending on the version
+    if isinstance(data, dict):
+        if key in data:
+            return data[key]
+        for value in data.values():
+            found = _find_key(value, key)
+            if found is not None:
+                return found
+    return None
+
+
+class SecureEraser:
+    """Erase a disk with the fastest method that the hardware supports.
+
+    ATA security erase goes through hdparm, NVMe format and sanitize through nvme-cli, and SSDs that
+    support TRIM can be discarded with blkdiscard. The drive does the work in all cases, so a few
+    minutes are usually enough even for a large disk.
+    """
+
+    def __init__(self, device: EraseDevice, poll_interval: float = 2.0, discard_step: int = 1024**3):
+        self.device = device
+        self.poll_interval = poll_interval
+        self.discard_step = discard_step
+        self._hdparm = None
+        self._nvme = None
+
+    def supported_methods(self) -> List[str]:
+        methods = []
+        if self.device.name.startswith("nvme"):
+            nvme = self._nvme_id_ctrl()
+            if nvme is not None:
+                sanicap = int(nvme.get("sanicap", 0))
+                # Crypto erase (bit 0) or block erase (bit 1)
+                if sanicap & 0b011:
+                    methods.append(NVME_SANITIZE)
+                methods.append(NVME_FORMAT)
+        else:
+            security = self._ata_security()
+            if security["supported"] and not security["frozen"] and not security["locked"]:
+                if security["enhanced"]:
+                    methods.append(ATA_ENHANCED_SECURITY_ERASE)
+                methods.append(ATA_SECURITY_ERASE)
+        if self.device.sysfs("queue/rotational") == "0" and int(self.device.sysfs("queue/discard_max_bytes") or 0) > 0:
+            methods.append(DISCARD)
+        return methods
+
+    def best_method(self) -> Optional[str]:
+        methods = self.supported_methods()
+        return methods[0] if len(methods) > 0 else None
+
+    def erase(self, method: str, on_progress: Callable[[float, str], None], should_continue: Callable[[], bool] = lambda: True) -> bool:
+        """Run the erase, return False if it was stopped. Raise SecureEraseError on failure."""
+        if method not in self.supported_methods():
+            raise SecureEraseError(f"{method} is not supported by {self.device.path}")
+        if method == NVME_SANITIZE:
+            return self._nvme_sanitize(on_progress)
+        elif method == NVME_FORMAT:
+            return self._nvme_format(on_progress)
+        elif method in (ATA_SECURITY_ERASE, ATA_ENHANCED_SECURITY_ERASE):
+            return self._ata_erase(method == ATA_ENHANCED_SECURITY_ERASE, on_progress)
+        else:
+            return self._discard(on_progress, should_continue)
+
+    def _ata_security(self) -> dict:
+        if self._hdparm is None:
+            exitcode, output = self.device.run(("hdparm", "-I", self.device.path))
+            self._hdparm = parse_hdparm_security(output if exitcode == 0 else "")
+        return self._hdparm
+
+    def _nvme_id_ctrl(self) -> Optional[dict]:
+        if self._nvme is None:
+            exitcode, output = self.device.run(("nvme", "id-ctrl", "-o", "json", self.device.path))
+            if exitcode != 0:
+                return None
+            try:
+                self._nvme = json.loads(output)
+            except json.JSONDecodeError:
+                return None
+        return self._nvme
+
+    def _check(self, command: tuple, what: str):
+        exitcode, _ = self.device.run(command)
+        if exitcode != 0:
+            raise SecureEraseError(f"{what} failed with exit code {exitcode}")
+
+    def _ata_erase(self, enhanced: bool, on_progress: Callable[[float, str], None]) -> bool:
+        security = self._ata_security()
+        minutes = security["enhanced_minutes" if enhanced else "minutes"] or 0
+        path = self.device.path
+
+        on_progress(0.0, "Setting temporary ATA password")
+        self._check(("hdparm", "--user-master", "u", "--security-set-pass", ATA_PASSWORD, path), "Setting the ATA password")
+
+        erase_command = "--security-erase-enhanced" if enhanced else "--security-erase"
+        process = self.device.start(("hdparm", "--user-master", "u", erase_command, ATA_PASSWORD, path))
+        start = self.device.now()
+        # The drive cannot be stopped once the command has been sent, so should_continue is ignored
+        while process.poll() is None:
+            elapsed = self.device.now() - start
+            if minutes > 0:
+                # The estimate is given by the drive and is usually pessimistic
+                percent = min(99.0, elapsed / (minutes * 60) * 100)
+                on_progress(percent, f"Security erase in progress, about {minutes} min (cannot be stopped)")
+            else:
+                on_progress(0.0, "Security erase in progress (cannot be stopped)")
+            self.device.wait(self.poll_interval)
+        if process.poll() != 0:
+            # The password stays set if the erase did not happen, and the drive would be locked at the next power cycle
+            self.device.run(("hdparm", "--user-master", "u", "--security-disable", ATA_PASSWORD, path))
+            raise SecureEraseError(f"ATA security erase failed with exit code {process.poll()}")
+        return True
+
+    def _nvme_format(self, on_progress: Callable[[float, str], None]) -> bool:
+        nvme = self._nvme_id_ctrl() or {}
+        # Bit 2 of FNA: cryptographic erase is supported by format
+        ses = "2" if int(nvme.get("fna", 0)) & 0b100 else "1"
+        on_progress(0.0, "Formatting")
+        self._check(("nvme", "format", self.device.path, "-s", ses, "-f"), "NVMe format")
+        return True
+
+    def _nvme_sanitize(self, on_progress: Callable[[float, str], None]) -> bool:
+        nvme = self._nvme_id_ctrl() or {}
+        # 4 is crypto erase, 2 is block erase
+        action = "4" if int(nvme.get("sanicap", 0)) & 0b001 else "2"
+        self._check(("nvme", "sanitize", self.device.path, "-a", action), "NVMe sanitize")
+        start = self.device.now()
+        timeout = None
+        polls = 0
+        while True:
+            self.device.wait(self.poll_interval)
+            polls += 1
+            exitcode, output = self.device.run(("nvme", "sanitize-log", "-o", "json", self.device.path))
+            if exitcode != 0:
+                raise SecureEraseError(f"Reading the NVMe sanitize log failed with exit code {exitcode}")
+            try:
+                log = json.loads(output)
+            except json.JSONDecodeError:
+                raise SecureEraseError("Cannot parse the NVMe sanitize log")
+            if timeout is None:
+                # Twice what the drive estimates, plus some margin, since the thread cannot be stopped meanwhile
+                estimate = int(_find_key(log, "time_crypto_erase" if action == "4" else "time_block_erase") or 0)
+                timeout = estimate * 2 + 600 if 0 < estimate < _NVME_NO_ESTIMATE else SANITIZE_TIMEOUT
+            sstat = int(_find_key(log, "sstat") or 0) & 0b111
+            if sstat == 0b010:
+                # In progress, SPROG is a fraction of 65536
+                on_progress(int(_find_key(log, "sprog") or 0) / 65536 * 100, "Sanitize in progress (cannot be stopped)")
+            elif sstat == 0b001 or sstat == 0b100:
+                return True
+            elif sstat == 0b011:
+                raise SecureEraseError("NVMe sanitize failed")
+            elif sstat == 0b000 and polls >= SANITIZE_START_POLLS:
+                raise SecureEraseError("NVMe sanitize did not start, the drive ignored the command")
+            if self.device.now() - start > timeout:
+                raise SecureEraseError(f"NVMe sanitize did not finish in {timeout // 60} minutes")
+
+    def _discard(self, on_progress: Callable[[float, str], None], should_continue: Callable[[], bool]) -> bool:
+        size = int(self.device.sysfs("size") or 0) * 512
+        if size <= 0:
+            raise SecureEraseError(f"Cannot determine the size of {self.device.path}")
+        # Discard in steps, otherwise there would be no progress at all
+        for offset in range(0, size, self.discard_step):
+            if not should_continue():
+                return False
+            on_progress(offset / size * 100, "Discarding")
+            length = min(self.discard_step, size - offset)
+            self._check(("blkdiscard", "-o", str(offset), "-l", str(length), self.device.path), "blkdiscard")
+        return True
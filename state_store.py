@@ -0,0 +1,181 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import List, Optional
+
+from erase_engine import convert_ranges, replace_ranges
+
+
+class JsonStore:
+    """A small dict persisted to a JSON file, for state that must survive a restart of basilico.
+
+    Every change is written to a temporary file and renamed over the old one, so a crash never
+    leaves a half written file behind.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._data = self._load()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                return data
+            logging.warning(f"Ignoring {self.path}, it does not contain a JSON object")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable state file {self.path}", exc_info=e)
+        return {}
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary = f"{self.path}.tmp"
+        try:
+            with open(temporary, "w") as f:
+                json.dump(self._data, f, separators=(",", ":"))
+            os.replace(temporary, self.path)
+        except OSError as e:
+            logging.warning(f"Cannot save state to {self.path}", exc_info=e)
+
+    def get(self, key: str):
+        with self._lock:
+            return self._data.get(key)
+
+    def set(self, key: str, value):
+        with self._lock:
+            self._data[key] = value
+            self._save()
+
+    def delete(self, key: str):
+        with self._lock:
+            if key in self._data:
+                del self._data[key]
+                self._save()
+
+
+def composite_id_key(composite_id: tuple) -> str:
+    # (path, wwn, serial), any of them may be None
+    return json.dumps(list(composite_id), separators=(",", ":"))
+
+
+def normalize_serial(serial: str) -> str:
+    # Western Digital disks say WD-something, Tarallo has just the something
+    serial = serial.strip().upper()
+    return serial[3:] if serial.startswith("WD-") else serial
+
+
+class CheckpointStore(JsonStore):
+    """Last verified byte of each erase, to resume it instead of starting over.
+
+    A checkpoint is only valid for the same physical disk (the composite ID), the same size and the
+    same pattern.
+    """
+
+    def get_checkpoint(self, composite_id: tuple, size: int, pattern: str) -> Optional[dict]:
+        checkpoint = self.get(composite_id_key(composite_id))
+        if checkpoint is None or checkpoint.get("size") != size or checkpoint.get("pattern") != pattern:
+            return None
+        return checkpoint
+
+    def set_checkpoint(
+        self, composite_id: tuple, size: int, pattern: str, verified: int, errors: int, error_ranges: Optional[list] = None, seed: Optional[int] = None
+    ):
+        self.set(
+            composite_id_key(composite_id),
+            {
+                "size": size,
+                "pattern": pattern,
+                # Everything before this byte has been written and read back
+                "verified": verified,
+                "errors": errors,
+                "error_ranges": error_ranges or [],
+                # Random patterns are generated from this, resuming needs the same data
+                "seed": seed,
+                "time": int(time.time()),
+            },
+        )
+
+    def clear_checkpoint(self, composite_id: tuple):
+        self.delete(composite_id_key(composite_id))
+
+
+class BadBlockStore(JsonStore):
+    """Bad sectors found on each disk, by serial number, as [first LBA, count] ranges.
+
+    Each erase replaces what was known about the part of the disk it went over, so a bad area that
+    has been remapped disappears and the rest of the map is kept.
+    """
+
+    def get_map(self, serial: str) -> Optional[dict]:
+        return self.get(serial)
+
+    def update_map(
+        self, serial: str, size: int, sector_size: int, ranges: List[List[int]], start: int = 0, end: Optional[int] = None, method: Optional[str] = None
+    ) -> dict:
+        """Record the ranges found between LBA start and end (exclusive, default the end of the disk)"""
+        with self._lock:
+            old = self.get(serial)
+            if end is None:
+                end = size // sector_size
+            if old is None or old.get("size") != size:
+                old_ranges = []
+            else:
+                old_ranges = convert_ranges(old["ranges"], old["sector_size"], sector_size)
+            ranges = replace_ranges(old_ranges, ranges, start, end)
+            bad_map = {
+                "size": size,
+                "sector_size": sector_size,
+                "ranges": ranges,
+                "bad_sectors": sum(count for _, count in ranges),
+                "method": method,
+                "time": int(time.time()),
+            }
+            self.set(serial, bad_map)
+            return bad_map
+
+
+class CodeCache(JsonStore):
+    """Tarallo code of each serial number, so disks without a code are not looked up after every job.
+
+    Codes are trusted for ttl seconds. Serial numbers that Tarallo does not know are remembered as
+    well, for the shorter negative_ttl, since someone may add them at any time.
+    """
+
+    def __init__(self, path: str, ttl: float = 7 * 24 * 3600, negative_ttl: float = 3600):
+        super().__init__(path)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, serial: str) -> (bool, Optional[str]):
+        """(True, code) if the answer is cached, with None as the code for "not found", else (False, None)"""
+        key = normalize_serial(serial)
+        with self._lock:
+            entry = self.get(key)
+            if entry is not None:
+                ttl = self.ttl if entry.get("code") is not None else self.negative_ttl
+                if time.time() - entry.get("time", 0) <= ttl:
+                    self.hits += 1
+                    return True, entry.get("code")
+                self.delete(key)
+            self.misses += 1
+            return False, None
+
+    def remember(self, serial: str, code: Optional[str]):
+        self.set(normalize_serial(serial), {"code": code, "time": int(time.time())})
+
+    def invalidate(self, serial: str):
+        self.delete(normalize_serial(serial))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._data), "ttl": self.ttl, "negative_ttl": self.negative_ttl}
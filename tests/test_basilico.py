@@ -1,9 +1,13 @@
 import json
+import threading
 
 # noinspection PyPackageRequirements
 import pytest
 
-from basilico import CommandRunner
+import basilico
+from basilico import CommandRunner, IoMetrics, parse_rate
+from code_resolver import CodeResolver
+from state_store import CodeCache
 
 
 def _remove_partn(lsblk):
@@ -591,3 +595,185 @@ def test_get_last_linux_partition_path_and_number_from_lsblk_mbr_null_parttypes(
 
     # Assert that the result matches the expected output
     assert result == expected
+
+
+def test_io_metrics_throughput():
+    metrics = IoMetrics()
+    start = metrics._start
+    for second in range(1, 11):
+        metrics.update(second * 100, 2000, now=start + second)
+
+    serialized = metrics.serialize()
+    assert serialized["bytes_done"] == 1000
+    assert serialized["bytes_total"] == 2000
+    assert metrics.throughput() == 100
+    assert metrics.average_throughput(now=start + 10) == 100
+
+
+def test_io_metrics_resumed():
+    metrics = IoMetrics()
+    start = metrics._start
+    metrics.update(1500, 2000, bytes_resumed=1000, now=start + 5)
+
+    assert metrics.average_throughput(now=start + 5) == 100
+    assert metrics.throughput() == 100
+
+
+def test_io_metrics_no_io():
+    metrics = IoMetrics()
+
+    assert metrics.serialize()["throughput"] is None
+    assert metrics.serialize()["bytes_done"] is None
+
+
+def test_io_metrics_stopped():
+    metrics = IoMetrics()
+    metrics.update(100, 100)
+    metrics.stop()
+
+    assert metrics.throughput() is None
+    assert metrics.elapsed() == metrics.elapsed(now=metrics._start + 1000)
+
+
+@pytest.mark.parametrize("rate, expected", [("50", 50_000_000), ("0.5", 500_000), ("0", 0), ("-1", None), ("fast", None), ("nan", None)])
+def test_parse_rate(rate, expected):
+    assert parse_rate(rate) == expected
+
+
+def test_handle_disk_event(monkeypatch):
+    lsblk = {"/dev/sdz": [{"path": "/dev/sdz", "serial": "AAA", "mountpoint": [], "mountpoint_map": {}}]}
+    deltas = []
+    monkeypatch.setattr(basilico, "get_disks", lambda path=None: [dict(disk) for disk in lsblk.get(path, [])])
+    monkeypatch.setattr(basilico, "send_disks_delta", lambda since: deltas.append(basilico.disks_since(since)))
+
+    basilico.handle_disk_event("add", "/dev/sdz")
+    basilico.handle_disk_event("change", "/dev/sdz")
+    lsblk["/dev/sdz"][0]["serial"] = "BBB"
+    basilico.handle_disk_event("change", "/dev/sdz")
+    basilico.handle_disk_event("remove", "/dev/sdz")
+
+    assert [([disk["serial"] for disk in delta["added"]], delta["removed"]) for delta in deltas] == [
+        (["AAA"], []),
+        ([], []),
+        (["BBB"], ["/dev/sdz"]),
+        ([], ["/dev/sdz"]),
+    ]
+    assert "/dev/sdz" not in basilico.disks
+
+
+def test_handle_disk_event_change(monkeypatch):
+    lsblk = {"/dev/sdw": [{"path": "/dev/sdw", "serial": "AAA", "mountpoint": [], "mountpoint_map": {}}]}
+    deltas = []
+    monkeypatch.setattr(basilico, "get_disks", lambda path=None: [dict(disk) for disk in lsblk.get(path, [])])
+    monkeypatch.setattr(basilico, "send_disks_delta", lambda since: deltas.append(basilico.disks_since(since)))
+
+    basilico.handle_disk_event("add", "/dev/sdw")
+    lsblk["/dev/sdw"][0]["mountpoint"] = ["/mnt"]
+    lsblk["/dev/sdw"][0]["mountpoint_map"] = {"/dev/sdw1": "/mnt"}
+    basilico.handle_disk_event("change", "/dev/sdw")
+    basilico.handle_disk_event("change", "/dev/sdw")
+
+    assert [disk["mountpoint"] for disk in deltas[1]["changed"]] == [["/mnt"]]
+    assert deltas[2]["changed"] == []
+    assert basilico.disks["/dev/sdw"].get_mountpoints_map() == {"/dev/sdw1": "/mnt"}
+    basilico.handle_disk_event("remove", "/dev/sdw")
+
+
+def test_disks_since(monkeypatch):
+    lsblk = {"/dev/sdy": [{"path": "/dev/sdy", "serial": "AAA", "mountpoint": [], "mountpoint_map": {}}]}
+    monkeypatch.setattr(basilico, "get_disks", lambda path=None: [dict(disk) for disk in lsblk.get(path, [])])
+    monkeypatch.setattr(basilico, "send_disks_delta", lambda since: None)
+    start = basilico.current_disk_version()
+
+    basilico.handle_disk_event("add", "/dev/sdy")
+    added = basilico.current_disk_version()
+    basilico.disks["/dev/sdy"].set_code("H123")
+    coded = basilico.current_disk_version()
+    basilico.disks["/dev/sdy"].set_code("H123")
+
+    assert [disk["serial"] for disk in basilico.disks_since(start)["added"]] == ["AAA"]
+    assert basilico.disks_since(start)["changed"] == []
+    assert [disk["code"] for disk in basilico.disks_since(added)["changed"]] == ["H123"]
+    assert basilico.disks_since(coded) == {"epoch": basilico.DISKS_EPOCH, "since": coded, "version": coded, "added": [], "changed": [], "removed": []}
+
+    basilico.handle_disk_event("remove", "/dev/sdy")
+
+    assert basilico.disks_since(start)["removed"] == ["/dev/sdy"]
+    assert basilico.disks_since(start)["added"] == []
+    assert basilico.disks_since(coded)["removed"] == ["/dev/sdy"]
+    assert basilico.disks_since(basilico.current_disk_version())["removed"] == []
+
+
+def test_disk_code_is_looked_up_in_the_background(monkeypatch):
+    answer = threading.Event()
+
+    class SlowTarallo:
+        @staticmethod
+        def get_codes_by_feature(feature, value):
+            answer.wait(5)
+            return ["H42"] if (feature, value) == ("sn", "CCC") else []
+
+    resolver = CodeResolver(1)
+    deltas = []
+    monkeypatch.setattr(basilico, "CODE_RESOLVER", resolver)
+    monkeypatch.setattr(basilico, "send_disks_delta", lambda since: deltas.append(since))
+
+    disk = basilico.Disk({"path": "/dev/sdx", "serial": "WD-CCC", "mountpoint": [], "mountpoint_map": {}}, SlowTarallo())
+    pending = dict(disk.serialize_disk())
+    answer.set()
+    resolver.shutdown()
+
+    assert pending["code"] is None
+    assert pending["code_pending"]
+    assert disk.serialize_disk()["code"] == "H42"
+    assert not disk.serialize_disk()["code_pending"]
+    assert disk.get_version() > pending["version"]
+    assert len(deltas) == 1
+
+
+def test_disk_code_from_cache(monkeypatch, tmp_path):
+    class NoTarallo:
+        @staticmethod
+        def get_codes_by_feature(feature, value):
+            raise AssertionError("Tarallo should not be asked")
+
+    cache = CodeCache(str(tmp_path / "codes.json"))
+    cache.remember("DDD", "H7")
+    resolver = CodeResolver(1)
+    monkeypatch.setattr(basilico, "CODE_CACHE", cache)
+    monkeypatch.setattr(basilico, "CODE_RESOLVER", resolver)
+    monkeypatch.setattr(basilico, "send_disks_delta", lambda since: None)
+
+    disk = basilico.Disk({"path": "/dev/sdw", "serial": "DDD", "mountpoint": [], "mountpoint_map": {}}, NoTarallo())
+    resolver.shutdown()
+
+    assert disk.serialize_disk()["code"] == "H7"
+    assert cache.stats()["hits"] == 1
+
+
+def test_uploaded_code_is_not_overwritten_by_lookup(monkeypatch, tmp_path):
+    asked = threading.Event()
+    answer = threading.Event()
+
+    class SlowTarallo:
+        @staticmethod
+        def get_codes_by_feature(feature, value):
+            asked.set()
+            answer.wait(5)
+            return []
+
+    cache = CodeCache(str(tmp_path / "codes.json"))
+    resolver = CodeResolver(1)
+    monkeypatch.setattr(basilico, "CODE_CACHE", cache)
+    monkeypatch.setattr(basilico, "CODE_RESOLVER", resolver)
+    monkeypatch.setattr(basilico, "send_disks_delta", lambda since: None)
+
+    disk = basilico.Disk({"path": "/dev/sdv", "serial": "EEE", "mountpoint": [], "mountpoint_map": {}}, SlowTarallo())
+    assert asked.wait(5)
+    upload = threading.Thread(target=disk.set_code, args=("H9",))
+    upload.start()
+    answer.set()
+    upload.join(5)
+    resolver.shutdown()
+
+    assert disk.serialize_disk()["code"] == "H9"
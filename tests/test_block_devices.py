@@ -0,0 +1,106 @@
+import os
+
+from block_devices import BlockDeviceScanner
+
+
+def _write(path, content: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def _device(parent: str, name: str, dev: str, size: int = 0, partition: bool = False):
+    directory = os.path.join(parent, name)
+    _write(os.path.join(directory, "dev"), dev + "\n")
+    _write(os.path.join(directory, "size"), f"{size}\n")
+    if partition:
+        _write(os.path.join(directory, "partition"), "1\n")
+    return directory
+
+
+def _disk(root, devices_path: str, name: str, dev: str, size: int, rotational: int = 1, removable: int = 0):
+    directory = _device(os.path.join(root, "sys", devices_path), name, dev, size)
+    _write(os.path.join(directory, "queue", "rotational"), f"{rotational}\n")
+    _write(os.path.join(directory, "removable"), f"{removable}\n")
+    os.makedirs(os.path.join(root, "sys", "block"), exist_ok=True)
+    os.symlink(directory, os.path.join(root, "sys", "block", name))
+    return directory
+
+
+def _make_tree(root):
+    sata = _disk(root, "devices/pci0000:00/0000:00:17.0/ata1/host0/target0:0:0/0:0:0:0/block", "sda", "8:0", 1000)
+    _write(os.path.join(sata, "device", "vendor"), "ATA     \n")
+    _write(os.path.join(sata, "device", "model"), "WDC WD5000AAKX-0\n")
+    with open(os.path.join(sata, "device", "vpd_pg80"), "wb") as f:
+        f.write(b"\x00\x80\x00\x0fWD-WCAYUJ123456")
+    _device(sata, "sda1", "8:1", 100, partition=True)
+    _device(sata, "sda2", "8:2", 100, partition=True)
+    sda3 = _device(sata, "sda3", "8:3", 800, partition=True)
+    # dm-crypt on sda3
+    dm = _device(os.path.join(root, "sys", "devices", "virtual", "block"), "dm-0", "254:0", 800)
+    _write(os.path.join(dm, "dm", "name"), "cryptroot\n")
+    _write(os.path.join(dm, "slaves", "sda3"), "")
+    os.symlink(dm, os.path.join(root, "sys", "block", "dm-0"))
+    os.makedirs(os.path.join(sda3, "holders"))
+    os.symlink(dm, os.path.join(sda3, "holders", "dm-0"))
+
+    _disk(root, "devices/pci0000:00/0000:00:14.0/usb2/2-1/2-1:1.0/host6/target6:0:0/6:0:0:0/block", "sdb", "8:16", 2000, rotational=0)
+    _write(
+        os.path.join(root, "udev", "b8:16"),
+        "S:disk/by-id/usb-Kingston\nE:ID_MODEL_ENC=DataTraveler\\x203.0\nE:ID_SERIAL_SHORT=0123456789\nE:ID_WWN=0x5000000000000001\n",
+    )
+    _disk(root, "devices/virtual/block", "loop0", "7:0", 100)
+    # Card reader without a card
+    _disk(root, "devices/pci0000:00/0000:00:14.0/usb2/2-2/2-2:1.0/host7/target7:0:0/7:0:0:0/block", "sdc", "8:32", 0, removable=1)
+
+    _write(
+        os.path.join(root, "proc", "self", "mountinfo"),
+        "22 1 254:0 / / rw,relatime shared:1 - ext4 /dev/mapper/cryptroot rw\n" "23 22 8:1 / /boot\\040efi rw,relatime shared:2 - vfat /dev/sda1 rw\n",
+    )
+    _write(os.path.join(root, "proc", "swaps"), "Filename\tType\tSize\tUsed\tPriority\n/dev/sda2 partition 100 0 -2\n")
+    return BlockDeviceScanner(os.path.join(root, "sys"), os.path.join(root, "proc"), os.path.join(root, "udev"), "/dev")
+
+
+def test_scan_disks(tmp_path):
+    scanner = _make_tree(str(tmp_path))
+
+    disks = scanner.scan()
+
+    assert [disk["path"] for disk in disks] == ["/dev/sda", "/dev/sdb"]
+    sda, sdb = disks
+    assert sda == {
+        "path": "/dev/sda",
+        "vendor": "ATA",
+        "model": "WDC WD5000AAKX-0",
+        "serial": "WD-WCAYUJ123456",
+        "wwn": None,
+        "hotplug": False,
+        "rota": True,
+        "size": 1000 * 512,
+        "mountpoint": ["/boot efi", "[SWAP]", "/"],
+        "mountpoint_map": {"/dev/sda1": "/boot efi", "/dev/sda2": "[SWAP]", "/dev/mapper/cryptroot": "/"},
+    }
+    assert sdb["model"] == "DataTraveler 3.0"
+    assert sdb["serial"] == "0123456789"
+    assert sdb["wwn"] == "0x5000000000000001"
+    assert sdb["hotplug"]
+    assert not sdb["rota"]
+    assert sdb["mountpoint"] == []
+
+
+def test_scan_one_disk(tmp_path):
+    scanner = _make_tree(str(tmp_path))
+
+    assert [disk["path"] for disk in scanner.scan("/dev/sdb")] == ["/dev/sdb"]
+    assert scanner.scan("/dev/sdz") == []
+
+
+def test_scan_btrfs_mount(tmp_path):
+    scanner = _make_tree(str(tmp_path))
+    # btrfs has an anonymous major:minor, only the source device says where it is
+    _write(os.path.join(str(tmp_path), "proc", "self", "mountinfo"), "22 1 0:31 /root / rw,relatime shared:1 - btrfs /dev/sda1 rw\n")
+
+    sda = scanner.scan("/dev/sda")[0]
+
+    assert sda["mountpoint_map"] == {"/dev/sda1": "/", "/dev/sda2": "[SWAP]"}
+    assert sda["mountpoint"] == ["/", "[SWAP]"]
@@ -0,0 +1,88 @@
+import hashlib
+import os
+
+from bmap import BlockMap, create_bmap, find_bmap, load_bmap, save_bmap, parse_bmaptool_xml, BMAP_SUFFIX
+from erase_engine import KiB, MiB
+from imaging import ImageWriter
+
+
+def _make_sparse_image(tmp_path):
+    # Data at 0-64 KiB and 1 MiB-1 MiB+100, holes everywhere else
+    path = tmp_path / "image.img"
+    with open(path, "wb") as f:
+        f.write(os.urandom(64 * KiB))
+        f.seek(1 * MiB)
+        f.write(os.urandom(100))
+        f.truncate(2 * MiB)
+    return str(path)
+
+
+def test_create_bmap_maps_data(tmp_path):
+    image = _make_sparse_image(tmp_path)
+
+    bmap = create_bmap(image)
+
+    assert bmap.image_size == 2 * MiB
+    with open(image, "rb") as f:
+        data = f.read()
+    for offset, length, checksum in bmap.byte_ranges():
+        assert hashlib.sha256(data[offset : offset + length]).hexdigest() == checksum
+    # Filesystems without holes map everything, which is still correct
+    assert 64 * KiB + 100 <= bmap.mapped_bytes <= 2 * MiB
+    assert bmap.matches(image)
+
+
+def test_bmap_round_trip(tmp_path):
+    image = _make_sparse_image(tmp_path)
+    bmap = create_bmap(image)
+
+    save_bmap(bmap, image + BMAP_SUFFIX)
+    loaded = load_bmap(find_bmap(image))
+
+    assert loaded.serialize() == bmap.serialize()
+
+
+def test_parse_bmaptool_xml():
+    bmap = parse_bmaptool_xml("""<?xml version="1.0" ?>
+<bmap version="2.0">
+    <ImageSize> 1000000 </ImageSize>
+    <BlockSize> 4096 </BlockSize>
+    <BlocksCount> 245 </BlocksCount>
+    <MappedBlocksCount> 11 </MappedBlocksCount>
+    <ChecksumType> sha256 </ChecksumType>
+    <BmapFileChecksum> 0 </BmapFileChecksum>
+    <BlockMap>
+        <Range chksum="aa"> 0-9 </Range>
+        <Range chksum="bb"> 244 </Range>
+    </BlockMap>
+</bmap>""")
+
+    assert bmap.checksum_type == "sha256"
+    assert bmap.ranges == [[0, 9, "aa"], [244, 244, "bb"]]
+    # The last block is cut at the end of the image
+    assert list(bmap.byte_ranges()) == [(0, 40960, "aa"), (244 * 4096, 1000000 - 244 * 4096, "bb")]
+
+
+def test_bmap_copy_and_verify(tmp_path):
+    image = tmp_path / "image.img"
+    image.write_bytes(os.urandom(1 * MiB))
+    disk = tmp_path / "disk.img"
+    disk.write_bytes(b"\xff" * (1 * MiB))
+    digest = hashlib.sha256(image.read_bytes()[: 256 * KiB]).hexdigest()
+    bmap = BlockMap(1 * MiB, 4096, [[0, 63, digest]])
+    writer = ImageWriter(str(image), str(disk), block_size=128 * KiB, bmap=bmap)
+
+    result = writer.run()
+
+    assert result.completed
+    assert result.bytes_written == 256 * KiB
+    data = disk.read_bytes()
+    assert data[: 256 * KiB] == image.read_bytes()[: 256 * KiB]
+    # Not in the map, not touched
+    assert data[256 * KiB :] == b"\xff" * (768 * KiB)
+    assert writer.verify(bmap.byte_ranges(), bmap.new_hash) == []
+
+    with open(disk, "r+b") as f:
+        f.seek(100 * KiB)
+        f.write(b"\x00")
+    assert writer.verify(bmap.byte_ranges(), bmap.new_hash) == [(0, 256 * KiB)]
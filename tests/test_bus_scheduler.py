@@ -0,0 +1,90 @@
+import threading
+
+# noinspection PyPackageRequirements
+import pytest
+
+from bus_scheduler import BusScheduler, bus_group, bus_group_from_sysfs_path
+
+
+@pytest.mark.parametrize(
+    "device_path, expected",
+    [
+        # Two disks on the same USB hub
+        (
+            "/sys/devices/pci0000:00/0000:00:14.0/usb2/2-1/2-1.3/2-1.3:1.0/host6/target6:0:0/6:0:0:0",
+            "pci0000:00/0000:00:14.0/usb2/2-1",
+        ),
+        (
+            "devices/pci0000:00/0000:00:14.0/usb2/2-1/2-1.4/2-1.4:1.0/host7/target7:0:0/7:0:0:0",
+            "pci0000:00/0000:00:14.0/usb2/2-1",
+        ),
+        # Directly on the root hub
+        ("devices/pci0000:00/0000:00:14.0/usb2/2-2/2-2:1.0/host8/target8:0:0/8:0:0:0", "pci0000:00/0000:00:14.0/usb2"),
+        # SATA, one port each, or a port multiplier
+        ("devices/pci0000:00/0000:00:17.0/ata3/host2/target2:0:0/2:0:0:0", "pci0000:00/0000:00:17.0/ata3"),
+        ("devices/pci0000:00/0000:00:17.0/ata3/link3.1/dev3.1.0/ata_device/host2/target2:1:0/2:1:0:0", "pci0000:00/0000:00:17.0/ata3"),
+        # SAS behind an expander
+        (
+            "devices/pci0000:00/0000:00:01.0/0000:03:00.0/host0/port-0:0/expander-0:0/port-0:0:1/end_device-0:0:1/target0:0:1/0:0:1:0",
+            "pci0000:00/0000:00:01.0/0000:03:00.0/host0/port-0:0/expander-0:0",
+        ),
+        # NVMe
+        ("devices/pci0000:00/0000:00:1d.0/0000:3d:00.0/nvme/nvme0", "pci0000:00/0000:00:1d.0/0000:3d:00.0"),
+    ],
+)
+def test_bus_group_from_sysfs_path(device_path, expected):
+    assert bus_group_from_sysfs_path(device_path) == expected
+
+
+def test_bus_group_fake_sysfs(tmp_path):
+    device = tmp_path / "devices" / "pci0000:00" / "0000:00:17.0" / "ata1" / "host0" / "target0:0:0" / "0:0:0:0"
+    device.mkdir(parents=True)
+    block = tmp_path / "class" / "block" / "sda"
+    block.mkdir(parents=True)
+    (block / "device").symlink_to(device)
+
+    assert bus_group("/dev/sda", str(tmp_path)) == "pci0000:00/0000:00:17.0/ata1"
+    assert bus_group("/dev/sdz", str(tmp_path)) == "sdz"
+
+
+def test_scheduler_limits_jobs():
+    scheduler = BusScheduler(2)
+    assert scheduler.acquire("hub")
+    assert scheduler.acquire("hub")
+    assert scheduler.acquire("other")
+    assert scheduler.is_full("hub")
+    # Stopped while waiting
+    assert not scheduler.acquire("hub", lambda: False, 0.01)
+
+    acquired = []
+    waiting = threading.Thread(target=lambda: acquired.append(scheduler.acquire("hub", poll_interval=0.01)))
+    waiting.start()
+    scheduler.release("hub")
+    waiting.join(5)
+
+    assert acquired == [True]
+    assert scheduler.running("hub") == 2
+    assert scheduler.running("other") == 1
+
+
+def test_scheduler_no_limit():
+    scheduler = BusScheduler(0)
+    for _ in range(10):
+        assert scheduler.acquire("hub")
+    assert not scheduler.is_full("hub")
+
+
+def test_scheduler_shared_slot():
+    scheduler = BusScheduler(2)
+    assert scheduler.acquire("hub")
+    # A fanout to 8 disks on the hub takes the other slot
+    for _ in range(8):
+        assert scheduler.acquire("hub", lambda: False, 0.01, share="fanout image.img")
+    assert scheduler.running("hub") == 2
+    assert not scheduler.acquire("hub", lambda: False, 0.01, share="fanout other.img")
+
+    for _ in range(7):
+        scheduler.release("hub", "fanout image.img")
+    assert scheduler.running("hub") == 2
+    scheduler.release("hub", "fanout image.img")
+    assert scheduler.running("hub") == 1
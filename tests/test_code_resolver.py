@@ -0,0 +1,35 @@
+import threading
+
+from code_resolver import CodeResolver
+
+
+def test_same_lookup_runs_once():
+    resolver = CodeResolver(2)
+    release = threading.Event()
+    done = threading.Event()
+    results = []
+
+    assert resolver.submit("sda", lambda: release.wait(5) and "H1", lambda result, error: results.append(result) or done.set())
+    assert not resolver.submit("sda", lambda: "H2", lambda result, error: results.append(result))
+    assert resolver.is_running("sda")
+    release.set()
+    assert done.wait(5)
+    resolver.shutdown()
+
+    assert results == ["H1"]
+    assert not resolver.is_running("sda")
+
+
+def test_exceptions_are_passed_on():
+    resolver = CodeResolver(1)
+    errors = []
+
+    def lookup():
+        raise RuntimeError("no")
+
+    resolver.submit("sdb", lookup, lambda result, error: errors.append((result, error)))
+    resolver.shutdown()
+
+    assert len(errors) == 1
+    assert errors[0][0] is None
+    assert isinstance(errors[0][1], RuntimeError)
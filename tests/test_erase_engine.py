@@ -0,0 +1,286 @@
+import os
+
+# noinspection PyPackageRequirements
+import pytest
+
+from erase_engine import (
+    EraseEngine,
+    KiB,
+    MiB,
+    RandomPattern,
+    convert_ranges,
+    merge_ranges,
+    replace_ranges,
+    parse_size,
+    parse_fraction,
+    parse_pattern,
+    profile_patterns,
+)
+
+
+def _make_disk(tmp_path, size: int):
+    path = tmp_path / "disk.img"
+    path.write_bytes(os.urandom(size))
+    return str(path)
+
+
+class CorruptingEraseEngine(EraseEngine):
+    """Reads back something different from what was written at bad_offset"""
+
+    bad_offset = 0
+
+    def _read(self, fd: int, view: memoryview, offset: int):
+        super()._read(fd, view, offset)
+        if offset <= self.bad_offset < offset + len(view):
+            view[self.bad_offset - offset] = 0xFF
+
+
+@pytest.mark.parametrize("queue_depth", [1, 4])
+def test_erase_zeroes_everything(tmp_path, queue_depth):
+    path = _make_disk(tmp_path, 3 * MiB + 512)
+    engine = EraseEngine(path, block_size=256 * KiB, queue_depth=queue_depth, region_size=1 * MiB)
+    progress = []
+
+    result = engine.run(on_progress=progress.append)
+
+    assert result.completed
+    assert result.errors == 0
+    assert result.size == 3 * MiB + 512
+    with open(path, "rb") as f:
+        assert f.read() == bytes(3 * MiB + 512)
+    assert progress[-1].percent == pytest.approx(100.0)
+
+
+def test_erase_can_be_stopped(tmp_path):
+    path = _make_disk(tmp_path, 1 * MiB)
+    engine = EraseEngine(path, block_size=64 * KiB)
+
+    result = engine.run(should_continue=lambda: False)
+
+    assert not result.completed
+
+
+def test_erase_finds_bad_lbas(tmp_path):
+    path = _make_disk(tmp_path, 1 * MiB)
+    engine = CorruptingEraseEngine(path, block_size=256 * KiB, probe_size=4 * KiB)
+    engine.bad_offset = 300 * KiB + 10
+
+    result = engine.run()
+
+    assert result.completed
+    assert result.error_ranges == [[300 * KiB // 512, 8]]
+    assert result.errors == 8
+
+
+def test_merge_ranges():
+    assert merge_ranges([[16, 8], [0, 8], [8, 8], [100, 1], [101, 3], [200, 4], [202, 1]]) == [[0, 24], [100, 4], [200, 4]]
+
+
+@pytest.mark.parametrize(
+    "size, expected",
+    [("4096", 4096), ("512K", 512 * KiB), ("4M", 4 * MiB), ("4MiB", 4 * MiB), ("1g", 1024 * MiB)],
+)
+def test_parse_size(size, expected):
+    assert parse_size(size) == expected
+
+
+def test_parse_size_invalid():
+    with pytest.raises(ValueError):
+        parse_size("lots")
+
+
+def test_erase_resume_from_checkpoint(tmp_path):
+    path = _make_disk(tmp_path, 4 * MiB)
+    checkpoints = []
+    engine = EraseEngine(path, block_size=256 * KiB, region_size=1 * MiB)
+
+    result = engine.run(should_continue=lambda: len(checkpoints) < 2, on_checkpoint=lambda verified, errors: checkpoints.append(verified))
+
+    assert not result.completed
+    assert checkpoints == [1 * MiB, 2 * MiB]
+    with open(path, "rb") as f:
+        assert f.read(2 * MiB) == bytes(2 * MiB)
+
+    progress = []
+    result = engine.run(on_progress=progress.append, start_offset=checkpoints[-1], on_checkpoint=lambda verified, errors: checkpoints.append(verified))
+
+    assert result.completed
+    assert result.start == 2 * MiB
+    assert checkpoints[2:] == [3 * MiB, 4 * MiB]
+    assert progress[-1].bytes_resumed == 4 * MiB
+    with open(path, "rb") as f:
+        assert f.read() == bytes(4 * MiB)
+
+
+def test_erase_sample_verify(tmp_path):
+    path = _make_disk(tmp_path, 4 * MiB)
+    engine = CorruptingEraseEngine(path, block_size=64 * KiB, verify="sample", sample_fraction=0.25, sample_edges=128 * KiB, seed=42)
+    # On the first edge, always read back
+    engine.bad_offset = 10
+    progress = []
+
+    result = engine.run(on_progress=progress.append)
+
+    assert result.completed
+    # 2 blocks on each edge, a quarter of the 64 blocks from the middle
+    assert result.sample_blocks == 2 + 16 + 2
+    assert result.error_ranges == [[0, 8]]
+    assert result.bytes_processed == 4 * MiB + 20 * 64 * KiB
+    assert progress[-1].percent == pytest.approx(100.0)
+    with open(path, "rb") as f:
+        assert f.read() == bytes(4 * MiB)
+
+
+def test_sample_blocks_include_edges(tmp_path):
+    path = _make_disk(tmp_path, 1 * MiB)
+    engine = EraseEngine(path, block_size=64 * KiB, verify="sample", sample_fraction=0, sample_edges=64 * KiB)
+
+    assert engine.sample_blocks(1 * MiB) == [(0, 64 * KiB), (1 * MiB - 64 * KiB, 64 * KiB)]
+    # Edges larger than the disk: everything is verified
+    engine.sample_edges = 1 * MiB
+    assert len(engine.sample_blocks(1 * MiB)) == 16
+
+
+@pytest.mark.parametrize("fraction, expected", [("0.05", 0.05), ("5%", 0.05), ("100%", 1.0)])
+def test_parse_fraction(fraction, expected):
+    assert parse_fraction(fraction) == pytest.approx(expected)
+
+
+def test_erase_throttle(tmp_path):
+    path = _make_disk(tmp_path, 1 * MiB)
+    engine = EraseEngine(path, block_size=256 * KiB, region_size=1 * MiB)
+    throttled = []
+
+    result = engine.run(throttle=lambda amount: throttled.append(amount) or len(throttled) < 6)
+
+    # 4 blocks written, 1 read back, then stopped
+    assert not result.completed
+    assert throttled == [256 * KiB] * 6
+    assert result.bytes_processed == 5 * 256 * KiB
+
+
+def test_erase_random_then_zero(tmp_path):
+    path = _make_disk(tmp_path, 2 * MiB)
+    engine = CorruptingEraseEngine(path, block_size=256 * KiB, queue_depth=2, region_size=1 * MiB, patterns=("random", "0x00"))
+    engine.bad_offset = 1 * MiB + 10
+
+    result = engine.run()
+
+    assert result.completed
+    # Found in both passes
+    assert result.error_ranges == [[1 * MiB // 512, 8]]
+    assert result.bytes_processed == 2 * MiB * 4
+    with open(path, "rb") as f:
+        assert f.read() == bytes(2 * MiB)
+
+
+def test_erase_random_is_verified(tmp_path):
+    path = _make_disk(tmp_path, 1 * MiB)
+    engine = EraseEngine(path, block_size=64 * KiB, patterns=("random",))
+
+    result = engine.run()
+
+    assert result.completed
+    assert result.errors == 0
+    with open(path, "rb") as f:
+        data = f.read()
+    # Not the same data in every block
+    assert len({data[offset : offset + 64 * KiB] for offset in range(0, 1 * MiB, 64 * KiB)}) == 16
+
+
+def test_random_pattern_is_repeatable():
+    pattern = RandomPattern(seed=1)
+    first = bytes(pattern.data(8 * KiB, 4 * KiB, bytearray(4 * KiB)))
+    assert bytes(pattern.data(8 * KiB, 4 * KiB, bytearray(4 * KiB))) == first
+    assert bytes(pattern.data(12 * KiB, 4 * KiB, bytearray(4 * KiB))) != first
+    # Same data whatever the block it is in
+    assert bytes(pattern.data(0, 200 * KiB, bytearray(200 * KiB)))[8 * KiB : 12 * KiB] == first
+    assert bytes(RandomPattern(seed=1).data(8 * KiB, 4 * KiB, bytearray(4 * KiB))) == first
+    assert bytes(RandomPattern(seed=2).data(8 * KiB, 4 * KiB, bytearray(4 * KiB))) != first
+
+
+def test_erase_random_sample_with_uneven_regions(tmp_path):
+    path = _make_disk(tmp_path, 4 * MiB)
+    # Regions are not a multiple of the block size, sampled blocks are not where blocks were written
+    engine = EraseEngine(path, block_size=384 * KiB, region_size=1000 * KiB, verify="sample", sample_fraction=1, patterns=("random",))
+
+    result = engine.run()
+
+    assert result.completed
+    assert result.errors == 0
+
+
+def test_erase_resume_random_sample(tmp_path):
+    path = _make_disk(tmp_path, 4 * MiB)
+    checkpoints = []
+    engine = EraseEngine(path, block_size=256 * KiB, region_size=1 * MiB, verify="sample", sample_fraction=1, patterns=("random",))
+
+    result = engine.run(should_continue=lambda: len(checkpoints) < 2, on_checkpoint=lambda verified, errors: checkpoints.append(verified))
+
+    assert not result.completed
+    resumed = EraseEngine(
+        path, block_size=512 * KiB, region_size=1 * MiB, verify="sample", sample_fraction=1, patterns=("random",), pattern_seed=engine.pattern_seed
+    )
+    result = resumed.run(start_offset=checkpoints[-1])
+
+    assert result.completed
+    assert result.errors == 0
+
+
+@pytest.mark.parametrize("pattern, expected", [("0x00", 0), ("0xFF", 255), ("0x5", 5), ("random", None)])
+def test_parse_pattern(pattern, expected):
+    assert parse_pattern(pattern) == expected
+
+
+@pytest.mark.parametrize("pattern", ["0x100", "ff", "zeros"])
+def test_parse_pattern_invalid(pattern):
+    with pytest.raises(ValueError):
+        parse_pattern(pattern)
+
+
+def test_profile_patterns():
+    assert profile_patterns("zero") == ("0x00",)
+    with pytest.raises(ValueError):
+        profile_patterns("gutmann")
+
+
+def test_convert_ranges():
+    # 4096 byte blocks to 512 byte LBAs and back, rounding outwards
+    assert convert_ranges([[1, 2], [3, 1]], 4096, 512) == [[8, 24]]
+    assert convert_ranges([[9, 1], [30, 4]], 512, 4096) == [[1, 1], [3, 2]]
+
+
+def test_replace_ranges():
+    old = [[0, 10], [20, 10], [50, 5]]
+    assert replace_ranges(old, [[40, 2]], 5, 25) == [[0, 5], [25, 5], [40, 2], [50, 5]]
+    assert replace_ranges(old, [[1, 1]], 0, 0) == [[0, 10], [20, 10], [50, 5]]
+
+
+def test_erase_skips_known_bad(tmp_path):
+    path = _make_disk(tmp_path, 1 * MiB)
+    engine = EraseEngine(path, block_size=256 * KiB, probe_size=4 * KiB, skip_ranges=[[600, 8]])
+
+    result = engine.run()
+
+    assert result.completed
+    # Still reported, rounded to the probe size
+    assert result.error_ranges == [[600, 8]]
+    with open(path, "rb") as f:
+        data = f.read()
+    assert data[: 600 * 512] == bytes(600 * 512)
+    assert data[608 * 512 :] == bytes(1 * MiB - 608 * 512)
+    # Not touched
+    assert data[600 * 512 : 608 * 512] != bytes(8 * 512)
+
+
+def test_erase_progress_counts_each_error_once(tmp_path):
+    path = _make_disk(tmp_path, 1 * MiB)
+    engine = CorruptingEraseEngine(path, block_size=256 * KiB, patterns=profile_patterns("badblocks"), skip_ranges=[[600, 8]])
+    engine.bad_offset = 10
+    progress = []
+
+    result = engine.run(on_progress=progress.append)
+
+    assert result.completed
+    assert result.errors == 16
+    assert progress[-1].errors == 16
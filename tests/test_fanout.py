@@ -0,0 +1,79 @@
+import gzip
+import os
+import threading
+
+from erase_engine import KiB, MiB
+from fanout import FanoutHub, FanoutRegistry
+from imaging import ImageWriter
+
+
+def _make_disks(tmp_path, count: int, size: int):
+    disks = []
+    for i in range(count):
+        path = tmp_path / f"disk{i}.img"
+        path.write_bytes(bytes(size))
+        disks.append(str(path))
+    return disks
+
+
+def _write_all(hub: FanoutHub, image: str, disks, should_continue=None):
+    results = {}
+    streams = [hub.join() for _ in disks]
+
+    def write(i: int):
+        writer = ImageWriter(image, disks[i], block_size=hub.block_size, stream=streams[i])
+        results[i] = writer.run((should_continue or {}).get(i, lambda: True))
+
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(len(disks))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    return results
+
+
+def test_fanout_writes_every_disk(tmp_path):
+    data = os.urandom(1 * MiB + 100)
+    image = tmp_path / "image.img"
+    image.write_bytes(data)
+    disks = _make_disks(tmp_path, 3, 2 * MiB)
+    # Fewer slots than blocks, to go around the ring a few times
+    hub = FanoutHub(str(image), 64 * KiB, slots=3, expected=3, gather_timeout=5)
+
+    results = _write_all(hub, str(image), disks)
+
+    for i, disk in enumerate(disks):
+        assert results[i].completed
+        assert results[i].size == len(data)
+        with open(disk, "rb") as f:
+            assert f.read(len(data)) == data
+
+
+def test_stopped_target_does_not_block_the_others(tmp_path):
+    data = os.urandom(1 * MiB)
+    image = tmp_path / "image.img.gz"
+    image.write_bytes(gzip.compress(data))
+    disks = _make_disks(tmp_path, 2, 1 * MiB)
+    hub = FanoutHub(str(image), 64 * KiB, slots=2, expected=2, gather_timeout=5)
+    calls = []
+
+    results = _write_all(hub, str(image), disks, {0: lambda: calls.append(1) or len(calls) < 3})
+
+    assert not results[0].completed
+    assert results[1].completed
+    with open(disks[1], "rb") as f:
+        assert f.read() == data
+
+
+def test_late_targets_get_a_new_hub(tmp_path):
+    image = tmp_path / "image.img"
+    image.write_bytes(os.urandom(64 * KiB))
+    registry = FanoutRegistry(slots=2, gather_timeout=5)
+
+    first = registry.join(str(image), 64 * KiB, 1)
+    first.get()
+    second = registry.join(str(image), 64 * KiB, 1)
+
+    assert second._hub is not first._hub
+    first.close()
+    second.close()
@@ -0,0 +1,119 @@
+import errno
+import queue
+import struct
+import time
+
+from hotplug import UeventMonitor, parse_uevent
+
+
+def kernel_uevent(action: str, devpath: str, **properties) -> bytes:
+    fields = [f"{action}@{devpath}", f"ACTION={action}", f"DEVPATH={devpath}"] + [f"{key}={value}" for key, value in properties.items()]
+    return "\x00".join(fields).encode("utf-8") + b"\x00"
+
+
+def udev_uevent(action: str, devpath: str, **properties) -> bytes:
+    payload = "\x00".join([f"ACTION={action}", f"DEVPATH={devpath}"] + [f"{key}={value}" for key, value in properties.items()]).encode("utf-8") + b"\x00"
+    header_size = 40
+    return b"libudev\x00" + struct.pack("!I", 0xFEEDCAFE) + struct.pack("=IIIIIII", header_size, header_size, len(payload), 0, 0, 0, 0) + payload
+
+
+class FakeUeventSource:
+    def __init__(self):
+        self.events = queue.Queue()
+
+    def receive(self, timeout: float):
+        try:
+            event = self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if isinstance(event, Exception):
+            raise event
+        return event
+
+
+def test_parse_kernel_and_udev_uevents():
+    for data in (
+        kernel_uevent("add", "/devices/pci0000:00/usb1/1-1/host6/target6:0:0/6:0:0:0/block/sdb", SUBSYSTEM="block", DEVNAME="sdb", DEVTYPE="disk"),
+        udev_uevent("add", "/devices/pci0000:00/usb1/1-1/host6/target6:0:0/6:0:0:0/block/sdb", SUBSYSTEM="block", DEVNAME="/dev/sdb", DEVTYPE="disk"),
+    ):
+        properties = parse_uevent(data)
+
+        assert properties["ACTION"] == "add"
+        assert properties["SUBSYSTEM"] == "block"
+        assert properties["DEVTYPE"] == "disk"
+
+    assert parse_uevent(b"not an event") is None
+
+
+def test_monitor_reports_disks():
+    source = FakeUeventSource()
+    events = []
+    monitor = UeventMonitor(lambda action, path: events.append((action, path)), source, poll_interval=0.05)
+    monitor.start()
+    try:
+        source.events.put(kernel_uevent("add", "/devices/virtual/block/loop0", SUBSYSTEM="block", DEVNAME="loop0", DEVTYPE="disk", MAJOR="7"))
+        source.events.put(
+            kernel_uevent(
+                "add", "/devices/pci0000:00/0000:00:17.0/ata1/host0/target0:0:0/0:0:0:0/block/sda", SUBSYSTEM="block", DEVNAME="sda", DEVTYPE="disk", MAJOR="8"
+            )
+        )
+        source.events.put(
+            kernel_uevent(
+                "add",
+                "/devices/pci0000:00/0000:00:17.0/ata1/host0/target0:0:0/0:0:0:0/block/sda/sda1",
+                SUBSYSTEM="block",
+                DEVNAME="sda1",
+                DEVTYPE="partition",
+                MAJOR="8",
+            )
+        )
+        source.events.put(kernel_uevent("bind", "/devices/pci0000:00/usb1/1-1", SUBSYSTEM="usb"))
+        source.events.put(
+            udev_uevent("remove", "/devices/pci0000:00/0000:01:00.0/nvme/nvme0/nvme0n1", SUBSYSTEM="block", DEVNAME="/dev/nvme0n1", DEVTYPE="disk", MAJOR="259")
+        )
+        for _ in range(100):
+            if len(events) >= 3:
+                break
+            time.sleep(0.02)
+    finally:
+        monitor.stop()
+        monitor.join()
+
+    assert events == [("add", "/dev/sda"), ("change", "/dev/sda"), ("remove", "/dev/nvme0n1")]
+
+
+def test_monitor_resyncs_when_events_are_lost():
+    source = FakeUeventSource()
+    resyncs = []
+    monitor = UeventMonitor(lambda action, path: None, source, poll_interval=0.05, on_resync=lambda: resyncs.append(1))
+    monitor.start()
+    try:
+        source.events.put(OSError(errno.ENOBUFS, "No buffer space available"))
+        for _ in range(100):
+            if len(resyncs) > 0:
+                break
+            time.sleep(0.02)
+    finally:
+        monitor.stop()
+        monitor.join()
+
+    assert resyncs == [1]
+
+
+def test_monitor_backs_off_on_errors():
+    class BrokenSource:
+        calls = 0
+
+        def receive(self, timeout: float):
+            self.calls += 1
+            raise OSError(errno.EIO, "Input/output error")
+
+    source = BrokenSource()
+    monitor = UeventMonitor(lambda action, path: None, source, poll_interval=0.05)
+    monitor.start()
+    time.sleep(0.5)
+    monitor.stop()
+    monitor.join()
+
+    # Waits 0.1, 0.2, 0.4 seconds... instead of spinning
+    assert 1 <= source.calls <= 4
@@ -0,0 +1,97 @@
+import gzip
+import os
+import threading
+import time
+
+from image_catalog import ImageCatalog
+from partition_table import LINUX_GPT_TYPE
+from tests.test_partition_table import make_gpt
+
+
+def _wait_for_checksum(catalog: ImageCatalog, path: str) -> str:
+    for _ in range(100):
+        checksum = catalog.get(os.path.abspath(path))["checksum"]
+        if checksum is not None:
+            return checksum
+        time.sleep(0.05)
+    raise AssertionError("Never hashed")
+
+
+def test_catalog_lists_images(tmp_path):
+    images = tmp_path / "images"
+    images.mkdir()
+    (images / "debian.img").write_bytes(make_gpt([(LINUX_GPT_TYPE, 34, 99)]) + os.urandom(1000))
+    (images / "xubuntu.img.gz").write_bytes(gzip.compress(make_gpt([(LINUX_GPT_TYPE, 34, 99)])))
+    (images / "debian.img.bmap.json").write_text("{}")
+    (images / ".hidden").write_text("")
+    catalog = ImageCatalog(str(tmp_path / "images.json"))
+
+    listed = catalog.list(str(images))
+
+    assert [image["name"] for image in listed] == ["debian.img", "xubuntu.img.gz"]
+    assert listed[0]["size"] == os.path.getsize(images / "debian.img")
+    assert listed[0]["bmap"]
+    assert listed[1]["compression"] == "gzip"
+    for image in listed:
+        assert image["partition_table"] == "gpt"
+        assert image["grow_partition"] == 1
+    assert len(_wait_for_checksum(catalog, str(images / "debian.img"))) == 128
+
+
+def test_catalog_reindexes_changed_images(tmp_path):
+    image = tmp_path / "image.img"
+    image.write_bytes(bytes(4096))
+    catalog = ImageCatalog(str(tmp_path / "images.json"))
+    assert catalog.entry(str(image))["partition_table"] is None
+    old = _wait_for_checksum(catalog, str(image))
+
+    image.write_bytes(make_gpt([(LINUX_GPT_TYPE, 34, 99)]))
+    os.utime(image, ns=(0, 1))
+
+    # From the file, like after a restart
+    catalog = ImageCatalog(str(tmp_path / "images.json"))
+    assert catalog.entry(str(image))["partition_table"] == "gpt"
+    assert _wait_for_checksum(catalog, str(image)) != old
+
+
+def test_catalog_forgets_deleted_images(tmp_path):
+    image = tmp_path / "image.img"
+    image.write_bytes(bytes(4096))
+    catalog = ImageCatalog(str(tmp_path / "state" / "images.json"))
+    catalog.list(str(tmp_path))
+
+    image.unlink()
+
+    assert catalog.list(str(tmp_path)) == []
+    assert catalog.get(os.path.abspath(image)) is None
+
+
+def test_catalog_hashes_each_image_once(tmp_path):
+    image = tmp_path / "image.img"
+    image.write_bytes(bytes(4096))
+    catalog = ImageCatalog(str(tmp_path / "images.json"))
+    hashed = []
+    release = threading.Event()
+    hash_file = catalog.hash_file
+
+    def slow_hash_file(path):
+        hashed.append(path)
+        release.wait(5)
+        return hash_file(path)
+
+    catalog.hash_file = slow_hash_file
+    catalog.entry(str(image))
+    for _ in range(100):
+        if hashed:
+            break
+        time.sleep(0.01)
+
+    # Listed again while it is being hashed
+    catalog.entry(str(image))
+    catalog.entry(str(image))
+    queued = catalog._pending.qsize()
+    release.set()
+
+    assert queued == 0
+    assert _wait_for_checksum(catalog, str(image)) is not None
+    assert hashed == [str(image)]
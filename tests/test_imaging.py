@@ -0,0 +1,215 @@
+import errno
+import gzip
+import hashlib
+import lzma
+import os
+import shutil
+import subprocess
+
+# noinspection PyPackageRequirements
+import pytest
+
+from erase_engine import KiB, MiB
+from imaging import ImageWriter, COPY_BUFFERED, COPY_METHODS, ZEROES_SKIP, ZEROES_WRITE
+
+
+def _make_image(tmp_path, size: int):
+    path = tmp_path / "image.img"
+    path.write_bytes(os.urandom(size))
+    return str(path)
+
+
+def _make_disk(tmp_path, size: int):
+    path = tmp_path / "disk.img"
+    path.write_bytes(bytes(size))
+    return str(path)
+
+
+class NoCopyFileRangeWriter(ImageWriter):
+    """copy_file_range fails after the first MiB, like it would between a file and a block device"""
+
+    def _kernel_step(self, method: str, source_fd: int, target_fd: int, offset: int, length: int, pipe) -> int:
+        if method == "copy_file_range" and offset >= 1 * MiB:
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        return super()._kernel_step(method, source_fd, target_fd, offset, length, pipe)
+
+
+@pytest.mark.parametrize("method", COPY_METHODS)
+@pytest.mark.parametrize("size", [3 * MiB, 3 * MiB + 100])
+def test_image_is_copied(tmp_path, size, method):
+    image = _make_image(tmp_path, size)
+    disk = _make_disk(tmp_path, 4 * MiB)
+    progress = []
+
+    result = ImageWriter(image, disk, block_size=1 * MiB, method=method).run(on_progress=progress.append)
+
+    assert result.completed
+    assert result.size == size
+    assert progress[-1].bytes_done == progress[-1].bytes_total == size
+    with open(image, "rb") as f_image, open(disk, "rb") as f_disk:
+        assert f_disk.read(size) == f_image.read()
+        # The rest of the disk is untouched
+        assert f_disk.read() == bytes(4 * MiB - size)
+
+
+def test_image_copy_can_be_stopped(tmp_path):
+    image = _make_image(tmp_path, 1 * MiB)
+    disk = _make_disk(tmp_path, 1 * MiB)
+    throttled = []
+
+    result = ImageWriter(image, disk, block_size=256 * KiB).run(throttle=lambda amount: throttled.append(amount) or len(throttled) < 3)
+
+    assert not result.completed
+    assert result.size == 512 * KiB
+
+
+def test_image_copy_falls_back(tmp_path):
+    image = _make_image(tmp_path, 3 * MiB)
+    disk = _make_disk(tmp_path, 3 * MiB)
+
+    result = NoCopyFileRangeWriter(image, disk, block_size=512 * KiB).run()
+
+    assert result.completed
+    assert result.method == "sendfile"
+    assert result.size == 3 * MiB
+    with open(image, "rb") as f_image, open(disk, "rb") as f_disk:
+        assert f_disk.read() == f_image.read()
+
+
+def _make_sparse_image(tmp_path):
+    # 1 MiB of data, a 2 MiB hole, 1 MiB of data of which the second half is zeroes
+    path = tmp_path / "sparse.img"
+    with open(path, "wb") as f:
+        f.write(os.urandom(1 * MiB))
+        f.seek(3 * MiB)
+        f.write(os.urandom(512 * KiB))
+        f.write(bytes(512 * KiB))
+    return str(path)
+
+
+def test_zeroes_are_skipped(tmp_path):
+    image = _make_sparse_image(tmp_path)
+    disk = _make_disk(tmp_path, 4 * MiB)
+    progress = []
+
+    result = ImageWriter(image, disk, block_size=1 * MiB, zeroes="skip", zero_block=256 * KiB).run(on_progress=progress.append)
+
+    assert result.completed
+    assert result.size == 4 * MiB
+    assert result.bytes_written == 1 * MiB + 512 * KiB
+    assert progress[-1].bytes_done == 4 * MiB
+    with open(image, "rb") as f_image, open(disk, "rb") as f_disk:
+        assert f_disk.read() == f_image.read()
+
+
+def test_zeroes_are_written_on_dirty_disks(tmp_path):
+    image = _make_sparse_image(tmp_path)
+    disk = tmp_path / "dirty.img"
+    disk.write_bytes(os.urandom(4 * MiB))
+
+    # Not a block device, BLKZEROOUT fails and zeroes are written instead
+    result = ImageWriter(image, str(disk), block_size=1 * MiB, zeroes="zeroout").run()
+
+    assert result.completed
+    assert result.bytes_written == 4 * MiB
+    with open(image, "rb") as f_image:
+        assert disk.read_bytes() == f_image.read()
+
+
+def test_extents_find_holes(tmp_path):
+    image = _make_sparse_image(tmp_path)
+    writer = ImageWriter(image, _make_disk(tmp_path, 4 * MiB), zeroes="skip")
+    writer._size = 4 * MiB
+    fd = os.open(image, os.O_RDONLY)
+    try:
+        extents = list(writer.extents(fd))
+    finally:
+        os.close(fd)
+
+    # Some filesystems do not support holes, and everything is data
+    assert extents in ([(0, 1 * MiB, True), (1 * MiB, 2 * MiB, False), (3 * MiB, 1 * MiB, True)], [(0, 4 * MiB, True)])
+
+
+def _compress(tmp_path, data: bytes, compression: str) -> str:
+    if compression == "gz":
+        path = tmp_path / "image.img.gz"
+        path.write_bytes(gzip.compress(data))
+    elif compression == "xz":
+        path = tmp_path / "image.img.xz"
+        path.write_bytes(lzma.compress(data))
+    else:
+        path = tmp_path / "image.img.zst"
+        if shutil.which("zstd") is None:
+            pytest.skip("No zstd")
+        subprocess.run(("zstd", "-q", "-o", str(path)), input=data, check=True)
+    return str(path)
+
+
+@pytest.mark.parametrize("compression", ["gz", "xz", "zst"])
+def test_compressed_image_is_copied(tmp_path, compression):
+    # Compressible, but not all zeroes
+    data = os.urandom(64 * KiB) * 40 + bytes(500)
+    image = _compress(tmp_path, data, compression)
+    disk = _make_disk(tmp_path, 4 * MiB)
+    progress = []
+
+    result = ImageWriter(image, disk, block_size=256 * KiB, queue_depth=2).run(on_progress=progress.append)
+
+    assert result.completed
+    assert result.method == COPY_BUFFERED
+    assert result.size == len(data)
+    assert progress[-1].bytes_done == progress[-1].bytes_total == len(data)
+    with open(disk, "rb") as f:
+        assert f.read(len(data)) == data
+        assert f.read() == bytes(4 * MiB - len(data))
+
+
+def test_compressed_image_copy_can_be_stopped(tmp_path):
+    image = _compress(tmp_path, os.urandom(2 * MiB), "gz")
+    disk = _make_disk(tmp_path, 2 * MiB)
+    throttled = []
+
+    result = ImageWriter(image, disk, block_size=256 * KiB).run(throttle=lambda amount: throttled.append(amount) or len(throttled) < 3)
+
+    assert not result.completed
+    assert result.size == 512 * KiB
+
+
+def test_corrupted_compressed_image(tmp_path):
+    image = tmp_path / "image.img.xz"
+    image.write_bytes(lzma.compress(os.urandom(1 * MiB))[:-100])
+    disk = _make_disk(tmp_path, 2 * MiB)
+
+    with pytest.raises(OSError):
+        ImageWriter(str(image), disk, block_size=256 * KiB).run()
+
+
+@pytest.mark.parametrize("zeroes", [ZEROES_WRITE, ZEROES_SKIP])
+def test_image_is_hashed_while_copied(tmp_path, zeroes):
+    image = tmp_path / "image.img"
+    with open(image, "wb") as f:
+        f.write(os.urandom(100 * KiB))
+        f.seek(1 * MiB)
+        f.write(os.urandom(100))
+    disk = _make_disk(tmp_path, 2 * MiB)
+    writer = ImageWriter(str(image), disk, block_size=256 * KiB, zeroes=zeroes, checksum="blake2b")
+
+    result = writer.run()
+
+    assert result.method == COPY_BUFFERED
+    assert result.digest == hashlib.blake2b(image.read_bytes()).hexdigest()
+    assert writer.verify([(0, result.size, result.digest)], hashlib.blake2b) == []
+    with open(disk, "r+b") as f:
+        f.seek(1 * MiB + 50)
+        f.write(b"\x00")
+    assert writer.verify([(0, result.size, result.digest)], hashlib.blake2b) == [(0, result.size)]
+
+
+def test_compressed_image_is_hashed_while_copied(tmp_path):
+    data = os.urandom(300 * KiB)
+    image = _compress(tmp_path, data, "gz")
+    disk = _make_disk(tmp_path, 1 * MiB)
+
+    result = ImageWriter(image, disk, block_size=128 * KiB, checksum="blake2b").run()
+
+    assert result.digest == hashlib.blake2b(data).hexdigest()
@@ -0,0 +1,77 @@
+import struct
+import uuid
+
+from partition_table import parse_partition_table, partition_path, reread_partition_table, LINUX_GPT_TYPE
+
+EFI_SYSTEM = "c12a7328-f81f-11d2-ba4b-00a0c93ec93b"
+
+
+def make_gpt(partitions, sector_size: int = 512) -> bytes:
+    """partitions are (type GUID, first LBA, last LBA)"""
+    head = bytearray(sector_size * 2 + 128 * 128)
+    head[446 + 4] = 0xEE
+    head[510:512] = b"\x55\xaa"
+    head[sector_size : sector_size + 8] = b"EFI PART"
+    struct.pack_into("<QII", head, sector_size + 72, 2, 128, 128)
+    for i, (part_type, first, last) in enumerate(partitions):
+        offset = sector_size * 2 + i * 128
+        head[offset : offset + 16] = uuid.UUID(part_type).bytes_le
+        head[offset + 16 : offset + 32] = uuid.uuid4().bytes_le
+        struct.pack_into("<QQ", head, offset + 32, first, last)
+        head[offset + 56 : offset + 56 + 8] = "root".encode("utf-16-le")
+    return bytes(head)
+
+
+def make_mbr(partitions) -> bytes:
+    """partitions are (type, first LBA, sectors)"""
+    head = bytearray(512)
+    for i, (part_type, first, sectors) in enumerate(partitions):
+        struct.pack_into("<B3xB3xII", head, 446 + i * 16, 0x80 if i == 0 else 0, part_type, first, sectors)
+    head[510:512] = b"\x55\xaa"
+    return bytes(head)
+
+
+def test_gpt():
+    table = parse_partition_table(make_gpt([(EFI_SYSTEM, 2048, 4095), (LINUX_GPT_TYPE, 4096, 8191)]))
+
+    assert table.table_type == "gpt"
+    assert [(p.number, p.start, p.size, p.linux) for p in table.partitions] == [(1, 2048 * 512, 2048 * 512, False), (2, 4096 * 512, 4096 * 512, True)]
+    assert table.partitions[1].name == "root"
+    assert table.last_linux_partition().number == 2
+
+
+def test_gpt_4k_sectors():
+    table = parse_partition_table(make_gpt([(LINUX_GPT_TYPE, 256, 511)], 4096))
+
+    assert table.table_type == "gpt"
+    assert table.partitions[0].start == 256 * 4096
+
+
+def test_mbr():
+    # Linux, swap, extended
+    table = parse_partition_table(make_mbr([(0x83, 2048, 1000), (0x82, 4096, 1000), (0x05, 8192, 1000)]))
+
+    assert table.table_type == "dos"
+    assert [(p.number, p.part_type) for p in table.partitions] == [(1, "0x83"), (2, "0x82")]
+    assert table.last_linux_partition().number == 1
+
+
+def test_no_partition_table():
+    table = parse_partition_table(bytes(4096))
+
+    assert table.table_type is None
+    assert table.last_linux_partition() is None
+
+
+def test_partition_path():
+    assert partition_path("/dev/sda", 2) == "/dev/sda2"
+    assert partition_path("/dev/nvme0n1", 2) == "/dev/nvme0n1p2"
+    assert partition_path("/dev/mmcblk0", 1) == "/dev/mmcblk0p1"
+
+
+def test_reread_partition_table_needs_a_disk(tmp_path):
+    image = tmp_path / "disk.img"
+    image.write_bytes(bytes(4096))
+
+    assert not reread_partition_table(str(image))
+    assert not reread_partition_table(str(tmp_path / "missing.img"))
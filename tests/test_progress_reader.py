@@ -0,0 +1,101 @@
+import os
+
+# noinspection PyPackageRequirements
+import pytest
+
+from progress_reader import ProgressReader, BadblocksProgressParser, E2fsckProgressParser, Resize2fsProgressParser, GrowpartParser
+
+
+def _status(percent: str, errors: str = "0/0/0"):
+    line = f"{percent}% done, 0:05 elapsed. ({errors} errors)"
+    return line + "\b" * len(line)
+
+
+def _read_all(data: bytes, parser, chunk_size: int = 64 * 1024):
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, data)
+    os.close(write_fd)
+    try:
+        return [progress for progress in ProgressReader(read_fd, parser, chunk_size) if progress is not None]
+    finally:
+        os.close(read_fd)
+
+
+def test_badblocks_parser_write_pass():
+    parser = BadblocksProgressParser()
+    parser.scan("Testing with pattern 0x00: ")
+    progress = parser.parse(" 50.00% done, 1:05 elapsed. (0/1/0 errors)")
+
+    assert progress.percent == pytest.approx(25.0)
+    assert progress.errors == 1
+
+
+def test_badblocks_parser_read_pass():
+    parser = BadblocksProgressParser()
+    parser.scan("Testing with pattern 0x00: done\nReading and comparing: ")
+    progress = parser.parse(" 50.00% done, 1:05 elapsed. (1/2/3 errors)")
+
+    assert progress.percent == pytest.approx(75.0)
+    assert progress.errors == 6
+
+
+def test_badblocks_parser_ignores_other_messages():
+    parser = BadblocksProgressParser()
+
+    assert parser.parse("Checking for bad blocks in read-write mode") is None
+    assert parser.errors == -1
+
+
+@pytest.mark.parametrize("chunk_size", [7, 64 * 1024])
+def test_progress_reader_returns_latest_frame(chunk_size):
+    data = "Checking for bad blocks in read-write mode\nFrom block 0 to 100\nTesting with pattern 0x00: "
+    data += _status("10.00") + _status("20.00") + "done                                                 \n"
+    data += "Reading and comparing: " + _status("50.00", "0/0/2") + _status("100.00", "0/0/2") + "done\n"
+
+    parser = BadblocksProgressParser()
+    progress = _read_all(data.encode("utf-8"), parser, chunk_size)
+
+    assert progress[-1].percent == pytest.approx(100.0)
+    assert parser.errors == 2
+    percentages = [p.percent for p in progress]
+    assert percentages == sorted(percentages)
+
+
+def test_progress_reader_no_output():
+    parser = BadblocksProgressParser()
+
+    assert _read_all(b"", parser) == []
+    assert parser.errors == -1
+
+
+def test_e2fsck_parser():
+    data = "e2fsck 1.47.0 (5-Feb-2023)\nPass 1: Checking inodes, blocks, and sizes\n1 50 100 /dev/sda2\n1 100 100 /dev/sda2\n2 10 40 /dev/sda2\n"
+
+    progress = _read_all(data.encode("utf-8"), E2fsckProgressParser())
+
+    assert progress[-1].percent == pytest.approx(70.0 + 20.0 / 4)
+    assert progress[-1].text == "e2fsck pass 2"
+
+
+def test_resize2fs_parser_reads_the_bar_being_drawn():
+    data = "Resizing the filesystem on /dev/sda2 to 1000 (4k) blocks.\nBegin pass 1 (max = 8)\nExtending the inode table     "
+    data += "-" * 40 + "\b" * 40 + "X" * 10
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, data.encode("utf-8"))
+    reader = iter(ProgressReader(read_fd, Resize2fsProgressParser()))
+    try:
+        progress = next(reader)
+    finally:
+        os.close(write_fd)
+        os.close(read_fd)
+
+    assert progress.percent == pytest.approx(25.0)
+    assert progress.text == "resize2fs pass 1"
+
+
+def test_growpart_parser():
+    parser = GrowpartParser()
+
+    assert _read_all(b"NOCHANGE: partition 2 is size 1000. it cannot be grown\n", parser) == []
+    assert parser.nochange
+    assert not parser.changed
@@ -0,0 +1,43 @@
+import time
+
+from rate_limiter import RateLimiter
+
+
+def test_unlimited_does_not_wait():
+    limiter = RateLimiter()
+    start = time.monotonic()
+    for _ in range(100):
+        assert limiter.consume(1024 * 1024 * 1024)
+    assert time.monotonic() - start < 0.1
+
+
+def test_limit_is_respected():
+    limiter = RateLimiter(1000 * 1000, poll_interval=0.01)
+    start = time.monotonic()
+    for _ in range(4):
+        assert limiter.consume(100 * 1000)
+    # 400 kB at 1 MB/s
+    assert 0.3 <= time.monotonic() - start < 1.0
+
+
+def test_stop_while_waiting():
+    limiter = RateLimiter(1000, poll_interval=0.01)
+    start = time.monotonic()
+    assert not limiter.consume(1000 * 1000, lambda: False)
+    assert time.monotonic() - start < 0.5
+
+
+def test_rate_change_wakes_up_waiting():
+    limiter = RateLimiter(1000, poll_interval=0.01)
+    calls = []
+
+    def should_continue():
+        calls.append(None)
+        if len(calls) == 3:
+            limiter.set_rate(0)
+        return True
+
+    start = time.monotonic()
+    assert limiter.consume(1000 * 1000, should_continue)
+    assert time.monotonic() - start < 0.5
+    assert limiter.rate == 0
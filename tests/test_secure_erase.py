@@ -0,0 +1,221 @@
+import json
+
+# noinspection PyPackageRequirements
+import pytest
+
+from secure_erase import (
+    SecureEraser,
+    SecureEraseError,
+    parse_hdparm_security,
+    ATA_SECURITY_ERASE,
+    ATA_ENHANCED_SECURITY_ERASE,
+    NVME_SANITIZE,
+    NVME_FORMAT,
+    DISCARD,
+)
+
+HDPARM_NOT_FROZEN = """
+/dev/sda:
+
+ATA device, with non-removable media
+\tModel Number:       Samsung SSD 850 EVO 250GB
+Security:
+\tMaster password revision code = 65534
+\t\tsupported
+\tnot\tenabled
+\tnot\tlocked
+\tnot\tfrozen
+\tnot\texpired: security count
+\t\tsupported: enhanced erase
+\t2min for SECURITY ERASE UNIT. 4min for ENHANCED SECURITY ERASE UNIT.
+Logical Unit WWN Device Identifier: 5002538d40000000
+Checksum: correct
+"""
+
+HDPARM_FROZEN = HDPARM_NOT_FROZEN.replace("\tnot\tfrozen", "\t\tfrozen")
+
+
+class FakeProcess:
+    def __init__(self, polls: int, exitcode: int = 0):
+        self._polls = polls
+        self._exitcode = exitcode
+
+    def poll(self):
+        if self._polls > 0:
+            self._polls -= 1
+            return None
+        return self._exitcode
+
+
+class FakeDevice:
+    def __init__(self, path: str, responses: dict, sysfs: dict):
+        self.path = path
+        self.name = path.rsplit("/", 1)[-1]
+        self.responses = responses
+        self._sysfs = sysfs
+        self.commands = []
+        self.clock = 0.0
+        self.exitcode = 0
+
+    def sysfs(self, attribute: str):
+        return self._sysfs.get(attribute)
+
+    def run(self, command: tuple):
+        self.commands.append(command)
+        response = self.responses.get(command[:2], (1, ""))
+        if isinstance(response, list):
+            return response.pop(0)
+        return response
+
+    def start(self, command: tuple):
+        self.commands.append(command)
+        return FakeProcess(3, self.exitcode)
+
+    def wait(self, seconds: float):
+        self.clock += seconds
+
+    def now(self):
+        return self.clock
+
+
+def _ata_device(hdparm: str = HDPARM_NOT_FROZEN, rotational: str = "0"):
+    return FakeDevice(
+        "/dev/sda",
+        {("hdparm", "-I"): (0, hdparm), ("hdparm", "--user-master"): (0, "")},
+        {"queue/rotational": rotational, "queue/discard_max_bytes": "2147450880", "size": str(5 * 1024**3 // 512)},
+    )
+
+
+def test_parse_hdparm_security():
+    security = parse_hdparm_security(HDPARM_NOT_FROZEN)
+
+    assert security["supported"]
+    assert not security["enabled"]
+    assert not security["frozen"]
+    assert security["enhanced"]
+    assert security["minutes"] == 2
+    assert security["enhanced_minutes"] == 4
+
+
+def test_parse_hdparm_no_security():
+    assert not parse_hdparm_security("/dev/sdb:\n\nATA device\n")["supported"]
+
+
+def test_ata_methods():
+    eraser = SecureEraser(_ata_device())
+
+    assert eraser.supported_methods() == [ATA_ENHANCED_SECURITY_ERASE, ATA_SECURITY_ERASE, DISCARD]
+
+
+def test_ata_frozen_falls_back_to_discard():
+    eraser = SecureEraser(_ata_device(HDPARM_FROZEN))
+
+    assert eraser.best_method() == DISCARD
+
+
+def test_hdd_without_security():
+    eraser = SecureEraser(_ata_device(HDPARM_FROZEN, rotational="1"))
+
+    assert eraser.best_method() is None
+
+
+def test_ata_erase():
+    device = _ata_device()
+    eraser = SecureEraser(device)
+    progress = []
+
+    assert eraser.erase(ATA_ENHANCED_SECURITY_ERASE, lambda p, t: progress.append(p))
+    assert ("hdparm", "--user-master", "u", "--security-erase-enhanced", "pesto", "/dev/sda") in device.commands
+    assert progress == sorted(progress)
+
+
+def test_ata_erase_failed_removes_password():
+    device = _ata_device()
+    device.exitcode = 5
+    eraser = SecureEraser(device)
+
+    with pytest.raises(SecureEraseError):
+        eraser.erase(ATA_SECURITY_ERASE, lambda p, t: None)
+    assert device.commands[-1] == ("hdparm", "--user-master", "u", "--security-disable", "pesto", "/dev/sda")
+
+
+def test_discard_in_steps():
+    device = _ata_device()
+    device.responses[("blkdiscard", "-o")] = (0, "")
+    eraser = SecureEraser(device)
+
+    assert eraser.erase(DISCARD, lambda p, t: None)
+    discards = [c for c in device.commands if c[0] == "blkdiscard"]
+    assert len(discards) == 5
+
+
+def test_discard_stopped():
+    device = _ata_device()
+    eraser = SecureEraser(device)
+
+    assert not eraser.erase(DISCARD, lambda p, t: None, lambda: False)
+
+
+def test_unsupported_method():
+    eraser = SecureEraser(_ata_device(HDPARM_FROZEN))
+
+    with pytest.raises(SecureEraseError):
+        eraser.erase(ATA_SECURITY_ERASE, lambda p, t: None)
+
+
+def _nvme_device(sanicap: int):
+    return FakeDevice(
+        "/dev/nvme0n1",
+        {
+            ("nvme", "id-ctrl"): (0, json.dumps({"sanicap": sanicap, "fna": 4})),
+            ("nvme", "sanitize"): (0, ""),
+            ("nvme", "format"): (0, ""),
+            ("nvme", "sanitize-log"): [
+                (0, json.dumps({"nvme0": {"sprog": 32768, "sstat": 2}})),
+                (0, json.dumps({"nvme0": {"sprog": 65535, "sstat": 257}})),
+            ],
+        },
+        {"queue/rotational": "0", "queue/discard_max_bytes": "0"},
+    )
+
+
+def test_nvme_sanitize():
+    device = _nvme_device(sanicap=3)
+    eraser = SecureEraser(device)
+    progress = []
+
+    assert eraser.best_method() == NVME_SANITIZE
+    assert eraser.erase(NVME_SANITIZE, lambda p, t: progress.append(p))
+    assert ("nvme", "sanitize", "/dev/nvme0n1", "-a", "4") in device.commands
+    assert progress == [50.0]
+
+
+def test_nvme_sanitize_ignored():
+    device = _nvme_device(sanicap=3)
+    device.responses[("nvme", "sanitize-log")] = [(0, json.dumps({"nvme0": {"sprog": 65535, "sstat": 0}}))] * 10
+    eraser = SecureEraser(device)
+
+    with pytest.raises(SecureEraseError):
+        eraser.erase(NVME_SANITIZE, lambda p, t: None)
+    assert device.commands.count(("nvme", "sanitize-log", "-o", "json", "/dev/nvme0n1")) == 5
+
+
+def test_nvme_sanitize_timeout():
+    device = _nvme_device(sanicap=3)
+    stuck = {"nvme0": {"sprog": 100, "sstat": 2, "time_crypto_erase": 60}}
+    device.responses[("nvme", "sanitize-log")] = [(0, json.dumps(stuck))] * 1000
+    eraser = SecureEraser(device, poll_interval=10)
+
+    with pytest.raises(SecureEraseError):
+        eraser.erase(NVME_SANITIZE, lambda p, t: None)
+    # 60 * 2 + 600 seconds
+    assert device.clock == 730
+
+
+def test_nvme_without_sanitize():
+    device = _nvme_device(sanicap=0)
+    eraser = SecureEraser(device)
+
+    assert eraser.supported_methods() == [NVME_FORMAT]
+    assert eraser.erase(NVME_FORMAT, lambda p, t: None)
+    assert ("nvme", "format", "/dev/nvme0n1", "-s", "2", "-f") in device.commands
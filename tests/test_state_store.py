@@ -0,0 +1,93 @@
+from state_store import JsonStore, CheckpointStore, BadBlockStore, CodeCache
+
+
+def test_json_store_persists(tmp_path):
+    path = str(tmp_path / "state" / "store.json")
+    store = JsonStore(path)
+    store.set("a", {"b": 1})
+    store.set("c", 2)
+    store.delete("c")
+
+    assert JsonStore(path).get("a") == {"b": 1}
+    assert JsonStore(path).get("c") is None
+
+
+def test_json_store_ignores_garbage(tmp_path):
+    path = tmp_path / "store.json"
+    path.write_text("{not json")
+
+    assert JsonStore(str(path)).get("a") is None
+
+
+def test_checkpoint_only_for_same_disk(tmp_path):
+    path = str(tmp_path / "checkpoints.json")
+    disk = ("/dev/sda", None, "S123")
+    CheckpointStore(path).set_checkpoint(disk, 1000, "0x00", 500, 1, [[10, 1]])
+    store = CheckpointStore(path)
+
+    assert store.get_checkpoint(disk, 1000, "0x00")["verified"] == 500
+    assert store.get_checkpoint(disk, 1000, "0x00")["error_ranges"] == [[10, 1]]
+    assert store.get_checkpoint(("/dev/sda", None, "S456"), 1000, "0x00") is None
+    assert store.get_checkpoint(disk, 2000, "0x00") is None
+    assert store.get_checkpoint(disk, 1000, "random") is None
+
+    store.clear_checkpoint(disk)
+    assert CheckpointStore(path).get_checkpoint(disk, 1000, "0x00") is None
+
+
+def test_checkpoint_keeps_seed(tmp_path):
+    path = str(tmp_path / "checkpoints.json")
+    disk = ("/dev/sda", None, "S123")
+    CheckpointStore(path).set_checkpoint(disk, 1000, "random", 500, 0, seed=2**63 + 5)
+
+    assert CheckpointStore(path).get_checkpoint(disk, 1000, "random")["seed"] == 2**63 + 5
+
+
+def test_bad_block_map_replaces_scanned_part(tmp_path):
+    path = str(tmp_path / "badblocks.json")
+    store = BadBlockStore(path)
+    store.update_map("S123", 8192 * 512, 512, [[10, 8], [5000, 16]])
+    # Only the second half was scanned again, and 5000 has been remapped
+    store.update_map("S123", 8192 * 512, 512, [[7000, 8]], start=4096)
+
+    bad_map = BadBlockStore(path).get_map("S123")
+    assert bad_map["ranges"] == [[10, 8], [7000, 8]]
+    assert bad_map["bad_sectors"] == 16
+    assert BadBlockStore(path).get_map("S456") is None
+
+
+def test_bad_block_map_of_another_size_is_dropped(tmp_path):
+    store = BadBlockStore(str(tmp_path / "badblocks.json"))
+    store.update_map("S123", 8192 * 512, 512, [[10, 8]])
+    store.update_map("S123", 4096 * 4096, 4096, [[1, 1]], start=0, end=0)
+
+    assert store.get_map("S123")["ranges"] == [[1, 1]]
+
+
+def test_code_cache_expires(tmp_path, monkeypatch):
+    path = str(tmp_path / "codes.json")
+    now = [1000.0]
+    monkeypatch.setattr("state_store.time.time", lambda: now[0])
+    cache = CodeCache(path, ttl=100, negative_ttl=10)
+    cache.remember("WD-abc123 ", "H1")
+    cache.remember("XYZ", None)
+
+    cache = CodeCache(path, ttl=100, negative_ttl=10)
+    assert cache.lookup("ABC123") == (True, "H1")
+    assert cache.lookup("XYZ") == (True, None)
+    now[0] += 50
+    assert cache.lookup("abc123") == (True, "H1")
+    assert cache.lookup("XYZ") == (False, None)
+    now[0] += 100
+    assert cache.lookup("ABC123") == (False, None)
+    assert cache.stats()["hits"] == 3
+    assert cache.stats()["misses"] == 2
+    assert cache.stats()["entries"] == 0
+
+
+def test_code_cache_invalidate(tmp_path):
+    cache = CodeCache(str(tmp_path / "codes.json"))
+    cache.remember("S1", None)
+    cache.invalidate("S1")
+
+    assert cache.lookup("S1") == (False, None)